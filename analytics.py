@@ -0,0 +1,195 @@
+"""
+Population statistics from incrementally maintained rollup tables
+
+severity_daily counts assessments per day, questionnaire and severity;
+question_totals holds per-question answer counts, score sums and positive
+(non-zero) answers per questionnaire, so severities of different scales
+are never added up, and PHQ-9 means are not mixed with the items an
+adaptive screen that stopped early (a 'phq2' result) did answer.
+Questions are numbered within their instrument: a 'phq2' result answers
+PHQ-9 questions 1, 2 and 9.  Both tables are updated in the
+same transaction as every assessment insert (see
+database._insert_assessment) and are filled for older rows by the
+analytics_rollups backfill, so reading them never scans assessments.
+
+Usage:
+  python analytics.py [summary]        overall distribution, question means, item 9
+  python analytics.py daily [--days 30]
+  python analytics.py backfill         build the rollups for existing rows now
+"""
+from collections import Counter
+
+from questionnaires import PHQ9_ITEM9, QUESTIONNAIRES
+
+# Item 9 asks about thoughts of self-harm; every PHQ-9 flow asks it
+ITEM9 = 9
+ITEM9_QUESTIONNAIRES = tuple(q.key for q in QUESTIONNAIRES.values() if PHQ9_ITEM9 in q.items)
+
+
+def question_numbers(questionnaire):
+    """Question number within its instrument of each answer, in items order"""
+    return [int(item.partition('.')[2]) for item in QUESTIONNAIRES[questionnaire].items]
+
+
+def update_rollups(conn, assessment_id, questionnaire, severity, answers):
+    """Count one new assessment in the rollups; runs inside the insert's transaction"""
+    conn.execute('''
+        INSERT INTO severity_daily (day, questionnaire, severity, count)
+        SELECT date(assessment_date), ?, ?, 1 FROM assessments WHERE assessment_id = ?
+        ON CONFLICT (day, questionnaire, severity) DO UPDATE SET count = count + 1
+    ''', (questionnaire, severity, assessment_id))
+    _add_question_totals(conn, [
+        (questionnaire, question, 1, value, int(value > 0))
+        for question, value in zip(question_numbers(questionnaire), answers)
+    ])
+
+
+def _add_question_totals(conn, rows):
+    conn.executemany('''
+        INSERT INTO question_totals (questionnaire, question, answered, score_sum, positive)
+        VALUES (?, ?, ?, ?, ?)
+        ON CONFLICT (questionnaire, question) DO UPDATE SET
+            answered = answered + excluded.answered,
+            score_sum = score_sum + excluded.score_sum,
+            positive = positive + excluded.positive
+    ''', rows)
+
+
+def add_chunk(conn, rows, decode):
+    """Count (day, questionnaire, severity, answers_packed, answers) rows from a backfill chunk"""
+    severities = Counter()
+    answered = Counter()
+    score_sums = Counter()
+    positives = Counter()
+    for day, questionnaire, severity, answers_packed, answers_text in rows:
+        severities[day, questionnaire, severity] += 1
+        answers = decode(answers_packed, answers_text)
+        for question, value in zip(question_numbers(questionnaire), answers):
+            key = questionnaire, question
+            answered[key] += 1
+            score_sums[key] += value
+            positives[key] += value > 0
+
+    conn.executemany('''
+        INSERT INTO severity_daily (day, questionnaire, severity, count) VALUES (?, ?, ?, ?)
+        ON CONFLICT (day, questionnaire, severity) DO UPDATE SET count = count + excluded.count
+    ''', [(*key, count) for key, count in severities.items()])
+    _add_question_totals(conn, [
+        (*key, answered[key], score_sums[key], positives[key])
+        for key in answered
+    ])
+
+
+# ============================================
+# Queries (constant time in the number of assessments)
+# ============================================
+
+def severity_counts(conn, day=None):
+    """{(questionnaire, severity): count} for one day, or for all days"""
+    if day is None:
+        rows = conn.execute('''
+            SELECT questionnaire, severity, SUM(count) FROM severity_daily GROUP BY questionnaire, severity
+        ''')
+    else:
+        rows = conn.execute(
+            'SELECT questionnaire, severity, count FROM severity_daily WHERE day = ?', (day,)
+        )
+    return {(questionnaire, severity): count for questionnaire, severity, count in rows}
+
+
+def daily_severity(conn, days=30):
+    """{day: {(questionnaire, severity): count}} for the most recent days with assessments"""
+    rows = conn.execute('''
+        SELECT day, questionnaire, severity, count FROM severity_daily
+        WHERE day >= (SELECT date(MAX(day), ?) FROM severity_daily)
+        ORDER BY day
+    ''', (f'-{days - 1} days',)).fetchall()
+    result = {}
+    for day, questionnaire, severity, count in rows:
+        result.setdefault(day, {})[questionnaire, severity] = count
+    return result
+
+
+def question_totals(conn):
+    """{(questionnaire, question): (answered, score_sum, positive)}"""
+    rows = conn.execute('SELECT questionnaire, question, answered, score_sum, positive FROM question_totals')
+    return {(questionnaire, question): (answered, score_sum, positive)
+            for questionnaire, question, answered, score_sum, positive in rows}
+
+
+def merge(results):
+    """Sum results of the functions above from several shards"""
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            if isinstance(value, dict):
+                merged[key] = dict(Counter(merged.get(key, {})) + Counter(value))
+            elif isinstance(value, tuple):
+                previous = merged.get(key, (0,) * len(value))
+                merged[key] = tuple(a + b for a, b in zip(previous, value))
+            else:
+                merged[key] = merged.get(key, 0) + value
+    return merged
+
+
+def question_means(totals, questionnaire):
+    """{question: mean score} over one questionnaire's results"""
+    return {question: score_sum / answered for (key, question), (answered, score_sum, _) in sorted(totals.items())
+            if key == questionnaire and answered}
+
+
+def item9_positive_share(totals):
+    """Share of item 9 answers above 0, over every result that asked it"""
+    answered = positive = 0
+    for questionnaire in ITEM9_QUESTIONNAIRES:
+        item_answered, _, item_positive = totals.get((questionnaire, ITEM9), (0, 0, 0))
+        answered += item_answered
+        positive += item_positive
+    return positive / answered if answered else None
+
+
+def _title(questionnaire):
+    return QUESTIONNAIRES[questionnaire].title if questionnaire in QUESTIONNAIRES else questionnaire
+
+
+def query(fn, *args):
+    """Run a query function on the database, or on every shard when sharded"""
+    from sharding import SHARD_COUNT, fanout
+    if SHARD_COUNT > 1:
+        return merge(fanout(fn, *args))
+    import database
+    return database.submit_read(fn, *args).result()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Assessment statistics from the rollup tables")
+    parser.add_argument('command', nargs='?', default='summary', choices=('summary', 'daily', 'backfill'))
+    parser.add_argument('--days', type=int, default=30)
+    args = parser.parse_args()
+
+    import database
+    if args.command == 'backfill':
+        database.init_database(backfill=False)
+        database.run_backfills()
+        print("Rollups are up to date")
+    elif args.command == 'daily':
+        for day, counts in query(daily_severity, args.days).items():
+            print(f"{day}  " + "  ".join(f"{_title(questionnaire)} {severity}: {count}"
+                                         for (questionnaire, severity), count in sorted(counts.items())))
+    else:
+        counts = query(severity_counts)
+        totals = query(question_totals)
+        print(f"Assessments: {sum(counts.values())}")
+        for questionnaire in sorted({key for key, _ in counts}):
+            subtotal = sum(count for (key, _), count in counts.items() if key == questionnaire)
+            print(f"{_title(questionnaire)}: {subtotal}")
+            by_severity = [(severity, count) for (key, severity), count in counts.items() if key == questionnaire]
+            for severity, count in sorted(by_severity, key=lambda item: -item[1]):
+                print(f"  {severity:<18} {count:>8}  {count / subtotal:6.1%}")
+            means = question_means(totals, questionnaire)
+            print("  Mean score per question: " + "  ".join(f"Q{question} {mean:.2f}" for question, mean in means.items()))
+        share = item9_positive_share(totals)
+        print(f"Item 9 answered above 0: {'n/a' if share is None else f'{share:.1%}'}")
+    database.close_database()
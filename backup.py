@@ -0,0 +1,274 @@
+"""
+Online backups of the bot database
+
+snapshot() copies the live database with the SQLite backup API,
+BACKUP_PAGES pages per step with a BACKUP_PAUSE between steps, from its
+own read-only connection.  That connection holds one read transaction for
+the whole copy: in WAL mode this pins a consistent snapshot, so writers
+carry on (their commits go to the WAL) and the copy is never restarted by
+them, as an unpinned stepwise backup would be on every write.  The copy
+is written next to its final name, switched to a single-file journal
+mode, checked with PRAGMA integrity_check and only then renamed, so a
+snapshot that exists is complete.
+
+With BACKUP_INTERVAL set the bot takes one snapshot per interval (named
+after the start of the interval, so a restart or a second worker on the
+same database does not take another) and keeps the newest BACKUP_KEEP.
+
+Usage:
+  python backup.py snapshot            take a snapshot now
+  python backup.py list
+  python backup.py verify [SNAPSHOT]   integrity check, the newest by default
+  python backup.py restore SNAPSHOT [--force]   with the bot stopped
+"""
+import asyncio
+import logging
+import os
+import sqlite3
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger(__name__)
+
+DB_PATH = os.getenv('DATABASE_PATH', './data/users.db')
+BACKUP_DIR = os.getenv('BACKUP_DIR', os.path.join(os.path.dirname(DB_PATH) or '.', 'backups'))
+
+# Seconds between scheduled snapshots, 0 to disable; newest BACKUP_KEEP kept
+BACKUP_INTERVAL = float(os.getenv('BACKUP_INTERVAL', '0'))
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '7'))
+
+# Pages copied per step (4 KiB each by default) and seconds between steps
+BACKUP_PAGES = int(os.getenv('BACKUP_PAGES', '256'))
+BACKUP_PAUSE = float(os.getenv('BACKUP_PAUSE', '0.005'))
+
+# A .part file untouched for this long was left by an interrupted snapshot
+STALE_PART_SECONDS = 24 * 3600
+
+_task = None
+
+
+class Snapshot(NamedTuple):
+    path: str
+    bytes: int
+    pages: int
+    steps: int
+    seconds: float
+
+    @property
+    def mb_per_s(self):
+        return self.bytes / 1e6 / self.seconds if self.seconds else 0.0
+
+
+class BackupError(Exception):
+    """A snapshot or restore failed its integrity check"""
+
+
+def _prefix(source):
+    return os.path.splitext(os.path.basename(source))[0] + '-'
+
+
+def snapshot_path(timestamp, source=DB_PATH, dest_dir=BACKUP_DIR):
+    name = _prefix(source) + time.strftime('%Y%m%d-%H%M%S', time.gmtime(timestamp)) + '.db'
+    return os.path.join(dest_dir, name)
+
+
+def integrity_check(path):
+    """Problems PRAGMA integrity_check finds in a database file, empty if none"""
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        rows = [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    finally:
+        conn.close()
+    return [] if rows == ['ok'] else rows
+
+
+def _copy(source_conn, path, pages, pause):
+    """Stepwise backup of source_conn into a new file at path, returns (pages, steps)"""
+    steps = 0
+    total = 0
+
+    def progress(status, remaining, pagecount):
+        nonlocal steps, total
+        steps += 1
+        total = pagecount
+        if remaining and pause:
+            time.sleep(pause)
+
+    target = sqlite3.connect(path)
+    try:
+        source_conn.backup(target, pages=pages, progress=progress)
+        # The copy would otherwise be in WAL mode like the source
+        target.execute('PRAGMA journal_mode=DELETE')
+    finally:
+        target.close()
+    return total, steps
+
+
+def snapshot(source=DB_PATH, dest=None, pages=BACKUP_PAGES, pause=BACKUP_PAUSE):
+    """
+    Copy the live database to dest (a new timestamped file by default)
+
+    Returns a Snapshot, or None if dest already exists or another process is
+    writing it.  Raises BackupError if the copy fails its integrity check.
+    """
+    dest = dest or snapshot_path(time.time(), source)
+    if os.path.exists(dest):
+        return None
+    os.makedirs(os.path.dirname(dest) or '.', exist_ok=True)
+    part = dest + '.part'
+    try:
+        # Claims the snapshot: a second process taking the same one backs off
+        os.close(os.open(part, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return None
+
+    started = time.perf_counter()
+    try:
+        conn = sqlite3.connect(f"file:{source}?mode=ro", uri=True)
+        try:
+            # Pin one WAL snapshot for the whole copy
+            conn.execute('BEGIN')
+            conn.execute('SELECT COUNT(*) FROM sqlite_master').fetchone()
+            pages_copied, steps = _copy(conn, part, pages, pause)
+            conn.rollback()
+        finally:
+            conn.close()
+        problems = integrity_check(part)
+        if problems:
+            raise BackupError(f"Snapshot of {source} failed the integrity check: {problems[:5]}")
+        os.replace(part, dest)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    return Snapshot(dest, os.path.getsize(dest), pages_copied, steps, time.perf_counter() - started)
+
+
+def list_snapshots(source=DB_PATH, dest_dir=BACKUP_DIR):
+    """Paths of the source's snapshots, oldest first"""
+    if not os.path.isdir(dest_dir):
+        return []
+    prefix = _prefix(source)
+    return sorted(
+        os.path.join(dest_dir, name) for name in os.listdir(dest_dir)
+        if name.startswith(prefix) and name.endswith('.db')
+    )
+
+
+def prune(source=DB_PATH, dest_dir=BACKUP_DIR, keep=BACKUP_KEEP):
+    """Delete all but the newest keep snapshots, returns the deleted paths"""
+    snapshots = list_snapshots(source, dest_dir)
+    deleted = snapshots[:-keep] if keep > 0 else snapshots
+    for path in deleted:
+        os.remove(path)
+    prefix = _prefix(source)
+    for name in os.listdir(dest_dir) if os.path.isdir(dest_dir) else ():
+        path = os.path.join(dest_dir, name)
+        if (name.startswith(prefix) and name.endswith('.db.part')
+                and os.path.getmtime(path) < time.time() - STALE_PART_SECONDS):
+            os.remove(path)
+    return deleted
+
+
+def restore(snapshot_file, target=DB_PATH, force=False):
+    """
+    Replace target with a copy of snapshot_file; the bot must not be running
+
+    The snapshot is checked before and the copy after, and the target's
+    WAL files are removed so they are not applied to the restored database.
+    """
+    problems = integrity_check(snapshot_file)
+    if problems:
+        raise BackupError(f"{snapshot_file} failed the integrity check: {problems[:5]}")
+    if os.path.exists(target) and not force:
+        raise FileExistsError(f"{target} exists, restore with force (--force) to replace it")
+
+    os.makedirs(os.path.dirname(target) or '.', exist_ok=True)
+    part = target + '.restore'
+    if os.path.exists(part):
+        os.remove(part)
+    source = sqlite3.connect(f"file:{snapshot_file}?mode=ro", uri=True)
+    try:
+        _copy(source, part, -1, 0)
+    finally:
+        source.close()
+    problems = integrity_check(part)
+    if problems:
+        os.remove(part)
+        raise BackupError(f"Restored copy failed the integrity check: {problems[:5]}")
+    for suffix in ('-wal', '-shm'):
+        if os.path.exists(target + suffix):
+            os.remove(target + suffix)
+    os.replace(part, target)
+
+
+async def _run_scheduled(interval, keep):
+    while True:
+        now = time.time()
+        slot = now - now % interval
+        try:
+            taken = await asyncio.to_thread(snapshot, DB_PATH, snapshot_path(slot))
+            if taken:
+                logger.info(f"Backup {taken.path}: {taken.bytes / 1e6:.1f} MB in {taken.seconds:.2f}s "
+                            f"({taken.mb_per_s:.1f} MB/s, {taken.steps} steps)")
+            await asyncio.to_thread(prune, DB_PATH, BACKUP_DIR, keep)
+        except Exception as e:
+            logger.error(f"Scheduled backup failed: {e}")
+        await asyncio.sleep(max(0.0, slot + interval - time.time()))
+
+
+def start(interval=BACKUP_INTERVAL, keep=BACKUP_KEEP):
+    """Start scheduled snapshots in the running event loop, as configured"""
+    global _task
+    if interval and _task is None:
+        _task = asyncio.create_task(_run_scheduled(interval, keep))
+
+
+async def stop():
+    global _task
+    if _task is not None:
+        _task.cancel()
+        try:
+            await _task
+        except asyncio.CancelledError:
+            pass
+        _task = None
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Online backups of the bot database")
+    parser.add_argument('command', choices=('snapshot', 'list', 'verify', 'restore'))
+    parser.add_argument('snapshot', nargs='?', help="snapshot file for verify and restore")
+    parser.add_argument('--force', action='store_true', help="let restore replace an existing database")
+    args = parser.parse_args()
+
+    if args.command == 'snapshot':
+        taken = snapshot()
+        if taken is None:
+            parser.exit(1, "A snapshot with this name is already being taken\n")
+        print(f"{taken.path}: {taken.bytes:,} bytes, {taken.pages} pages in {taken.steps} steps, "
+              f"{taken.seconds:.2f}s ({taken.mb_per_s:.1f} MB/s)")
+        for path in prune():
+            print(f"Deleted {path}")
+    elif args.command == 'list':
+        for path in list_snapshots():
+            print(f"{path}  {os.path.getsize(path):,} bytes")
+    elif args.command == 'verify':
+        snapshots = list_snapshots()
+        path = args.snapshot or (snapshots[-1] if snapshots else None)
+        if path is None:
+            parser.error(f"no snapshots in {BACKUP_DIR}")
+        problems = integrity_check(path)
+        print(f"{path}: " + ("ok" if not problems else '\n'.join(problems)))
+        if problems:
+            parser.exit(1)
+    else:
+        if not args.snapshot:
+            parser.error("restore needs a snapshot file")
+        try:
+            restore(args.snapshot, force=args.force)
+        except (BackupError, FileExistsError) as e:
+            parser.exit(1, f"{e}\n")
+        print(f"Restored {DB_PATH} from {args.snapshot}")
@@ -0,0 +1,50 @@
+"""
+Batch scoring benchmark: rows per second for the vectorized and per-row paths
+
+Usage: python benchmarks/batch_scoring.py [--rows 5000000] [--chunk 100000]
+"""
+import argparse
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from depression_detector import DepressionDetector
+
+
+def rate(rows, seconds):
+    return f"{rows / seconds:>14,.0f} rows/s"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=5_000_000)
+    parser.add_argument('--chunk', type=int, default=100_000)
+    parser.add_argument('--per-row', type=int, default=200_000,
+                        help="rows scored one at a time for the baseline")
+    args = parser.parse_args()
+
+    detector = DepressionDetector()
+    answers = np.random.default_rng(0).integers(0, 4, (args.rows, 9), dtype=np.uint8)
+
+    start = time.perf_counter()
+    detector.score_batch(answers)
+    print(f"score_batch       {rate(args.rows, time.perf_counter() - start)}")
+
+    chunks = (answers[i:i + args.chunk] for i in range(0, args.rows, args.chunk))
+    start = time.perf_counter()
+    for _ in detector.score_chunks(chunks):
+        pass
+    print(f"score_chunks      {rate(args.rows, time.perf_counter() - start)}")
+
+    rows = answers[:args.per_row].tolist()
+    start = time.perf_counter()
+    for row in rows:
+        detector.classify_score(detector.calculate_phq9_score(row))
+    print(f"per-row           {rate(len(rows), time.perf_counter() - start)}")
+
+
+if __name__ == '__main__':
+    main()
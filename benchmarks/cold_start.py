@@ -0,0 +1,106 @@
+"""
+Cold-start benchmark: time from process start to the first handled update
+
+Each scenario runs in a fresh interpreter against a temporary database:
+
+  before  the old startup path, training the model before the first update
+  after   lazy startup, the model is not touched before the first update
+  model   lazy startup, then the first model prediction from the cached table
+  train   lazy startup, then the first model prediction with nothing cached
+          (fits the model and builds the table, as on a new MODEL_DIR)
+
+Each first-use time in 'model' and 'train' includes the first update.
+
+Usage: python benchmarks/cold_start.py [--runs 5]
+"""
+import time
+
+_T0 = time.perf_counter()
+
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def _fake_start_update():
+    async def reply_text(text, reply_markup=None):
+        return None
+
+    user = SimpleNamespace(id=1, username='bench', first_name='Bench', last_name='User')
+    return SimpleNamespace(
+        effective_user=user,
+        message=SimpleNamespace(reply_text=reply_text),
+        callback_query=None,
+    )
+
+
+def child(scenario):
+    """Measure one cold start in this (fresh) process and print it as JSON"""
+    sys.path.insert(0, ROOT)
+    import logging
+    logging.disable(logging.INFO)
+
+    timings = {}
+    import main
+    timings['import_ms'] = (time.perf_counter() - _T0) * 1000
+
+    main.init_database()
+    if scenario == 'before':
+        main.detector.model
+    timings['ready_ms'] = (time.perf_counter() - _T0) * 1000
+
+    asyncio.run(main.start(_fake_start_update(), None))
+    timings['first_update_ms'] = (time.perf_counter() - _T0) * 1000
+
+    if scenario in ('model', 'train'):
+        main.detector.predict_severity([0] * 9)
+        timings['first_model_use_ms'] = (time.perf_counter() - _T0) * 1000
+
+    main.close_database()
+    print(json.dumps(timings))
+
+
+def run(scenario, model_dir):
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        # The old code trained on every start, so it gets no cache
+        env['MODEL_DIR'] = '' if scenario in ('before', 'train') else model_dir
+        out = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--child', scenario],
+            env=env, check=True, capture_output=True, text=True,
+        ).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--child', choices=['before', 'after', 'model', 'train'])
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child)
+        return
+
+    with tempfile.TemporaryDirectory() as model_dir:
+        run('model', model_dir)  # warm the table cache
+
+        print(f"{'scenario':<10}{'metric':<22}{'median ms':>12}{'min ms':>10}")
+        for scenario in ('before', 'after', 'model', 'train'):
+            results = [run(scenario, model_dir) for _ in range(args.runs)]
+            for metric in results[0]:
+                values = [r[metric] for r in results]
+                print(f"{scenario:<10}{metric:<22}{statistics.median(values):>12.1f}{min(values):>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+Conversation search benchmark: FTS5 index against a LIKE scan
+
+Writes --rows conversation logs (through the normal insert path, so they
+are indexed as they are saved) to a temporary database, then times a
+first page of results for a few keywords with search.search and with
+LIKE '%keyword%' over user_message and bot_response.
+
+Usage: python benchmarks/conversation_search.py [--rows 200000]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+WORDS = ("tired sleep work family friends exam stress lonely happy sad anxious calm "
+         "doctor therapy music walk weekend headache appetite focus school job money").split()
+
+# Rare, common (ranking every match costs the most), a phrase, and none at
+# all (LIKE stops early only when it finds enough rows)
+KEYWORDS = ('insomnia', 'stress', 'panic attack', 'nightmare')
+
+
+def _like(conn, keyword, limit):
+    pattern = f'%{keyword}%'
+    return conn.execute('''
+        SELECT conversation_id FROM conversations
+        WHERE user_message LIKE ? OR bot_response LIKE ?
+        LIMIT ?
+    ''', (pattern, pattern, limit)).fetchall()
+
+
+def timed_ms(fn, *args):
+    start = time.perf_counter()
+    result = fn(*args)
+    return (time.perf_counter() - start) * 1000, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--rows', type=int, default=200_000)
+    parser.add_argument('--limit', type=int, default=20)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        sys.path.insert(0, ROOT)
+        import database
+        import search
+
+        database.init_database(backfill=False)
+        rng = random.Random(0)
+        records = []
+        for i in range(args.rows):
+            words = rng.choices(WORDS, k=12)
+            if i % 5000 == 0:
+                words.append('insomnia')
+            if i % 700 == 0:
+                words[3:3] = ['panic', 'attack']
+            records.append(('conversation', (i % 10000, ' '.join(words), "Thanks for sharing that.")))
+
+        start = time.perf_counter()
+        for i in range(0, len(records), database.WRITE_BATCH_SIZE):
+            database.submit_write(database._write_batch, records[i:i + database.WRITE_BATCH_SIZE])
+        database.submit_write(lambda conn: None).result()
+        elapsed = time.perf_counter() - start
+        print(f"indexed writes     {args.rows:,} rows in {elapsed:.2f}s ({args.rows / elapsed:,.0f}/s)")
+
+        print(f"{'keyword':<16}{'fts ms':>10}{'like ms':>10}{'hits':>7}")
+        for keyword in KEYWORDS:
+            fts_ms, hits = timed_ms(database.search_conversations, search.keywords_query(keyword), args.limit)
+            like_ms, _ = timed_ms(lambda: database.submit_read(_like, keyword, args.limit).result())
+            print(f"{keyword:<16}{fts_ms:>10.2f}{like_ms:>10.2f}{len(hits):>7}")
+        database.close_database()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,123 @@
+"""
+Local stand-in for the Telegram Bot API, for offline load tests
+
+Implements the methods the bot uses (getMe, getUpdates, sendMessage,
+editMessageText, answerCallbackQuery, plus the webhook housekeeping calls).
+Tests push updates with push_update() and read what the bot sent to a chat
+from outbox(chat_id).  Point the bot at it with base_url=api.base_url.
+"""
+import asyncio
+import itertools
+import json
+import os
+import sys
+import time
+from collections import Counter, defaultdict
+from urllib.parse import parse_qs
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from http_server import HTTPServer
+
+BOT_USER = {'id': 1000000, 'is_bot': True, 'first_name': 'MindCare', 'username': 'mindcare_test_bot'}
+
+
+class FakeBotAPI(HTTPServer):
+
+    content_type = 'application/json'
+
+    def __init__(self, host='127.0.0.1', port=0):
+        super().__init__(host, port)
+        self.calls = Counter()
+        self._updates = []
+        self._update_ids = itertools.count(1)
+        self._new_updates = asyncio.Condition()
+        self._message_ids = defaultdict(lambda: itertools.count(1))
+        self._outboxes = defaultdict(asyncio.Queue)
+
+    @property
+    def base_url(self):
+        return f"http://{self.host}:{self.port}/bot"
+
+    # ---- test side ----
+
+    async def push_update(self, update):
+        """Queue an update for getUpdates, assigning its update_id"""
+        update = dict(update, update_id=next(self._update_ids))
+        async with self._new_updates:
+            self._updates.append(update)
+            self._new_updates.notify_all()
+        return update
+
+    def outbox(self, chat_id):
+        """Queue of (method, message dict, monotonic time) the bot sent to chat_id"""
+        return self._outboxes[chat_id]
+
+    # ---- bot side ----
+
+    async def handle_request(self, method, target, headers, body):
+        path = target.split('?', 1)[0]
+        api_method = path.rsplit('/', 1)[-1]
+        self.calls[api_method] += 1
+        params = self._parse_params(headers, body or b'')
+
+        handler = getattr(self, f"api_{api_method}", None)
+        result = await handler(params) if handler else True
+        return 200, json.dumps({'ok': True, 'result': result})
+
+    def _parse_params(self, headers, body):
+        content_type = headers.get('content-type', '')
+        if content_type.startswith('application/json'):
+            return json.loads(body) if body else {}
+        # python-telegram-bot sends form fields, nested objects as JSON strings
+        params = {}
+        for key, values in parse_qs(body.decode(), keep_blank_values=True).items():
+            value = values[0]
+            if value[:1] in ('{', '['):
+                value = json.loads(value)
+            params[key] = value
+        return params
+
+    async def api_getMe(self, params):
+        return BOT_USER
+
+    async def api_getUpdates(self, params):
+        offset = int(params.get('offset', 0) or 0)
+        limit = int(params.get('limit', 100) or 100)
+        timeout = float(params.get('timeout', 0) or 0)
+
+        async with self._new_updates:
+            # Updates below the offset have been confirmed by the bot
+            self._updates = [u for u in self._updates if u['update_id'] >= offset]
+            if not self._updates and timeout:
+                try:
+                    await asyncio.wait_for(self._new_updates.wait(), timeout)
+                except asyncio.TimeoutError:
+                    pass
+            return self._updates[:limit]
+
+    def _message(self, chat_id, message_id, params):
+        message = {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': BOT_USER,
+            'text': params.get('text', ''),
+        }
+        if params.get('reply_markup'):
+            message['reply_markup'] = params['reply_markup']
+        return message
+
+    async def api_sendMessage(self, params):
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, next(self._message_ids[chat_id]), params)
+        self._outboxes[chat_id].put_nowait(('sendMessage', message, time.monotonic()))
+        return message
+
+    async def api_editMessageText(self, params):
+        chat_id = int(params['chat_id'])
+        message = self._message(chat_id, int(params['message_id']), params)
+        self._outboxes[chat_id].put_nowait(('editMessageText', message, time.monotonic()))
+        return message
+
+    async def api_answerCallbackQuery(self, params):
+        return True
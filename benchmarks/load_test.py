@@ -0,0 +1,361 @@
+"""
+Load test: N simulated users against the real handlers and a fake Bot API
+
+Each user sends /start, takes the assessment (ASSESSMENT_FLOW, or --flow),
+then opens View Previous Results and Resources, waiting for the bot's reply
+before every tap.  The
+bot runs in this process with long polling against benchmarks/fake_bot_api.py,
+so no network access is needed.
+
+Reports per-handler p50/p95/p99 latency (update pushed -> reply received),
+updates per second, database write rate, answers per assessment and peak RSS.
+
+Usage: python benchmarks/load_test.py [--users 50] [--concurrency N] [--rate-limit]
+                                     [--flow adaptive] [--answer-weights 6,2,1,1]
+                                     [--reply-timeout S] [--json results.json]
+       python benchmarks/load_test.py --compare 1,32 [--users 50]
+       python benchmarks/load_test.py --compare-flows phq9,adaptive [--answer-weights 6,2,1,1]
+
+--compare runs the test once per update concurrency (1 is the sequential
+default of python-telegram-bot) in fresh processes and prints them side by side;
+a level that fails or times out is reported as such.  Replies time out after
+30 s plus 0.5 s (start_assessment's pause) per user queued ahead, users /
+concurrency, unless --reply-timeout is given.
+--compare-flows does the same per assessment flow.  --answer-weights sets
+how often simulated users pick each answer value 0-3 (uniform by default).
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI
+
+TOKEN = '123456:LOADTEST'
+REPLY_TIMEOUT = 30
+# start_assessment's pause before the first question
+SLOWEST_HANDLER_S = 0.5
+
+
+def reply_timeout(users, concurrency):
+    """REPLY_TIMEOUT plus the slowest handler for every user queued ahead at this concurrency"""
+    return REPLY_TIMEOUT + SLOWEST_HANDLER_S * users / max(concurrency, 1)
+
+
+def percentile(sorted_values, q):
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, int(round(q / 100 * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def _user(user_id):
+    return {'id': user_id, 'is_bot': False, 'first_name': f"User{user_id}"}
+
+
+def command_update(user_id, text):
+    return {'message': {
+        'message_id': 1,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': _user(user_id),
+        'text': text,
+        'entities': [{'type': 'bot_command', 'offset': 0, 'length': len(text)}],
+    }}
+
+
+def callback_update(user_id, message, data):
+    return {'callback_query': {
+        'id': f"{user_id}-{time.monotonic_ns()}",
+        'chat_instance': str(user_id),
+        'from': _user(user_id),
+        'message': message,
+        'data': data,
+    }}
+
+
+def keyboard_data(message):
+    markup = message.get('reply_markup') or {}
+    return [button.get('callback_data')
+            for row in markup.get('inline_keyboard', []) for button in row]
+
+
+def is_answer(data):
+    # answer_<value>, or a signed session (session_store.CallbackSessions.PREFIX,
+    # not imported here: the bot's settings are read when it is imported)
+    return data.startswith(('answer_', 's:'))
+
+
+class SimulatedUser:
+    """Walks one user through the bot, recording how long each reply takes"""
+
+    def __init__(self, api, user_id, stats, rng, answer_weights=None, timeout=REPLY_TIMEOUT):
+        self.api = api
+        self.user_id = user_id
+        self.stats = stats
+        self.rng = rng
+        self.answer_weights = answer_weights
+        self.timeout = timeout
+        self.outbox = api.outbox(user_id)
+        self.message = None
+
+    async def _send(self, handler, update):
+        pushed = time.monotonic()
+        await self.api.push_update(update)
+        # A handler is done once it shows a message with a keyboard
+        while True:
+            method, message, received = await asyncio.wait_for(self.outbox.get(), self.timeout)
+            if message.get('reply_markup'):
+                break
+        self.stats['latency'][handler].append((received - pushed) * 1000)
+        self.stats['updates'] += 1
+        self.message = message
+
+    async def tap(self, handler, data):
+        if data not in keyboard_data(self.message):
+            raise RuntimeError(f"user {self.user_id}: no {data!r} button in {keyboard_data(self.message)}")
+        await self._send(handler, callback_update(self.user_id, self.message, data))
+
+    async def run(self):
+        try:
+            await self._send('start', command_update(self.user_id, '/start'))
+            await self.tap('start_assessment', 'start_assessment')
+            answers = [d for d in keyboard_data(self.message) if is_answer(d)]
+            while answers:
+                # Buttons are in answer value order, 0-3
+                data = self.rng.choices(answers, self.answer_weights)[0]
+                await self.tap('handle_answer', data)
+                self.stats['answers'] += 1
+                answers = [d for d in keyboard_data(self.message) if is_answer(d)]
+                if not answers:
+                    # The last answer's reply is the result screen
+                    latency = self.stats['latency']
+                    latency['show_assessment_result'].append(latency['handle_answer'].pop())
+            self.stats['assessments'] += 1
+            await self.tap('menu', 'menu')
+            await self.tap('view_results', 'view_results')
+            await self.tap('menu', 'menu')
+            await self.tap('resources', 'resources')
+            self.stats['completed'] += 1
+        except (RuntimeError, asyncio.TimeoutError) as e:
+            self.stats['errors'].append(f"user {self.user_id}: {e!r}")
+
+
+def count_rows(db_path):
+    conn = sqlite3.connect(db_path)
+    try:
+        return sum(conn.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+                   for table in ('users', 'assessments', 'conversations'))
+    finally:
+        conn.close()
+
+
+async def run_load(users, seed=0, build_kwargs=None, answer_weights=None, timeout=None):
+    """Run the load test in this process, returns the results dict"""
+    import main
+    if timeout is None:
+        timeout = reply_timeout(users, (build_kwargs or {}).get('concurrency', main.UPDATE_CONCURRENCY))
+
+    api = FakeBotAPI()
+    await api.start()
+    app = main.build_application(token=TOKEN, base_url=api.base_url, **(build_kwargs or {}))
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    stats = {'latency': defaultdict(list), 'updates': 0, 'completed': 0, 'errors': [],
+             'answers': 0, 'assessments': 0}
+    rng = random.Random(seed)
+    simulated = [SimulatedUser(api, 100000 + i, stats, random.Random(rng.random()), answer_weights, timeout)
+                 for i in range(users)]
+
+    started = time.monotonic()
+    await asyncio.gather(*(user.run() for user in simulated))
+    elapsed = time.monotonic() - started
+
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    await api.stop()
+
+    import database
+    rows_written = count_rows(database.DB_PATH)
+    latencies = {}
+    overall = sorted(v for values in stats['latency'].values() for v in values)
+    for handler, values in stats['latency'].items():
+        values.sort()
+        latencies[handler] = {
+            'count': len(values),
+            'p50_ms': percentile(values, 50),
+            'p95_ms': percentile(values, 95),
+            'p99_ms': percentile(values, 99),
+        }
+    return {
+        'users': users,
+        'completed': stats['completed'],
+        'errors': stats['errors'],
+        'elapsed_s': elapsed,
+        'updates': stats['updates'],
+        'updates_per_s': stats['updates'] / elapsed,
+        'rows_written': rows_written,
+        'answers_per_assessment': stats['answers'] / max(stats['assessments'], 1),
+        # Each user takes one assessment, plus a few menu screens around it
+        'edits_per_user': api.calls.get('editMessageText', 0) / users,
+        'db_writes_per_s': rows_written / elapsed,
+        'api_calls': dict(api.calls),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'latency': latencies,
+        'overall': {
+            'p50_ms': percentile(overall, 50),
+            'p95_ms': percentile(overall, 95),
+            'p99_ms': percentile(overall, 99),
+        },
+    }
+
+
+def print_report(results):
+    print(f"{'handler':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}")
+    for handler, row in sorted(results['latency'].items()):
+        print(f"{handler:<24}{row['count']:>7}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}")
+    print()
+    print(f"users completed   {results['completed']}/{results['users']}")
+    print(f"updates           {results['updates']} in {results['elapsed_s']:.2f}s "
+          f"({results['updates_per_s']:.1f}/s)")
+    print(f"db rows written   {results['rows_written']} ({results['db_writes_per_s']:.1f}/s)")
+    print(f"answers           {results['answers_per_assessment']:.2f} per assessment, "
+          f"{results['edits_per_user']:.2f} message edits per user")
+    print(f"peak RSS          {results['peak_rss_mb']:.1f} MB")
+    for error in results['errors'][:10]:
+        print(f"error: {error}")
+
+
+def _run_child(args, out):
+    """Run the load test in a fresh process, returns (results or None, problem or None)"""
+    process = subprocess.run([sys.executable, os.path.abspath(__file__), *args, '--json', out],
+                             stdout=subprocess.DEVNULL)
+    if not os.path.exists(out):
+        return None, f"failed (exit {process.returncode})"
+    with open(out) as f:
+        results = json.load(f)
+    if any('TimeoutError' in error for error in results['errors']):
+        return results, f"timed out ({len(results['errors'])} users)"
+    if results['errors']:
+        return results, f"{len(results['errors'])} users failed"
+    return results, None
+
+
+def compare(levels, users, seed, rate_limit=False, timeout=None):
+    """Run the load test in a fresh process per concurrency level"""
+    rows = []
+    extra = (['--rate-limit'] if rate_limit else []) + (['--reply-timeout', str(timeout)] if timeout else [])
+    with tempfile.TemporaryDirectory() as tmp:
+        for level in levels:
+            results, problem = _run_child(['--users', str(users), '--seed', str(seed),
+                                           '--concurrency', str(level)] + extra,
+                                          os.path.join(tmp, f"{level}.json"))
+            rows.append((level, results, problem))
+
+    print(f"{'concurrency':<13}{'updates/s':>11}{'p50 ms':>10}{'p99 ms':>10}{'elapsed s':>11}")
+    for level, results, problem in rows:
+        if results is None:
+            print(f"{level:<13}{problem:>11}")
+            continue
+        overall = results['overall']
+        print(f"{level:<13}{results['updates_per_s']:>11.1f}{overall['p50_ms']:>10.1f}"
+              f"{overall['p99_ms']:>10.1f}{results['elapsed_s']:>11.2f}" + (f"  {problem}" if problem else ''))
+    complete = [(level, results) for level, results, problem in rows if problem is None]
+    for level, results in complete[1:]:
+        print(f"concurrency {level}: {results['updates_per_s'] / complete[0][1]['updates_per_s']:.1f}x "
+              f"the updates/s of {complete[0][0]}")
+
+
+def compare_flows(flows, users, seed, answer_weights=None):
+    """Run the load test in a fresh process per assessment flow"""
+    rows = []
+    weights = ['--answer-weights', ','.join(map(str, answer_weights))] if answer_weights else []
+    with tempfile.TemporaryDirectory() as tmp:
+        for flow in flows:
+            results, problem = _run_child(['--users', str(users), '--seed', str(seed), '--flow', flow] + weights,
+                                          os.path.join(tmp, f"{flow}.json"))
+            rows.append((flow, results, problem))
+
+    print(f"{'flow':<13}{'answers':>9}{'edits':>8}{'updates':>9}{'p50 ms':>10}{'elapsed s':>11}")
+    for flow, results, problem in rows:
+        if results is None:
+            print(f"{flow:<13}{problem:>9}")
+            continue
+        print(f"{flow:<13}{results['answers_per_assessment']:>9.2f}{results['edits_per_user']:>8.2f}"
+              f"{results['updates']:>9}{results['overall']['p50_ms']:>10.1f}{results['elapsed_s']:>11.2f}"
+              + (f"  {problem}" if problem else ''))
+    complete = [(flow, results) for flow, results, problem in rows if problem is None]
+    for flow, results in complete[1:]:
+        print(f"{flow}: {1 - results['answers_per_assessment'] / complete[0][1]['answers_per_assessment']:.0%} "
+              f"fewer answer round trips per assessment than {complete[0][0]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--concurrency', type=int,
+                        help="updates handled at once (default: UPDATE_CONCURRENCY)")
+    parser.add_argument('--compare', help="comma separated concurrency levels to compare")
+    parser.add_argument('--rate-limit', action='store_true',
+                        help="keep Telegram's flood limits (outbound.py) against the fake API")
+    parser.add_argument('--flow', help="assessment flow (default: ASSESSMENT_FLOW)")
+    parser.add_argument('--compare-flows', help="comma separated assessment flows to compare")
+    parser.add_argument('--answer-weights', help="relative weights of answers 0-3, e.g. 6,2,1,1")
+    parser.add_argument('--reply-timeout', type=float,
+                        help=f"seconds to wait for each reply (default: {REPLY_TIMEOUT}, plus "
+                             f"{SLOWEST_HANDLER_S} per user queued ahead: users / concurrency)")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+    answer_weights = [float(w) for w in args.answer_weights.split(',')] if args.answer_weights else None
+    if args.flow:
+        os.environ['ASSESSMENT_FLOW'] = args.flow
+    if args.compare_flows:
+        compare_flows(args.compare_flows.split(','), args.users, args.seed, answer_weights)
+        return
+
+    # The fake API has no flood limits, so by default measure the bot alone
+    os.environ['OUTBOUND_RATE_LIMIT'] = '1' if args.rate_limit else '0'
+    if args.compare:
+        compare([int(level) for level in args.compare.split(',')], args.users, args.seed, args.rate_limit,
+                args.reply_timeout)
+        return
+    build_kwargs = {} if args.concurrency is None else {'concurrency': args.concurrency}
+
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Settings are read at import time, so set them before importing the bot
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        os.environ.setdefault('MODEL_DIR', os.path.join(tmp, 'models'))
+        results = asyncio.run(run_load(args.users, args.seed, build_kwargs, answer_weights, args.reply_timeout))
+
+    print_report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if results['errors']:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
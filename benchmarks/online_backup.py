@@ -0,0 +1,99 @@
+"""
+Online backup benchmark: copy throughput and writer stalls
+
+Fills a temporary database to about --mb megabytes through the normal write
+path, then keeps a writer saving durable conversation logs (each one waits
+for its commit) while backup.snapshot copies the database with different
+page step sizes.  Reports MB/s (including the integrity check of the
+copy), steps and the writer's slowest and p99
+commit latency during each copy against a quiet baseline, then restores
+the last snapshot and checks it.
+
+Usage: python benchmarks/online_backup.py [--mb 200] [--pages 64,256,-1]
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Writer(threading.Thread):
+    """Saves one durable conversation log after another, timing each"""
+
+    def __init__(self, database):
+        super().__init__(daemon=True)
+        self.database = database
+        self.latencies = []
+        self.running = True
+
+    def run(self):
+        while self.running:
+            start = time.perf_counter()
+            self.database.save_conversation(1, "backup benchmark", "still writing")
+            self.latencies.append(time.perf_counter() - start)
+            time.sleep(0.002)
+
+    def take(self):
+        latencies, self.latencies = sorted(self.latencies), []
+        if not latencies:
+            return 0, 0.0, 0.0
+        return len(latencies), latencies[int(len(latencies) * 0.99)] * 1000, latencies[-1] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--mb', type=int, default=200)
+    parser.add_argument('--pages', default='64,256,-1', help="comma separated pages per step, -1 for one step")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        os.environ['BACKUP_DIR'] = os.path.join(tmp, 'backups')
+        sys.path.insert(0, ROOT)
+        import logging
+        logging.disable(logging.INFO)
+        import backup
+        import database
+
+        database.init_database(backfill=False)
+        text = "how have you been feeling lately " * 30
+        rows = args.mb * 1_000_000 // (2 * len(text))
+        for i in range(0, rows, 10_000):
+            database.submit_write(database._write_batch, [
+                ('conversation', (user_id, text, text)) for user_id in range(i, min(i + 10_000, rows))
+            ])
+        database.submit_write(lambda conn: conn.execute('PRAGMA wal_checkpoint(TRUNCATE)')).result()
+        print(f"database           {os.path.getsize(database.DB_PATH) / 1e6:.0f} MB, {rows:,} conversations")
+
+        writer = Writer(database)
+        writer.start()
+        time.sleep(2)
+        commits, p99, worst = writer.take()
+        print(f"{'':<16}{'MB/s':>8}{'steps':>8}{'seconds':>9}{'commits':>9}{'p99 ms':>9}{'max ms':>9}")
+        print(f"{'no backup (2s)':<16}{'':>8}{'':>8}{'':>9}{commits:>9}{p99:>9.1f}{worst:>9.1f}")
+
+        taken = None
+        for pages in (int(p) for p in args.pages.split(',')):
+            dest = os.path.join(tmp, 'backups', f'users-pages{pages}.db')
+            taken = backup.snapshot(dest=dest, pages=pages)
+            commits, p99, worst = writer.take()
+            print(f"{f'pages={pages}':<16}{taken.mb_per_s:>8.0f}{taken.steps:>8}{taken.seconds:>9.2f}"
+                  f"{commits:>9}{p99:>9.1f}{worst:>9.1f}")
+        writer.running = False
+        writer.join()
+        database.close_database()
+
+        restored = os.path.join(tmp, 'restored.db')
+        backup.restore(taken.path, restored)
+        count = sqlite3.connect(restored).execute('SELECT COUNT(*) FROM conversations').fetchone()[0]
+        print(f"restored           {count:,} conversations, integrity "
+              f"{'ok' if not backup.integrity_check(restored) else 'FAILED'}")
+
+
+if __name__ == '__main__':
+    main()
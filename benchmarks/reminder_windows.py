@@ -0,0 +1,108 @@
+"""
+Reminder scheduler benchmark: window reads and draining a backlog
+
+Fills a temporary database with --pending reminders spread over the next
+--days days plus --overdue that came due while the bot was down, then
+shows the query plan and time of one window read and drains the overdue
+ones through ReminderScheduler with a stand-in bot, reporting send rate,
+windows and the peak memory allocated while draining.  Run it with two
+--overdue sizes to see the peak stay flat.
+
+Usage: python benchmarks/reminder_windows.py [--pending 100000] [--overdue 20000] [--days 14]
+"""
+import argparse
+import asyncio
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class CountingBot:
+    """Accepts send_message calls without any network"""
+
+    def __init__(self):
+        self.messages = 0
+
+    async def send_message(self, chat_id, text, reply_markup=None):
+        self.messages += 1
+
+
+def _fill(conn, rows):
+    conn.executemany('''
+        INSERT OR REPLACE INTO reminders (user_id, action, chat_id, due_at, attempts)
+        VALUES (?, ?, ?, ?, 0)
+    ''', rows)
+    conn.commit()
+
+
+def _plan(conn, sql, args):
+    return ' / '.join(row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, args))
+
+
+async def drain(database, reminders, args):
+    bot = CountingBot()
+    # No pacing here: measure the scheduler and the database, not the rate limit
+    scheduler = reminders.ReminderScheduler(bot, database.submit_read, database.submit_write,
+                                            batch_size=args.batch, rate=float('inf'))
+    tracemalloc.start()
+    start = time.perf_counter()
+    now = time.time()
+    # A full window is followed by the next one straight away
+    while (await scheduler.run_window(now)) <= now:
+        pass
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return bot.messages, scheduler.windows, elapsed, peak
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--pending', type=int, default=100_000)
+    parser.add_argument('--overdue', type=int, default=20_000)
+    parser.add_argument('--days', type=float, default=14)
+    parser.add_argument('--batch', type=int, default=50)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        sys.path.insert(0, ROOT)
+        import logging
+        logging.disable(logging.INFO)
+        import database
+        import reminders
+
+        database.init_database(backfill=False)
+        rng = random.Random(0)
+        now = time.time()
+        # Future ones start after the first window so draining never waits for them
+        rows = [(user_id, 'start_assessment', user_id, now + rng.uniform(3600, args.days * 86400))
+                for user_id in range(args.pending)]
+        rows += [(args.pending + i, 'start_assessment', args.pending + i, now - rng.uniform(0, 86400))
+                 for i in range(args.overdue)]
+        database.submit_write(_fill, rows).result()
+        del rows
+
+        sql = 'SELECT due_at, user_id, action, chat_id, attempts FROM reminders WHERE due_at <= ? ORDER BY due_at LIMIT ?'
+        print(f"window query plan  {database.submit_read(_plan, sql, (now, 1000)).result()}")
+        start = time.perf_counter()
+        window = database.submit_read(reminders.load_due, now + reminders.REMINDER_WINDOW,
+                                      reminders.REMINDER_WINDOW_MAX).result()
+        print(f"window read        {len(window)} rows in {(time.perf_counter() - start) * 1000:.2f} ms "
+              f"of {args.pending + args.overdue:,} pending")
+
+        sent, windows, elapsed, peak = asyncio.run(drain(database, reminders, args))
+        left = database.submit_read(reminders.count_pending).result()
+        print(f"overdue drained    {sent:,} in {elapsed:.2f}s ({sent / elapsed:,.0f}/s), "
+              f"{windows} windows, {left:,} still pending")
+        print(f"peak allocated     {peak / 1024:,.0f} KiB while draining")
+        database.close_database()
+
+
+if __name__ == '__main__':
+    main()
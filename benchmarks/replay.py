@@ -0,0 +1,199 @@
+"""
+Replay recorded traffic against the real handlers and a fake Bot API
+
+Feeds an update log recorded with UPDATE_LOG (see update_log.py) to the
+bot in this process, in recorded order, through long polling against
+benchmarks/fake_bot_api.py and a fresh temporary database, so two versions
+of the bot can be compared on identical traffic, abandoned assessments,
+double taps and all.
+
+--speed 0 (the default) pushes updates as fast as the bot takes them;
+--speed 1 keeps the recorded gaps between updates, 2 halves them.
+Latency runs from an update being pushed to the end of its handling (a
+handler in a later group than the bot's own), per handler.
+
+Usage: python benchmarks/replay.py updates.log.gz [--speed 0] [--limit N]
+                                   [--json results.json] [--baseline old.json]
+
+--baseline prints the change against results another version saved with
+--json from the same log.
+"""
+import argparse
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from collections import defaultdict
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fake_bot_api import FakeBotAPI
+from load_test import REPLY_TIMEOUT, TOKEN, percentile
+from update_log import read_log
+
+
+def handler_name(main, update):
+    """Name of the bot handler an update is routed to"""
+    if update.callback_query is None:
+        text = update.message.text if update.message else None
+        return 'start' if text and text.startswith('/start') else 'unhandled'
+    route = main.CALLBACKS.get(update.callback_query.data)
+    if route is None and main.sessions.stateless and update.callback_query.data.startswith(main.sessions.PREFIX):
+        route = (main.handle_answer, None)
+    return route[0].__name__ if route else 'unhandled'
+
+
+def _summary(values):
+    values.sort()
+    return {
+        'count': len(values),
+        'p50_ms': percentile(values, 50),
+        'p95_ms': percentile(values, 95),
+        'p99_ms': percentile(values, 99),
+    }
+
+
+async def replay(entries, speed=0.0):
+    """Replay (timestamp, update dict) pairs in this process, returns the results dict"""
+    import main
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    api = FakeBotAPI()
+    await api.start()
+    app = main.build_application(token=TOKEN, base_url=api.base_url)
+
+    pushed = {}
+    latency = defaultdict(list)
+    users = set()
+    state = {'pushed': 0, 'finished': 0, 'all_pushed': False}
+    idle = asyncio.Event()
+
+    async def finished(update, context):
+        started = pushed.pop(update.update_id, None)
+        if started is None:
+            return
+        latency[handler_name(main, update)].append((time.monotonic() - started) * 1000)
+        state['finished'] += 1
+        if state['all_pushed'] and state['finished'] == state['pushed']:
+            idle.set()
+
+    # After the bot's own handlers (group 0) are done with the update
+    app.add_handler(TypeHandler(Update, finished), group=1)
+    await app.initialize()
+    if app.post_init:
+        await app.post_init(app)
+    await app.updater.start_polling(poll_interval=0, timeout=10)
+    await app.start()
+
+    started = time.monotonic()
+    first = None
+    for timestamp, update in entries:
+        if speed:
+            first = timestamp if first is None else first
+            delay = started + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        sender = (update.get('callback_query') or update.get('message') or {}).get('from') or {}
+        users.add(sender.get('id'))
+        now = time.monotonic()
+        update = await api.push_update(update)
+        pushed[update['update_id']] = now
+        state['pushed'] += 1
+    state['all_pushed'] = True
+    if state['finished'] < state['pushed']:
+        try:
+            await asyncio.wait_for(idle.wait(), REPLY_TIMEOUT)
+        except asyncio.TimeoutError:
+            pass
+    elapsed = time.monotonic() - started
+
+    await app.updater.stop()
+    await app.stop()
+    await app.shutdown()
+    if app.post_shutdown:
+        await app.post_shutdown(app)
+    await api.stop()
+
+    overall = [v for values in latency.values() for v in values]
+    return {
+        'updates': state['pushed'],
+        'unfinished': state['pushed'] - state['finished'],
+        'users': len(users),
+        'speed': speed,
+        'elapsed_s': elapsed,
+        'updates_per_s': state['finished'] / elapsed,
+        'api_calls': dict(api.calls),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        'latency': {handler: _summary(values) for handler, values in latency.items()},
+        'overall': _summary(overall),
+    }
+
+
+def print_report(results, baseline=None):
+    def change(new, old):
+        return f"{(new - old) / old:>+8.0%}" if old else f"{'':>8}"
+
+    header = f"{'handler':<24}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+    print(header + (f"{'p50':>8}{'p99':>8}" if baseline else ''))
+    rows = sorted(results['latency'].items()) + [('(all)', results['overall'])]
+    for handler, row in rows:
+        line = f"{handler:<24}{row['count']:>7}{row['p50_ms']:>10.1f}{row['p95_ms']:>10.1f}{row['p99_ms']:>10.1f}"
+        if baseline:
+            old = baseline['overall'] if handler == '(all)' else baseline['latency'].get(handler)
+            if old:
+                line += change(row['p50_ms'], old['p50_ms']) + change(row['p99_ms'], old['p99_ms'])
+        print(line)
+    print()
+    print(f"updates           {results['updates']} from {results['users']} users in "
+          f"{results['elapsed_s']:.2f}s ({results['updates_per_s']:.1f}/s)"
+          + (f", {change(results['updates_per_s'], baseline['updates_per_s']).strip()} vs baseline"
+             if baseline else ''))
+    if results['unfinished']:
+        print(f"unfinished        {results['unfinished']} updates not handled within {REPLY_TIMEOUT}s")
+    print(f"Bot API calls     " + ', '.join(f"{name} {count}" for name, count in sorted(results['api_calls'].items())))
+    print(f"peak RSS          {results['peak_rss_mb']:.1f} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('log', help="update log recorded with UPDATE_LOG")
+    parser.add_argument('--speed', type=float, default=0.0,
+                        help="0: as fast as possible, 1: recorded timing, 2: twice as fast, ...")
+    parser.add_argument('--limit', type=int, help="replay only the first N updates")
+    parser.add_argument('--json', help="also write the results to this file")
+    parser.add_argument('--baseline', help="results of another version (--json) to compare with")
+    args = parser.parse_args()
+
+    entries = list(read_log(args.log))[:args.limit]
+    if not entries:
+        sys.exit(f"{args.log} holds no updates")
+
+    # The fake API has no flood limits, and a replay must not record itself
+    os.environ['OUTBOUND_RATE_LIMIT'] = '0'
+    os.environ['UPDATE_LOG'] = ''
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Settings are read at import time, so set them before importing the bot
+        os.environ['DATABASE_PATH'] = os.path.join(tmp, 'users.db')
+        os.environ.setdefault('MODEL_DIR', os.path.join(tmp, 'models'))
+        results = asyncio.run(replay(entries, args.speed))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print_report(results, baseline)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+"""
+Screen registry benchmark: CPU per update spent building replies and routing
+
+  rebuild   the old path: if/elif routing on callback_data, then building the
+            message and InlineKeyboardMarkup tree for the screen
+  registry  CALLBACKS dict lookup and the prebuilt screen from screens.py
+  handler   main.button_callback end to end for the same updates, with a
+            stub query that discards the reply
+
+Usage: python benchmarks/screen_registry.py [--updates 200000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import screens
+from questionnaires import FLOWS, PHQ9_ITEMS
+
+FLOW = FLOWS['phq9']
+
+# Callback data of a typical session: menu, nine answers, a few info screens
+UPDATES = ['menu'] + [f'answer_{i % 4}' for i in range(9)] + ['self_care', 'resources', 'menu', 'exit']
+
+
+def rebuild(data, question):
+    if data == 'menu':
+        return screens.Screen(screens.MENU_TEXT, screens.build_menu_keyboard())
+    elif data == 'resources':
+        return screens.Screen(screens.RESOURCES_TEXT, screens.build_back_keyboard())
+    elif data == 'self_care':
+        return screens.Screen(screens.SELF_CARE_TEXT, screens.build_back_keyboard())
+    elif data.startswith('answer_'):
+        return screens.build_question(FLOW, question + 1, PHQ9_ITEMS[question])
+    elif data == 'exit':
+        return screens.Screen(screens.EXIT_TEXT)
+
+
+STATIC = {'menu': screens.MENU, 'resources': screens.RESOURCES,
+          'self_care': screens.SELF_CARE, 'exit': screens.EXIT}
+
+
+def registry(callbacks, data, question):
+    callbacks[data]
+    return STATIC.get(data) or screens.QUESTIONS['phq9', question + 1, PHQ9_ITEMS[question]]
+
+
+def cpu_per_update(fn, count):
+    start = time.process_time()
+    for i in range(count):
+        fn(UPDATES[i % len(UPDATES)], i % 9)
+    return (time.process_time() - start) / count * 1e6
+
+
+async def _run_handlers(main, count):
+    async def discard(*args, **kwargs):
+        pass
+
+    updates = []
+    for data in UPDATES:
+        if data.startswith('answer_'):
+            continue  # needs a session and sends through the scheduler
+        query = SimpleNamespace(data=data, answer=discard, edit_message_text=discard)
+        updates.append(SimpleNamespace(callback_query=query, effective_user=SimpleNamespace(id=1)))
+    start = time.process_time()
+    for i in range(count):
+        await main.button_callback(updates[i % len(updates)], None)
+    return (time.process_time() - start) / count * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--updates', type=int, default=200_000)
+    args = parser.parse_args()
+
+    import logging
+    import main as bot
+    logging.disable(logging.INFO)
+
+    before = cpu_per_update(rebuild, args.updates)
+    after = cpu_per_update(lambda data, question: registry(bot.CALLBACKS, data, question), args.updates)
+    print(f"rebuild   {before:8.2f} µs CPU/update")
+    print(f"registry  {after:8.2f} µs CPU/update  ({before / after:.0f}x less)")
+    handler = asyncio.run(_run_handlers(bot, args.updates // 10))
+    print(f"handler   {handler:8.2f} µs CPU/update (static screens, end to end)")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,130 +1,449 @@
 import sqlite3
 import os
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from analytics import update_rollups
+from depression_detector import pack_answers
+from history_cache import HistoryCache
+from metrics import DB_SECONDS, gauge, timed
+from migrations import BACKFILLS, decode_answers, migrate, run_backfill_chunk
+from reminders import schedule_reminder
+from responses import Response, encode_params, store_template
+from search import index_conversation, register_functions, search
+from trends import get_trend, update_trend
+from write_behind import WriteBehindQueue
 
 # Database path
 DB_PATH = os.getenv('DATABASE_PATH', './data/users.db')
 
-def init_database():
-    """Initialize SQLite database with required tables"""
-    
-    # Create data folder if doesn't exist
-    os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
-    
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Table 1: Users table
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            user_id INTEGER PRIMARY KEY,
-            username TEXT,
-            first_name TEXT,
-            last_name TEXT,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            last_interaction TIMESTAMP
+# Number of long-lived read connections (one per reader thread)
+READ_POOL_SIZE = int(os.getenv('DATABASE_READ_POOL_SIZE', '4'))
+
+# Write-behind batching for conversation and assessment logs
+WRITE_BATCH_SIZE = int(os.getenv('WRITE_BATCH_SIZE', '100'))
+WRITE_FLUSH_INTERVAL = float(os.getenv('WRITE_FLUSH_INTERVAL', '0.5'))
+
+# Backfills run in chunks of this many rows, pausing between chunks
+BACKFILL_CHUNK_SIZE = int(os.getenv('BACKFILL_CHUNK_SIZE', '1000'))
+BACKFILL_PAUSE = float(os.getenv('BACKFILL_PAUSE', '0.01'))
+
+# Connections are long-lived and owned by the executor threads below:
+# a single writer thread (SQLite only allows one writer at a time) and a
+# small pool of reader threads, each with its own connection.
+_local = threading.local()
+_connections = []
+_connections_lock = threading.Lock()
+_write_executor = None
+_read_executor = None
+_write_queue = None
+_backfill_thread = None
+_backfill_stop = threading.Event()
+
+# Recent history per user for get_user_assessments_async; None when other
+# processes write to the same database (see disable_history_cache)
+_history_cache = HistoryCache()
+
+gauge('mindcare_pending_writes', 'Records waiting in the write-behind queue',
+      lambda: _write_queue.depth if _write_queue is not None else 0)
+gauge('mindcare_write_flush_last_ms', 'Time the last write-behind batch took to commit',
+      lambda: write_queue_stats()['last_flush_ms'])
+gauge('mindcare_write_flush_avg_ms', 'Average time a write-behind batch takes to commit',
+      lambda: write_queue_stats()['avg_flush_ms'])
+gauge('mindcare_write_flush_max_ms', 'Longest time a write-behind batch took to commit',
+      lambda: write_queue_stats()['max_flush_ms'])
+gauge('mindcare_write_flushes', 'Write-behind batches committed', lambda: write_queue_stats()['flushes'])
+for _name, _help in (
+    ('hits', 'History reads served from the cache'),
+    ('misses', 'History reads that went to the database'),
+    ('evictions', 'Users evicted from the history cache to stay within its bounds'),
+    ('invalidations', 'Cached histories dropped after a new assessment'),
+    ('bytes', 'Approximate memory held by the history cache'),
+):
+    gauge(f'mindcare_history_cache_{_name}', _help, lambda name=_name: history_cache_stats()[name])
+
+
+def _open_connection(readonly):
+    """Open a long-lived WAL connection for the current executor thread"""
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    if readonly:
+        conn.execute('PRAGMA query_only=ON')
+    # Needed to read the conversation_text view behind the search index
+    register_functions(conn)
+    _local.conn = conn
+    with _connections_lock:
+        _connections.append(conn)
+
+
+def _get_write_executor():
+    global _write_executor
+    if _write_executor is None:
+        os.makedirs(os.path.dirname(DB_PATH) or '.', exist_ok=True)
+        _write_executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='db-writer',
+            initializer=_open_connection,
+            initargs=(False,),
         )
-    ''')
-    
-    # Table 2: Assessment results
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS assessments (
-            assessment_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            phq9_score INTEGER,
-            severity TEXT,
-            answers TEXT,
-            assessment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
+    return _write_executor
+
+
+def _get_read_executor():
+    global _read_executor
+    if _read_executor is None:
+        _read_executor = ThreadPoolExecutor(
+            max_workers=READ_POOL_SIZE,
+            thread_name_prefix='db-reader',
+            initializer=_open_connection,
+            initargs=(True,),
         )
-    ''')
-    
-    # Table 3: Conversation logs
-    cursor.execute('''
-        CREATE TABLE IF NOT EXISTS conversations (
-            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id INTEGER,
-            user_message TEXT,
-            bot_response TEXT,
-            message_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (user_id) REFERENCES users(user_id)
+    return _read_executor
+
+
+def _call(fn, args):
+    return fn(_local.conn, *args)
+
+
+def submit_write(fn, *args):
+    """Run fn(conn, *args) on the writer thread, returns a concurrent Future"""
+    return _get_write_executor().submit(_call, fn, args)
+
+
+def submit_read(fn, *args):
+    """Run fn(conn, *args) on a pooled reader thread, returns a concurrent Future"""
+    return _get_read_executor().submit(_call, fn, args)
+
+
+def _get_write_queue():
+    global _write_queue
+    if _write_queue is None:
+        _write_queue = WriteBehindQueue(
+            lambda batch: submit_write(_write_batch, batch),
+            max_batch=WRITE_BATCH_SIZE,
+            flush_interval=WRITE_FLUSH_INTERVAL,
         )
-    ''')
-    
-    conn.commit()
-    conn.close()
+    return _write_queue
+
+
+def disable_history_cache():
+    """
+    Read assessment history from the database every time
+
+    For processes sharing the database with other writers (webhook
+    workers): the cache is only invalidated by this process's own saves.
+    """
+    global _history_cache
+    _history_cache = None
+
+
+def history_cache_stats():
+    """Hit/miss/eviction counters of the assessment history cache"""
+    if _history_cache is None:
+        return {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0, 'users': 0, 'bytes': 0}
+    return _history_cache.stats()
+
+
+def write_queue_stats():
+    """Depth and flush latency of the write-behind queue"""
+    if _write_queue is None:
+        return {'depth': 0, 'flushes': 0, 'records_flushed': 0,
+                'last_flush_ms': 0.0, 'avg_flush_ms': 0.0, 'max_flush_ms': 0.0}
+    return _write_queue.stats()
+
+
+def close_database():
+    """Drain queued writes, then close all pooled connections"""
+    global _write_executor, _read_executor, _write_queue, _backfill_thread
+    if _backfill_thread is not None:
+        _backfill_stop.set()
+        _backfill_thread.join()
+        _backfill_thread = None
+        _backfill_stop.clear()
+    if _write_queue is not None:
+        _write_queue.close()
+        _write_queue = None
+    for executor in (_write_executor, _read_executor):
+        if executor is not None:
+            executor.shutdown(wait=True)
+    _write_executor = None
+    _read_executor = None
+    with _connections_lock:
+        for conn in _connections:
+            conn.close()
+        _connections.clear()
+
+
+@timed(DB_SECONDS)
+def init_database(backfill=True, apply_migrations=True):
+    """
+    Initialize SQLite database, applying any pending migrations
+
+    Processes sharing a database with one that migrates it and runs the
+    backfills (webhook workers) pass apply_migrations=False, backfill=False.
+    """
+    if apply_migrations:
+        submit_write(migrate).result()
+    if backfill:
+        _start_backfills()
     print("✓ Database initialized successfully")
 
-def save_user(user_id, username, first_name, last_name):
-    """Save new user to database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+
+def run_backfills(chunk_size=BACKFILL_CHUNK_SIZE, pause=0.0, stop=None):
+    """
+    Run registered backfills to completion, one chunk per write transaction
     
+    Live writes queued on the writer thread run between chunks.
+    """
+    for name, fn in BACKFILLS:
+        while not (stop and stop.is_set()):
+            try:
+                more = submit_write(run_backfill_chunk, name, fn, chunk_size).result()
+            except Exception as e:
+                print(f"Error in backfill {name}: {e}")
+                break
+            if not more:
+                break
+            if pause:
+                time.sleep(pause)
+
+
+def _start_backfills():
+    global _backfill_thread
+    if _backfill_thread is None:
+        _backfill_thread = threading.Thread(
+            target=run_backfills,
+            kwargs={'pause': BACKFILL_PAUSE, 'stop': _backfill_stop},
+            name='db-backfill',
+            daemon=True,
+        )
+        _backfill_thread.start()
+
+
+def _save_user(conn, user_id, username, first_name, last_name):
     try:
-        cursor.execute('''
+        conn.execute('''
             INSERT OR IGNORE INTO users 
             (user_id, username, first_name, last_name, last_interaction)
             VALUES (?, ?, ?, ?, ?)
         ''', (user_id, username, first_name, last_name, datetime.now()))
         conn.commit()
     except Exception as e:
+        conn.rollback()
         print(f"Error saving user: {e}")
-    finally:
-        conn.close()
 
-def save_conversation(user_id, user_message, bot_response):
-    """Log conversation to database"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
+
+def _insert_conversation(conn, user_id, user_message, bot_response):
+    if isinstance(bot_response, Response):
+        # Only a reference to the shared template and the parameters are stored
+        cursor = conn.execute('''
             INSERT INTO conversations
-            (user_id, user_message, bot_response)
-            VALUES (?, ?, ?)
-        ''', (user_id, user_message, bot_response))
-        conn.commit()
-    except Exception as e:
-        print(f"Error saving conversation: {e}")
-    finally:
-        conn.close()
-
-def save_assessment(user_id, phq9_score, severity, answers):
-    """Save assessment results"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    try:
-        cursor.execute('''
-            INSERT INTO assessments
-            (user_id, phq9_score, severity, answers)
+            (user_id, user_message, response_template, response_params)
             VALUES (?, ?, ?, ?)
-        ''', (user_id, phq9_score, severity, str(answers)))
+        ''', (user_id, user_message, store_template(conn, bot_response.template),
+              encode_params(bot_response.params)))
+        index_conversation(conn, cursor.lastrowid, user_message, bot_response.text)
+        return
+    cursor = conn.execute('''
+        INSERT INTO conversations
+        (user_id, user_message, bot_response)
+        VALUES (?, ?, ?)
+    ''', (user_id, user_message, bot_response))
+    index_conversation(conn, cursor.lastrowid, user_message, bot_response)
+
+
+def _insert_assessment(conn, user_id, phq9_score, severity, answers, questionnaire='phq9', submission_key=None):
+    cursor = conn.execute('''
+        INSERT OR IGNORE INTO assessments
+        (user_id, phq9_score, severity, answers_packed, questionnaire, submission_key)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, phq9_score, severity, pack_answers(answers), questionnaire, submission_key))
+    if not cursor.rowcount:
+        # Already saved from an earlier tap on the same buttons
+        return
+    update_rollups(conn, cursor.lastrowid, questionnaire, severity, answers)
+    # The trend follows full PHQ-9 scores only, other scores are on other scales
+    if questionnaire == 'phq9':
+        update_trend(conn, user_id, cursor.lastrowid, phq9_score)
+
+
+_INSERTS = {
+    'conversation': _insert_conversation,
+    'assessment': _insert_assessment,
+    'reminder': schedule_reminder,
+}
+
+
+@timed(DB_SECONDS)
+def _write_batch(conn, batch):
+    """Write a batch of (kind, args) records in a single transaction"""
+    try:
+        for kind, args in batch:
+            _INSERTS[kind](conn, *args)
         conn.commit()
+        _committed(batch)
+        return
     except Exception as e:
-        print(f"Error saving assessment: {e}")
-    finally:
-        conn.close()
-
-def get_user_assessments(user_id):
-    """Retrieve user's assessment history"""
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
+        conn.rollback()
+        print(f"Error writing batch, retrying row by row: {e}")
     
+    # Keep the good rows if one record in the batch is bad
+    for record in batch:
+        kind, args = record
+        try:
+            _INSERTS[kind](conn, *args)
+            conn.commit()
+            _committed([record])
+        except Exception as e:
+            conn.rollback()
+            print(f"Error saving {kind}: {e}")
+
+
+def _committed(batch):
+    # Runs after commit so a concurrent read cannot cache the old history
+    for kind, args in batch:
+        if kind == 'assessment' and _history_cache is not None:
+            _history_cache.invalidate(args[0])
+
+
+@timed(DB_SECONDS)
+def _get_user_assessments(conn, user_id, limit, offset):
     try:
-        cursor.execute('''
-            SELECT phq9_score, severity, assessment_date 
+        cursor = conn.execute('''
+            SELECT phq9_score, severity, assessment_date, questionnaire
             FROM assessments 
             WHERE user_id = ? 
             ORDER BY assessment_date DESC
-        ''', (user_id,))
-        results = cursor.fetchall()
-        return results
+            LIMIT ? OFFSET ?
+        ''', (user_id, -1 if limit is None else limit, offset))
+        return cursor.fetchall()
     except Exception as e:
         print(f"Error retrieving assessments: {e}")
         return []
-    finally:
-        conn.close()
+
+
+def _get_assessment_answers(conn, assessment_id):
+    row = conn.execute('''
+        SELECT answers_packed, answers FROM assessments WHERE assessment_id = ?
+    ''', (assessment_id,)).fetchone()
+    return decode_answers(*row) if row else None
+
+
+@timed(DB_SECONDS)
+def _get_user_trend(conn, user_id):
+    try:
+        return get_trend(conn, user_id)
+    except Exception as e:
+        print(f"Error retrieving trend: {e}")
+        return None
+
+
+# ============================================
+# Blocking API (scripts and tools)
+# ============================================
+
+@timed(DB_SECONDS)
+def save_user(user_id, username, first_name, last_name):
+    """Save new user to database"""
+    submit_write(_save_user, user_id, username, first_name, last_name).result()
+
+@timed(DB_SECONDS)
+def save_conversation(user_id, user_message, bot_response):
+    """Log conversation to database"""
+    _get_write_queue().flush(('conversation', (user_id, user_message, bot_response))).result()
+
+@timed(DB_SECONDS)
+def save_assessment(user_id, phq9_score, severity, answers, questionnaire='phq9', submission_key=None):
+    """Save assessment results, answers in the questionnaire's items order"""
+    record = ('assessment', (user_id, phq9_score, severity, answers, questionnaire, submission_key))
+    _get_write_queue().flush(record).result()
+
+@timed(DB_SECONDS)
+def get_user_assessments(user_id, limit=None, offset=0):
+    """Retrieve user's assessment history, newest first, as (score, severity, date, questionnaire)"""
+    return submit_read(_get_user_assessments, user_id, limit, offset).result()
+
+@timed(DB_SECONDS)
+def get_assessment_answers(assessment_id):
+    """Answers of one assessment as a list, or None if it does not exist"""
+    return submit_read(_get_assessment_answers, assessment_id).result()
+
+@timed(DB_SECONDS)
+def get_user_trend(user_id):
+    """User's score trend (see trends.Trend), or None without assessments"""
+    return submit_read(_get_user_trend, user_id).result()
+
+@timed(DB_SECONDS)
+def search_conversations(query, limit=20, offset=0, user_id=None):
+    """Page of conversations matching an FTS5 query (see search.py), best first"""
+    return submit_read(search, query, limit, offset, user_id).result()
+
+
+# ============================================
+# Async API (bot handlers)
+# ============================================
+
+@timed(DB_SECONDS)
+async def save_user_async(user_id, username, first_name, last_name):
+    """Save new user without blocking the event loop"""
+    await asyncio.wrap_future(submit_write(_save_user, user_id, username, first_name, last_name))
+
+@timed(DB_SECONDS)
+async def save_conversation_async(user_id, user_message, bot_response):
+    """Queue a conversation log for the next write-behind batch"""
+    _get_write_queue().put(('conversation', (user_id, user_message, bot_response)))
+
+@timed(DB_SECONDS)
+async def save_assessment_async(user_id, phq9_score, severity, answers, durable=False, questionnaire='phq9',
+                                submission_key=None):
+    """
+    Save assessment results without blocking the event loop
+    
+    By default the row is batched with other writes.  With durable=True the
+    pending batch is flushed together with this row and the call returns
+    once it is committed.  A second save with the user's submission_key
+    (see AssessmentSession.submission_key) is ignored.
+    """
+    record = ('assessment', (user_id, phq9_score, severity, answers, questionnaire, submission_key))
+    if durable:
+        await asyncio.wrap_future(_get_write_queue().flush(record))
+    else:
+        _get_write_queue().put(record)
+
+@timed(DB_SECONDS)
+async def schedule_reminder_async(user_id, chat_id, action, due_at):
+    """Queue setting the user's reminder for action (see reminders.py) for the next batch"""
+    _get_write_queue().put(('reminder', (user_id, chat_id, action, due_at)))
+
+@timed(DB_SECONDS)
+async def get_user_assessments_async(user_id, limit=None, offset=0):
+    """
+    Retrieve user's assessment history from the read pool, newest first
+    
+    The first page (offset 0 with a limit) is served through the history
+    cache, unless it is disabled.
+    """
+    if offset or limit is None or _history_cache is None:
+        return await asyncio.wrap_future(submit_read(_get_user_assessments, user_id, limit, offset))
+    
+    cache = _history_cache
+    rows = cache.get(user_id, limit)
+    if rows is None:
+        token = cache.begin(user_id)
+        rows = await asyncio.wrap_future(submit_read(_get_user_assessments, user_id, limit, 0))
+        rows = cache.fill(user_id, limit, token, rows)
+    return rows
+
+@timed(DB_SECONDS)
+async def get_user_trend_async(user_id):
+    """User's score trend from the read pool, a single row read"""
+    return await asyncio.wrap_future(submit_read(_get_user_trend, user_id))
+
 
 if __name__ == "__main__":
-    init_database()
+    init_database(backfill=False)
+    run_backfills()
+    close_database()
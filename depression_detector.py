@@ -1,7 +1,26 @@
-from sklearn.ensemble import RandomForestClassifier
+import hashlib
+import json
+import os
+from bisect import bisect_left
+from importlib import metadata
+from types import MappingProxyType
+from typing import NamedTuple
+
 import numpy as np
 from datetime import datetime
 
+# The model's severity table is cached here, keyed by a hash of the training
+# data and hyperparameters.  Set MODEL_DIR to an empty string to always train
+# in memory.
+MODEL_DIR = os.getenv('MODEL_DIR', './data/models')
+
+# How severity is decided: 'score' uses the standard PHQ-9 cut-offs,
+# 'model' uses the RandomForest prediction for the full answer pattern
+SEVERITY_MODE = os.getenv('SEVERITY_MODE', 'score')
+
+# Bump when the artifact layout changes so old files are not picked up
+ARTIFACT_VERSION = 1
+
 # PHQ-9 Questions (standard depression screening tool)
 PHQ9_QUESTIONS = [
     "1. Little interest or pleasure in doing things?",
@@ -23,30 +42,270 @@ RESPONSE_OPTIONS = {
     "nearly every day": 3
 }
 
+# Answers are packed 2 bits each behind a leading 1 bit, so a single integer
+# also records how many questions have been answered (all 9 fit in 19 bits)
+EMPTY_ANSWERS = 1
+
+def pack_answers(answers):
+    """Pack a list of answers (0-3) into an integer"""
+    packed = EMPTY_ANSWERS
+    for value in answers:
+        if not 0 <= value <= 3:
+            raise ValueError(f"Invalid answer value: {value}")
+        packed = (packed << 2) | int(value)
+    return packed
+
+def unpack_answers(packed):
+    """Unpack an integer produced by pack_answers back into a list"""
+    count = (packed.bit_length() - 1) // 2
+    return [(packed >> (2 * (count - 1 - i))) & 3 for i in range(count)]
+
+
+# Sample training data (synthetic for demo)
+# In production, use real clinical data
+TRAINING_X = np.array([
+    [0, 0, 0, 0, 0, 0, 0, 0, 0],  # No symptoms
+    [1, 1, 1, 1, 1, 1, 1, 1, 0],  # Mild symptoms
+    [2, 2, 2, 2, 1, 1, 2, 2, 1],  # Moderate symptoms
+    [3, 3, 3, 3, 3, 3, 3, 3, 2],  # Severe symptoms
+    [0, 1, 0, 1, 0, 1, 0, 1, 0],  # Mild variation
+    [2, 2, 2, 2, 2, 2, 2, 2, 2],  # Moderate consistent
+])
+TRAINING_Y = np.array([0, 1, 2, 3, 1, 2])  # 0=None, 1=Mild, 2=Moderate, 3=Severe
+
+MODEL_PARAMS = {'n_estimators': 10, 'random_state': 42}
+
+MAX_PHQ9_SCORE = 27
+
+# Highest score of each severity level except the last (Severe)
+SEVERITY_UPPER_BOUNDS = (4, 9, 14, 19)
+
+# One shared, read-only result per severity level
+SEVERITY_LEVELS = tuple(MappingProxyType(level) for level in (
+    {
+        'severity': 'None',
+        'level': 0,
+        'recommendation': 'No depression detected. Keep maintaining healthy habits.',
+        'color': '✅'
+    },
+    {
+        'severity': 'Mild',
+        'level': 1,
+        'recommendation': 'Mild depression detected. Consider regular exercise, good sleep, and social connection.',
+        'color': '🟡'
+    },
+    {
+        'severity': 'Moderate',
+        'level': 2,
+        'recommendation': 'Moderate depression detected. Professional counseling is recommended.',
+        'color': '🟠'
+    },
+    {
+        'severity': 'Moderately Severe',
+        'level': 3,
+        'recommendation': 'Moderately severe depression detected. Please seek professional help.',
+        'color': '🔴'
+    },
+    {
+        'severity': 'Severe',
+        'level': 4,
+        'recommendation': 'Severe depression detected. Please contact a mental health professional immediately.',
+        'color': '🚨'
+    },
+))
+
+# Results whose response points to crisis services
+CRISIS_SEVERITIES = frozenset({'Moderately Severe', 'Severe'})
+
+SEVERITY_NAMES = np.array([level['severity'] for level in SEVERITY_LEVELS], dtype=object)
+
+# Precomputed for every possible score 0-27
+_LEVEL_BY_SCORE = np.searchsorted(
+    SEVERITY_UPPER_BOUNDS, np.arange(MAX_PHQ9_SCORE + 1), side='left'
+).astype(np.int8)
+_RESULT_BY_SCORE = tuple(SEVERITY_LEVELS[level] for level in _LEVEL_BY_SCORE)
+
+
+class BatchScores(NamedTuple):
+    """Result of DepressionDetector.score_batch, one entry per assessment"""
+    scores: np.ndarray
+    levels: np.ndarray
+    labels: np.ndarray
+
+
+def unpack_answers_batch(packed, count=9):
+    """Vectorized unpack_answers for an array of packed answers with the same count"""
+    packed = np.asarray(packed, dtype=np.int64)
+    shifts = np.arange(2 * (count - 1), -1, -2, dtype=np.int64)
+    return ((packed[:, None] >> shifts) & 3).astype(np.uint8)
+
+
+def model_artifact_key(X, y, params):
+    """Hash of everything that determines the fitted model"""
+    digest = hashlib.sha256()
+    digest.update(f"v{ARTIFACT_VERSION}".encode())
+    digest.update(metadata.version('scikit-learn').encode())
+    for array in (X, y):
+        digest.update(str((array.dtype.str, array.shape)).encode())
+        digest.update(np.ascontiguousarray(array).tobytes())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    return digest.hexdigest()[:16]
+
+
+def _artifact_path(model_dir, X, y, params, suffix):
+    key = model_artifact_key(X, y, params)
+    return os.path.join(model_dir, f"depression_rf-{key}{suffix}")
+
+
+def _save_atomic(path, save):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def train_model(X, y, params):
+    """
+    Fit the RandomForestClassifier
+
+    Not cached: unpickling a fitted forest imports sklearn and takes longer
+    than fitting this one, and the severity table makes it unnecessary.
+    """
+    from sklearn.ensemble import RandomForestClassifier
+    model = RandomForestClassifier(**params)
+    model.fit(X, y)
+    return model
+
+
+# Severity for each class the model predicts (0=None, 1=Mild, 2=Moderate, 3=Severe)
+MODEL_CLASS_LEVELS = (0, 1, 2, 4)
+
+# Weight of each answer in the index of the 4^9 lookup table, matching the
+# order of pack_answers (first answer in the highest bits)
+_ANSWER_WEIGHTS = 4 ** np.arange(8, -1, -1, dtype=np.int64)
+N_ANSWER_PATTERNS = 4 ** 9
+
+
+class CompiledForest(NamedTuple):
+    """A fitted RandomForestClassifier flattened into shared node arrays"""
+    roots: np.ndarray
+    feature: np.ndarray
+    threshold: np.ndarray
+    left: np.ndarray
+    right: np.ndarray
+    proba: np.ndarray
+    max_depth: int
+    classes: np.ndarray
+
+
+def compile_forest(model):
+    """
+    Flatten the trees of a fitted forest into one set of node arrays
+
+    Leaves point to themselves, so every row can be walked the same number of
+    steps.  Leaf values are normalized the way DecisionTreeClassifier does it,
+    which keeps predictions identical to sklearn's.
+    """
+    roots, feature, threshold, left, right, proba = [], [], [], [], [], []
+    offset = 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        nodes = np.arange(tree.node_count)
+        is_leaf = tree.children_left == -1
+
+        roots.append(offset)
+        feature.append(np.where(is_leaf, 0, tree.feature))
+        threshold.append(tree.threshold)
+        left.append(np.where(is_leaf, nodes, tree.children_left) + offset)
+        right.append(np.where(is_leaf, nodes, tree.children_right) + offset)
+
+        value = np.array(tree.value[:, 0, :model.n_classes_], dtype=np.float64)
+        normalizer = value.sum(axis=1)[:, np.newaxis]
+        normalizer[normalizer == 0.0] = 1.0
+        proba.append(value / normalizer)
+        offset += tree.node_count
+
+    return CompiledForest(
+        roots=np.array(roots),
+        feature=np.concatenate(feature),
+        threshold=np.concatenate(threshold),
+        left=np.concatenate(left),
+        right=np.concatenate(right),
+        proba=np.concatenate(proba),
+        max_depth=max(estimator.tree_.max_depth for estimator in model.estimators_),
+        classes=model.classes_,
+    )
+
+
+def predict_compiled(forest, X):
+    """Predict classes for an N x 9 array with a CompiledForest"""
+    X = np.asarray(X, dtype=np.float32)
+    rows = np.arange(len(X))
+    proba = np.zeros((len(X), forest.proba.shape[1]))
+    for root in forest.roots:
+        node = np.full(len(X), root)
+        for _ in range(forest.max_depth):
+            goes_left = X[rows, forest.feature[node]] <= forest.threshold[node]
+            node = np.where(goes_left, forest.left[node], forest.right[node])
+        proba += forest.proba[node]
+    proba /= len(forest.roots)
+    return forest.classes.take(np.argmax(proba, axis=1))
+
+
+def all_answer_patterns():
+    """Every possible set of 9 answers, row i is the pattern with table index i"""
+    return unpack_answers_batch(np.arange(N_ANSWER_PATTERNS) | (1 << 18))
+
+
+def load_or_build_severity_table(detector):
+    """
+    Predicted class for all 4^9 answer patterns, cached under MODEL_DIR
+
+    When the table is cached the model itself (and sklearn) is never loaded.
+    It is memory-mapped on load, so several workers share the pages.
+    """
+    path = None
+    if detector.model_dir:
+        path = _artifact_path(detector.model_dir, detector.X_train, detector.y_train,
+                              MODEL_PARAMS, '.table.npy')
+        if os.path.exists(path):
+            return np.load(path, mmap_mode='r')
+
+    table = predict_compiled(compile_forest(detector.model), all_answer_patterns()).astype(np.uint8)
+    if path:
+        def save(tmp_path):
+            with open(tmp_path, 'wb') as f:
+                np.save(f, table)
+        _save_atomic(path, save)
+    return table
+
+
 class DepressionDetector:
     """
     Detects depression severity based on PHQ-9 questionnaire scores
     """
     
-    def __init__(self):
-        """Initialize the depression detection model"""
-        # Train a simple model for demonstration
-        self.model = RandomForestClassifier(n_estimators=10, random_state=42)
-        
-        # Sample training data (synthetic for demo)
-        # In production, use real clinical data
-        self.X_train = np.array([
-            [0, 0, 0, 0, 0, 0, 0, 0, 0],  # No symptoms
-            [1, 1, 1, 1, 1, 1, 1, 1, 0],  # Mild symptoms
-            [2, 2, 2, 2, 1, 1, 2, 2, 1],  # Moderate symptoms
-            [3, 3, 3, 3, 3, 3, 3, 3, 2],  # Severe symptoms
-            [0, 1, 0, 1, 0, 1, 0, 1, 0],  # Mild variation
-            [2, 2, 2, 2, 2, 2, 2, 2, 2],  # Moderate consistent
-        ])
-        self.y_train = np.array([0, 1, 2, 3, 1, 2])  # 0=None, 1=Mild, 2=Moderate, 3=Severe
-        
-        # Train model
-        self.model.fit(self.X_train, self.y_train)
+    def __init__(self, model_dir=MODEL_DIR):
+        """Initialize the depression detector, the model is loaded on first use"""
+        self.model_dir = model_dir
+        self.X_train = TRAINING_X
+        self.y_train = TRAINING_Y
+        self._model = None
+        self._severity_table = None
+    
+    @property
+    def model(self):
+        """Fitted RandomForestClassifier, trained on first access"""
+        if self._model is None:
+            self._model = train_model(self.X_train, self.y_train, MODEL_PARAMS)
+        return self._model
+    
+    @property
+    def severity_table(self):
+        """Model prediction for every answer pattern, indexed like pack_answers"""
+        if self._severity_table is None:
+            self._severity_table = load_or_build_severity_table(self)
+        return self._severity_table
     
     def classify_score(self, phq9_score):
         """
@@ -58,43 +317,68 @@ class DepressionDetector:
         10-14: Moderate depression
         15-19: Moderately severe depression
         20-27: Severe depression
+        
+        Returns one of the shared, read-only SEVERITY_LEVELS mappings.
+        """
+        if type(phq9_score) is int and 0 <= phq9_score <= MAX_PHQ9_SCORE:
+            return _RESULT_BY_SCORE[phq9_score]
+        return SEVERITY_LEVELS[bisect_left(SEVERITY_UPPER_BOUNDS, phq9_score)]
+    
+    def score_batch(self, answers, upper_bounds=SEVERITY_UPPER_BOUNDS):
+        """
+        Score many assessments at once
+        
+        answers: N x 9 array-like of answers (0-3), one row per assessment
+        upper_bounds: highest score of each severity level but the last,
+            pass different cut-offs to re-score under them
+        
+        Returns BatchScores with scores, severity levels and labels as arrays.
         """
+        answers = np.asarray(answers)
+        if answers.ndim != 2 or answers.shape[1] != len(PHQ9_QUESTIONS):
+            raise ValueError(f"Expected an N x 9 array of answers, got shape {answers.shape}")
+        if answers.size and (answers.min() < 0 or answers.max() > 3):
+            raise ValueError("Answers must be between 0 and 3")
         
-        if phq9_score <= 4:
-            return {
-                'severity': 'None',
-                'level': 0,
-                'recommendation': 'No depression detected. Keep maintaining healthy habits.',
-                'color': '✅'
-            }
-        elif phq9_score <= 9:
-            return {
-                'severity': 'Mild',
-                'level': 1,
-                'recommendation': 'Mild depression detected. Consider regular exercise, good sleep, and social connection.',
-                'color': '🟡'
-            }
-        elif phq9_score <= 14:
-            return {
-                'severity': 'Moderate',
-                'level': 2,
-                'recommendation': 'Moderate depression detected. Professional counseling is recommended.',
-                'color': '🟠'
-            }
-        elif phq9_score <= 19:
-            return {
-                'severity': 'Moderately Severe',
-                'level': 3,
-                'recommendation': 'Moderately severe depression detected. Please seek professional help.',
-                'color': '🔴'
-            }
+        scores = answers.sum(axis=1, dtype=np.int16)
+        if upper_bounds is SEVERITY_UPPER_BOUNDS:
+            levels = _LEVEL_BY_SCORE[scores]
         else:
-            return {
-                'severity': 'Severe',
-                'level': 4,
-                'recommendation': 'Severe depression detected. Please contact a mental health professional immediately.',
-                'color': '🚨'
-            }
+            levels = np.searchsorted(upper_bounds, scores, side='left').astype(np.int8)
+        return BatchScores(scores, levels, SEVERITY_NAMES[levels])
+    
+    def score_chunks(self, chunks, upper_bounds=SEVERITY_UPPER_BOUNDS):
+        """Score an iterable of N x 9 answer chunks, yielding BatchScores per chunk"""
+        for chunk in chunks:
+            yield self.score_batch(chunk, upper_bounds)
+    
+    def predict_severity(self, answers):
+        """
+        Classify severity with the RandomForest model from the 9 answers
+        
+        A table lookup, so it takes microseconds. Returns the same shared
+        mappings as classify_score.
+        """
+        if len(answers) != len(PHQ9_QUESTIONS):
+            raise ValueError(f"Expected 9 answers, got {len(answers)}")
+        index = pack_answers(answers) & (N_ANSWER_PATTERNS - 1)
+        return SEVERITY_LEVELS[MODEL_CLASS_LEVELS[self.severity_table[index]]]
+    
+    def predict_severity_batch(self, answers):
+        """Model severity levels for an N x 9 array of answers"""
+        answers = np.asarray(answers)
+        if answers.ndim != 2 or answers.shape[1] != len(PHQ9_QUESTIONS):
+            raise ValueError(f"Expected an N x 9 array of answers, got shape {answers.shape}")
+        if answers.size and (answers.min() < 0 or answers.max() > 3):
+            raise ValueError("Answers must be between 0 and 3")
+        classes = self.severity_table[answers.astype(np.int64) @ _ANSWER_WEIGHTS]
+        return np.asarray(MODEL_CLASS_LEVELS, dtype=np.int8)[classes]
+    
+    def classify_answers(self, answers, mode=SEVERITY_MODE):
+        """Severity for a completed questionnaire, using SEVERITY_MODE"""
+        if mode == 'model':
+            return self.predict_severity(answers)
+        return self.classify_score(self.calculate_phq9_score(answers))
     
     def get_therapeutic_response(self, severity_data):
         """Generate empathetic response based on severity"""
@@ -146,3 +430,10 @@ if __name__ == "__main__":
         print(f"\nPHQ-9 Score: {score}")
         print(f"Severity: {result['severity']}")
         print(f"Recommendation: {result['recommendation']}")
+    
+    # The fast model paths must agree exactly with sklearn
+    patterns = all_answer_patterns()
+    expected = detector.model.predict(patterns)
+    assert np.array_equal(predict_compiled(compile_forest(detector.model), patterns), expected)
+    assert np.array_equal(detector.severity_table, expected)
+    print(f"\nFast model inference matches sklearn on all {len(patterns)} answer patterns")
@@ -0,0 +1,122 @@
+"""
+Per-user ordered concurrent update processing
+
+Updates from different users are handled concurrently, updates from the
+same user strictly in arrival order, since handlers such as handle_answer
+depend on the order of a user's taps.
+
+Install with:
+
+    processor = PerUserUpdateProcessor()
+    builder.concurrent_updates(processor).update_queue(processor.update_queue)
+
+At most UPDATE_CONCURRENCY handlers run at once.  At most UPDATE_MAX_PENDING
+updates are taken off the queue (running or waiting for their turn); beyond
+that the queue fills up to UPDATE_QUEUE_SIZE and then put() blocks, which
+stalls polling or delays webhook responses until the bot catches up.
+"""
+import asyncio
+import os
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+# Handlers running at once; 1 keeps the default sequential processing
+UPDATE_CONCURRENCY = int(os.getenv('UPDATE_CONCURRENCY', '32'))
+# Updates taken off the queue, running or waiting behind the same user
+UPDATE_MAX_PENDING = int(os.getenv('UPDATE_MAX_PENDING', '1024'))
+# Updates waiting in the queue before put() blocks
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '1024'))
+
+
+def update_key(update):
+    """Key whose updates must be processed in order, None if unordered"""
+    if not isinstance(update, Update):
+        return None
+    if update.effective_user:
+        return update.effective_user.id
+    if update.effective_chat:
+        return update.effective_chat.id
+    return None
+
+
+class _AdmissionQueue(asyncio.Queue):
+    """
+    Update queue that hands out updates only while there is room
+
+    The application fetches from it in arrival order, so this is where each
+    update gets its place in its user's line.  task_done() is called by the
+    application once an update has been processed.
+    """
+
+    def __init__(self, processor, maxsize):
+        super().__init__(maxsize)
+        self._processor = processor
+
+    async def get(self):
+        await self._processor._wait_for_room()
+        item = await super().get()
+        self._processor._admit(item)
+        return item
+
+    def task_done(self):
+        super().task_done()
+        self._processor._release()
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+
+    def __init__(self, concurrency=UPDATE_CONCURRENCY, max_pending=UPDATE_MAX_PENDING,
+                 queue_size=UPDATE_QUEUE_SIZE):
+        # The base class semaphore bounds pending updates; the admission
+        # queue keeps below it, so it never blocks
+        super().__init__(max_pending)
+        self.concurrency = concurrency
+        self.update_queue = _AdmissionQueue(self, queue_size)
+        self._running = asyncio.Semaphore(concurrency)
+        self._room = asyncio.Event()
+        self.pending = 0
+        # key -> future of the last admitted update of that key
+        self._tails = {}
+        # id(update) -> (key, future of the previous update, own future)
+        self._turns = {}
+
+    async def _wait_for_room(self):
+        while self.pending >= self.max_concurrent_updates:
+            self._room.clear()
+            await self._room.wait()
+
+    def _admit(self, item):
+        self.pending += 1
+        key = update_key(item)
+        if key is None:
+            return
+        own = asyncio.get_running_loop().create_future()
+        self._turns[id(item)] = (key, self._tails.get(key), own)
+        self._tails[key] = own
+
+    def _release(self):
+        # The application also calls task_done() for the stop signal and
+        # while draining the queue on shutdown
+        self.pending = max(0, self.pending - 1)
+        self._room.set()
+
+    async def do_process_update(self, update, coroutine):
+        key, previous, own = self._turns.pop(id(update), (None, None, None))
+        try:
+            if previous is not None and not previous.done():
+                # asyncio.wait does not cancel previous if this task is cancelled
+                await asyncio.wait([previous])
+            async with self._running:
+                await coroutine
+        finally:
+            if own is not None:
+                own.set_result(None)
+                if self._tails.get(key) is own:
+                    del self._tails[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
@@ -0,0 +1,232 @@
+"""
+Streaming export of conversations and assessments
+
+Rows are read in id order with fetchmany, a part file at a time, so memory
+stays flat whatever the table size.  Each export continues from the last
+exported id recorded in <out>/export_state.json, and the state advances
+only after a part file is complete, so an interrupted export resumes from
+the last finished part.
+
+Formats: JSON lines (optionally gzip compressed) or Parquet with zstd
+compression (needs pyarrow, which is not in requirements.txt).
+
+Usage: python export.py [--out ./exports] [--format jsonl|parquet] [--gzip]
+                        [--tables conversations,assessments] [--from-start]
+"""
+import argparse
+import gzip
+import json
+import os
+import resource
+import sqlite3
+
+from migrations import decode_answers
+from responses import decode_response
+from sharding import SHARD_COUNT, shard_paths
+
+DB_PATH = os.getenv('DATABASE_PATH', './data/users.db')
+EXPORT_DIR = os.getenv('EXPORT_DIR', './exports')
+# Rows fetched per fetchmany call and rows per part file
+EXPORT_FETCH_SIZE = int(os.getenv('EXPORT_FETCH_SIZE', '5000'))
+EXPORT_PART_ROWS = int(os.getenv('EXPORT_PART_ROWS', '200000'))
+
+STATE_FILE = 'export_state.json'
+
+
+def _conversation_row(row):
+    conversation_id, user_id, user_message, bot_response, template_body, params, message_timestamp = row
+    return (conversation_id, user_id, user_message,
+            decode_response(bot_response, template_body, params), message_timestamp)
+
+
+def _assessment_row(row):
+    assessment_id, user_id, questionnaire, phq9_score, severity, answers_packed, answers, assessment_date = row
+    return (assessment_id, user_id, questionnaire, phq9_score, severity,
+            decode_answers(answers_packed, answers), assessment_date)
+
+
+# table -> (id column, select list, exported columns, row converter)
+TABLES = {
+    'conversations': (
+        'conversation_id',
+        'conversation_id, user_id, user_message, bot_response, '
+        '(SELECT body FROM response_templates WHERE template_id = response_template), '
+        'response_params, message_timestamp',
+        ('conversation_id', 'user_id', 'user_message', 'bot_response', 'message_timestamp'),
+        _conversation_row,
+    ),
+    'assessments': (
+        'assessment_id',
+        'assessment_id, user_id, questionnaire, phq9_score, severity, answers_packed, answers, assessment_date',
+        ('assessment_id', 'user_id', 'questionnaire', 'phq9_score', 'severity', 'answers', 'assessment_date'),
+        _assessment_row,
+    ),
+}
+
+
+def load_state(out_dir):
+    try:
+        with open(os.path.join(out_dir, STATE_FILE)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def save_state(out_dir, state):
+    path = os.path.join(out_dir, STATE_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(state, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+def stream_rows(conn, table, after_id, until_id, fetch_size=EXPORT_FETCH_SIZE):
+    """Yield batches of rows with after_id < id <= until_id, in id order"""
+    id_column, select, _, convert = TABLES[table]
+    cursor = conn.execute(f'''
+        SELECT {select} FROM {table}
+        WHERE {id_column} > ? AND {id_column} <= ?
+        ORDER BY {id_column}
+    ''', (after_id, until_id))
+    try:
+        while True:
+            rows = cursor.fetchmany(fetch_size)
+            if not rows:
+                return
+            yield [convert(row) for row in rows] if convert else rows
+    finally:
+        cursor.close()
+
+
+class JSONLinesWriter:
+
+    def __init__(self, path, columns, compress=False):
+        self.columns = columns
+        self.file = gzip.open(path, 'wt', encoding='utf-8') if compress else open(path, 'w', encoding='utf-8')
+
+    def write(self, rows):
+        self.file.writelines(
+            json.dumps(dict(zip(self.columns, row)), ensure_ascii=False, default=str) + '\n'
+            for row in rows
+        )
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes each batch as a row group, so only one batch is held in memory"""
+
+    def __init__(self, path, columns):
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise SystemExit("Parquet export needs pyarrow: pip install pyarrow")
+        self.pa = pa
+        self.columns = columns
+        self.writer = None
+        self.path = path
+        self._pq = pq
+
+    def write(self, rows):
+        table = self.pa.table({
+            column: [row[i] for row in rows] for i, column in enumerate(self.columns)
+        })
+        if self.writer is None:
+            self.writer = self._pq.ParquetWriter(self.path, table.schema, compression='zstd')
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def export_table(conn, table, out_dir, after_id, fmt='jsonl', compress=False,
+                 part_rows=EXPORT_PART_ROWS, prefix='', on_part=None):
+    """
+    Export rows with an id above after_id, returns the last exported id
+
+    The upper bound is fixed when the export starts; rows inserted while it
+    runs are left for the next export.  on_part(last_id) is called after
+    each part file is complete.
+    """
+    id_column, _, columns, _ = TABLES[table]
+    until_id = conn.execute(f'SELECT COALESCE(MAX({id_column}), 0) FROM {table}').fetchone()[0]
+    extension = 'parquet' if fmt == 'parquet' else ('jsonl.gz' if compress else 'jsonl')
+
+    while after_id < until_id:
+        # One short read transaction per part, so a long export does not
+        # hold back WAL checkpoints
+        part_end = conn.execute(f'''
+            SELECT MAX({id_column}) FROM (
+                SELECT {id_column} FROM {table}
+                WHERE {id_column} > ? AND {id_column} <= ?
+                ORDER BY {id_column} LIMIT ?
+            )
+        ''', (after_id, until_id, part_rows)).fetchone()[0]
+        if part_end is None:
+            break
+
+        name = f"{prefix}{table}-{after_id + 1:012d}-{part_end:012d}.{extension}"
+        path = os.path.join(out_dir, name)
+        writer = (ParquetWriter(path + '.tmp', columns) if fmt == 'parquet'
+                  else JSONLinesWriter(path + '.tmp', columns, compress))
+        try:
+            for rows in stream_rows(conn, table, after_id, part_end):
+                writer.write(rows)
+        finally:
+            writer.close()
+        os.replace(path + '.tmp', path)
+
+        after_id = part_end
+        if on_part:
+            on_part(after_id)
+    return after_id
+
+
+def export(out_dir=EXPORT_DIR, tables=tuple(TABLES), fmt='jsonl', compress=False, from_start=False,
+           db_paths=None, part_rows=EXPORT_PART_ROWS):
+    """Incremental export of tables from every shard, returns {state key: last id}"""
+    os.makedirs(out_dir, exist_ok=True)
+    state = {} if from_start else load_state(out_dir)
+    db_paths = db_paths or shard_paths(SHARD_COUNT, DB_PATH)
+
+    for index, db_path in enumerate(db_paths):
+        if not os.path.exists(db_path):
+            continue
+        prefix = f"shard{index}-" if len(db_paths) > 1 else ''
+        conn = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, timeout=30)
+        try:
+            for table in tables:
+                key = prefix + table
+
+                def on_part(last_id, key=key):
+                    state[key] = last_id
+                    save_state(out_dir, state)
+
+                export_table(conn, table, out_dir, state.get(key, 0), fmt, compress,
+                             part_rows, prefix, on_part)
+        finally:
+            conn.close()
+    return state
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export conversations and assessments")
+    parser.add_argument('--out', default=EXPORT_DIR)
+    parser.add_argument('--format', choices=('jsonl', 'parquet'), default='jsonl')
+    parser.add_argument('--gzip', action='store_true', help="gzip JSON lines output")
+    parser.add_argument('--tables', default=','.join(TABLES))
+    parser.add_argument('--from-start', action='store_true', help="ignore the saved state and export everything")
+    args = parser.parse_args()
+
+    tables = [table for table in args.tables.split(',') if table]
+    unknown = set(tables) - set(TABLES)
+    if unknown:
+        parser.error(f"unknown tables: {', '.join(sorted(unknown))}")
+
+    state = export(args.out, tables, args.format, args.gzip, args.from_start)
+    peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Exported up to {state} into {args.out} (peak RSS {peak_mb:.1f} MB)")
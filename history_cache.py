@@ -0,0 +1,105 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+
+# Bounds of the per-user assessment history cache
+HISTORY_CACHE_USERS = int(os.getenv('HISTORY_CACHE_USERS', '10000'))
+HISTORY_CACHE_BYTES = int(os.getenv('HISTORY_CACHE_BYTES', str(8 * 1024 * 1024)))
+
+
+def _rows_size(rows):
+    """Approximate memory held by a tuple of result rows"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+class HistoryCache:
+    """
+    LRU cache of recent assessment history, bounded by user count and bytes
+
+    Entries are keyed by user and page size.  Writers call invalidate() after
+    committing; a read that started before the invalidation is not cached
+    (see begin/fill), so a slow read cannot put stale rows back.  Safe to use
+    from several threads.
+    """
+
+    def __init__(self, max_users=HISTORY_CACHE_USERS, max_bytes=HISTORY_CACHE_BYTES):
+        self.max_users = max_users
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        # user_id -> {limit: rows}, least recently used first
+        self._entries = OrderedDict()
+        self._sizes = {}
+        self._loading = {}
+        self.bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, user_id, limit):
+        """Cached rows, or None on a miss"""
+        with self._lock:
+            pages = self._entries.get(user_id)
+            if pages is not None and limit in pages:
+                self._entries.move_to_end(user_id)
+                self.hits += 1
+                return pages[limit]
+            self.misses += 1
+            return None
+
+    def begin(self, user_id):
+        """Start a read for user_id, returns a token to pass to fill()"""
+        token = object()
+        with self._lock:
+            self._loading[user_id] = token
+        return token
+
+    def fill(self, user_id, limit, token, rows):
+        """Cache rows read since begin(), unless the user was invalidated meanwhile"""
+        rows = tuple(rows)
+        size = _rows_size(rows)
+        with self._lock:
+            if self._loading.get(user_id) is not token:
+                return rows
+            del self._loading[user_id]
+            pages = self._entries.get(user_id)
+            if size > self.max_bytes or (pages is not None and limit in pages):
+                return rows
+            if pages is None:
+                pages = self._entries[user_id] = {}
+                self._sizes[user_id] = 0
+
+            pages[limit] = rows
+            self._entries.move_to_end(user_id)
+            self._sizes[user_id] += size
+            self.bytes += size
+
+            while len(self._entries) > self.max_users or self.bytes > self.max_bytes:
+                evicted, _ = self._entries.popitem(last=False)
+                self.bytes -= self._sizes.pop(evicted)
+                self.evictions += 1
+        return rows
+
+    def invalidate(self, user_id):
+        """Drop a user's cached history after their assessments changed"""
+        with self._lock:
+            self._loading.pop(user_id, None)
+            if self._entries.pop(user_id, None) is not None:
+                self.bytes -= self._sizes.pop(user_id)
+                self.invalidations += 1
+
+    def stats(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'users': len(self._entries),
+                'bytes': self.bytes,
+            }
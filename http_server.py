@@ -0,0 +1,130 @@
+import asyncio
+
+MAX_BODY_SIZE = 1024 * 1024
+
+_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 413: 'Payload Too Large', 429: 'Too Many Requests',
+    502: 'Bad Gateway', 503: 'Service Unavailable',
+}
+
+
+class BadRequest(Exception):
+    """Malformed request, answered with 400 and a closed connection"""
+
+
+class HTTPServer:
+    """
+    Minimal asyncio HTTP/1.1 server with keep-alive
+
+    Subclasses implement handle_request(method, target, headers, body) and
+    return (status, body) with body as str or bytes; body is None when the
+    request was larger than MAX_BODY_SIZE.  Malformed requests get a 400
+    without reaching handle_request; both close the connection.
+    """
+
+    content_type = 'text/plain; charset=utf-8'
+
+    def __init__(self, host, port, reuse_port=False):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self.accepting = False
+        self._server = None
+        self._connections = set()
+        self._busy = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_connection, self.host, self.port, reuse_port=self.reuse_port or None
+        )
+        self.accepting = True
+        # Report the real port when started with port 0
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Stop accepting connections and wait for requests in progress"""
+        self.accepting = False
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        # Idle keep-alive connections are closed, busy ones finish their request
+        for task in self._connections - self._busy:
+            task.cancel()
+        if self._connections:
+            await asyncio.gather(*self._connections, return_exceptions=True)
+
+    async def handle_request(self, method, target, headers, body):
+        raise NotImplementedError
+
+    async def _handle_connection(self, reader, writer):
+        task = asyncio.current_task()
+        self._connections.add(task)
+        try:
+            while self.accepting:
+                try:
+                    request = await self._read_request(reader)
+                except BadRequest as e:
+                    self._write_response(writer, 400, str(e), False)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                self._busy.add(task)
+                method, target, headers, body = request
+                status, payload = await self.handle_request(method, target, headers, body)
+                # An oversized body is left unread, so the connection cannot be reused
+                keep_alive = (body is not None and self.accepting
+                              and headers.get('connection', '').lower() != 'close')
+                self._write_response(writer, status, payload, keep_alive)
+                await writer.drain()
+                self._busy.discard(task)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.discard(task)
+            self._busy.discard(task)
+            writer.close()
+
+    async def _read_request(self, reader):
+        try:
+            request_line = await reader.readline()
+        except ConnectionError:
+            return None
+        if not request_line.strip():
+            return None
+        parts = request_line.decode('latin-1').split(' ', 2)
+        if len(parts) != 3:
+            raise BadRequest('malformed request line')
+        method, target, _ = parts
+
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise BadRequest('invalid Content-Length')
+        if length < 0:
+            raise BadRequest('invalid Content-Length')
+        if length > MAX_BODY_SIZE:
+            return method, target, headers, None
+        body = await reader.readexactly(length) if length else b''
+        return method, target, headers, body
+
+    def _write_response(self, writer, status, payload, keep_alive):
+        body = payload.encode() if isinstance(payload, str) else payload
+        head = (
+            f"HTTP/1.1 {status} {_REASONS.get(status, '')}\r\n"
+            f"Content-Type: {self.content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+        )
+        writer.write(head.encode() + body)
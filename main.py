@@ -5,18 +5,41 @@ import sys
 import asyncio
 import threading
 import os
+import time
 import logging
+from datetime import datetime, timezone
 from dotenv import load_dotenv
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes
-from database import init_database, save_user, save_conversation, save_assessment, get_user_assessments
-from depression_detector import DepressionDetector, PHQ9_QUESTIONS
+from telegram import Update
+from telegram.ext import Application, CommandHandler, CallbackQueryHandler, ContextTypes, TypeHandler
+from database import (
+    init_database, close_database, save_user_async, save_conversation_async,
+    save_assessment_async, get_user_assessments_async, get_user_trend_async,
+    schedule_reminder_async, submit_read, submit_write
+)
+from depression_detector import CRISIS_SEVERITIES, DepressionDetector, RESPONSE_OPTIONS, SEVERITY_MODE
+from questionnaires import ASSESSMENT_FLOW, FLOWS, QUESTIONNAIRES, advance
+from reminders import REMINDER_DAYS, ReminderScheduler
+from responses import Response, escape
+import screens
+from session_store import AssessmentSession, InvalidCallback, create_session_store
+from dispatch import UPDATE_CONCURRENCY, PerUserUpdateProcessor
+import backup
+import outbound
+from outbound import OUTBOUND_RATE_LIMIT, OutboundScheduler
+import metrics
+from metrics import HANDLER_SECONDS, METRICS_PORT, timed
+import update_log
+from update_log import UPDATE_LOG
 
 if sys.platform.startswith('win'):
     asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
 
 load_dotenv()
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
+# 'polling' or 'webhook' (see webhook.py)
+BOT_MODE = os.getenv('BOT_MODE', 'polling')
+# Alternative Bot API endpoint, e.g. a local stand-in for offline testing
+BOT_API_URL = os.getenv('BOT_API_URL')
 
 logging.basicConfig(
     format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
@@ -24,7 +47,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
-init_database()
+# Cheap to construct: the model is loaded on first use, and the database is
+# opened in post_init, so importing this module does no training or DB work
 detector = DepressionDetector()
 
 (
@@ -32,301 +56,262 @@ detector = DepressionDetector()
     ASSESSMENT_RESULT, SUPPORT, END
 ) = range(7)
 
-user_assessments = {}
+sessions = create_session_store()
+metrics.gauge('mindcare_active_sessions', 'Assessments in progress', lambda: len(sessions))
+
+# Started in post_init when REMINDER_DAYS is set
+reminder_scheduler = None
+metrics.gauge('mindcare_reminders_pending', 'Reminders read for the current window and not sent yet',
+              lambda: reminder_scheduler.pending if reminder_scheduler is not None else 0)
+
+# Result message; everything but the score is filled in (escaped) per
+# result and {score} stays a parameter, so stored logs share the template
+RESULT_TEMPLATE = """
+📊 Assessment Results
+
+{color} {measure}: {severity}
+📈 {title} Score: {{score}}/{max_score}
+
+💭 Analysis:
+{analysis}
+
+📌 Next Steps:
+1. Save these results for your records
+2. If severe, contact a professional immediately
+3. Practice self-care daily
+4. Retake assessment in 2 weeks
+"""
 
 
 # ============================================
 # Handler Functions
 # ============================================
 
+@timed(HANDLER_SECONDS, profile=True)
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    print('Handler triggered!')
     """Handle /start command"""
     logger.info(f"Start command from user: {update.effective_user.id}")
     user = update.effective_user
-    save_user(user.id, user.username, user.first_name, user.last_name)
+    await save_user_async(user.id, user.username, user.first_name, user.last_name)
     
-    welcome_message = f"""
-👋 Welcome to MindCare Bot, {user.first_name}!
-
-I'm here to help you understand your mental health through a scientifically-backed assessment.
-
-This chatbot can:
-✅ Conduct a depression screening (PHQ-9)
-✅ Provide personalized insights
-✅ Suggest helpful resources
-✅ Maintain confidential records
-
-⚠️ Important: This bot is NOT a substitute for professional medical advice.
-Always consult a mental health professional for diagnosis and treatment.
-
-What would you like to do?
-"""
-    keyboard = [
-        [InlineKeyboardButton("📋 Start Assessment", callback_data='start_assessment')],
-        [InlineKeyboardButton("📊 View Previous Results", callback_data='view_results')],
-        [InlineKeyboardButton("❓ Help & Resources", callback_data='resources')],
-        [InlineKeyboardButton("🚪 Exit", callback_data='exit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(welcome_message, reply_markup=reply_markup)
+    screen = screens.welcome(user.first_name)
+    await update.message.reply_text(screen.text, reply_markup=screen.reply_markup)
     return MENU
 
 
+@timed(HANDLER_SECONDS)
 async def show_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Display main menu"""
     logger.info(f"Show menu for user: {update.effective_user.id}")
     query = update.callback_query
     await query.answer()
     
-    menu_message = """
-📋 MindCare Main Menu
-
-What would you like to do today?
-"""
-    keyboard = [
-        [InlineKeyboardButton("📋 Start Assessment", callback_data='start_assessment')],
-        [InlineKeyboardButton("📊 View Previous Results", callback_data='view_results')],
-        [InlineKeyboardButton("❓ Help & Resources", callback_data='resources')],
-        [InlineKeyboardButton("🚪 Exit", callback_data='exit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    await query.edit_message_text(menu_message, reply_markup=reply_markup)
+    await query.edit_message_text(screens.MENU.text, reply_markup=screens.MENU.reply_markup)
     return MENU
 
 
-async def start_assessment(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Start PHQ-9 assessment"""
-    logger.info(f"Start assessment for user: {update.effective_user.id}")
+@timed(HANDLER_SECONDS)
+async def start_assessment(update: Update, context: ContextTypes.DEFAULT_TYPE, flow=ASSESSMENT_FLOW):
+    """Start an assessment with the given flow (see questionnaires.py)"""
+    logger.info(f"Start {flow} assessment for user: {update.effective_user.id}")
     query = update.callback_query
     await query.answer()
     user_id = update.effective_user.id
     
-    user_assessments[user_id] = {'current_question': 0, 'answers': [], 'user_id': user_id}
+    assessment = AssessmentSession(user_id, flow=flow)
+    await sessions.save(assessment)
     
-    instruction = """
-🧠 Depression Screening Assessment (PHQ-9)
-
-You'll answer 9 questions about how you've been feeling over the past 2 weeks.
-
-For each question, choose:
-• 😊 Not at all (0)
-• 😔 Several days (1)
-• 😞 More than half the days (2)
-• 😢 Nearly every day (3)
-
-Your responses are confidential and saved securely.
-
-Let's begin! 👇
-"""
-    await query.edit_message_text(instruction)
+    await query.edit_message_text(screens.INSTRUCTIONS[flow].text)
     await asyncio.sleep(0.5)
-    await ask_phq9_question(update, context)
+    await ask_question(update, context, assessment)
     return ASKING_QUESTION
 
 
-async def ask_phq9_question(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Ask the next PHQ-9 question"""
+async def start_anxiety_assessment(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Start GAD-7 assessment"""
+    return await start_assessment(update, context, 'gad7')
+
+
+async def ask_question(update: Update, context: ContextTypes.DEFAULT_TYPE, assessment=None):
+    """Ask the next question of the session's flow, or show the result once it is done"""
     user_id = update.effective_user.id
     
-    if user_id not in user_assessments:
-        user_assessments[user_id] = {'current_question': 0, 'answers': []}
-    
-    assessment = user_assessments[user_id]
-    question_idx = assessment['current_question']
+    if assessment is None:
+        assessment = await sessions.get(user_id)
+    if assessment is None:
+        assessment = AssessmentSession(user_id, flow=ASSESSMENT_FLOW)
+        await sessions.save(assessment)
     
-    if question_idx >= len(PHQ9_QUESTIONS):
-        await show_assessment_result(update, context)
+    step = advance(FLOWS[assessment.flow], assessment.answer_list())
+    if step.item is None:
+        await show_assessment_result(update, context, assessment, step)
         return ASSESSMENT_RESULT
     
-    question = PHQ9_QUESTIONS[question_idx]
-    
-    keyboard = [
-        [InlineKeyboardButton("😊 Not at all", callback_data='answer_0')],
-        [InlineKeyboardButton("😔 Several days", callback_data='answer_1')],
-        [InlineKeyboardButton("😞 More than half", callback_data='answer_2')],
-        [InlineKeyboardButton("😢 Nearly every day", callback_data='answer_3')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    progress = f"Question {question_idx + 1}/9"
-    message_text = f"{progress}\n\n{question}"
+    message_text, reply_markup = screens.QUESTIONS[assessment.flow, step.number, step.item]
+    if sessions.stateless:
+        # Each button carries the session so far plus its own answer
+        reply_markup = screens.build_answer_keyboard(
+            [sessions.encode(assessment, value) for value in RESPONSE_OPTIONS.values()]
+        )
     
     query = update.callback_query
-    if query:
-        try:
-            await query.edit_message_text(message_text, reply_markup=reply_markup)
-        except Exception as e:
-            logger.error(f"Error editing message: {e}")
-            await query.message.reply_text(message_text, reply_markup=reply_markup)
+    if query and outbound.is_scheduled(context.bot):
+        # Don't hold up the user's next tap while the edit waits for its
+        # turn; the scheduler drops it if a newer edit of the message follows
+        context.application.create_task(_show_question(query, message_text, reply_markup), update)
+    elif query:
+        await _show_question(query, message_text, reply_markup)
     else:
         await update.message.reply_text(message_text, reply_markup=reply_markup)
+    return ASKING_QUESTION
+
+
+async def _show_question(query, message_text, reply_markup):
+    try:
+        await query.edit_message_text(message_text, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"Error editing message: {e}")
+        await query.message.reply_text(message_text, reply_markup=reply_markup)
 
 
+@timed(HANDLER_SECONDS)
 async def handle_answer(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handle answer to PHQ-9 question"""
+    """Handle answer to a questionnaire question"""
     query = update.callback_query
-    await query.answer()
-    
     user_id = update.effective_user.id
     data = query.data
     
-    if user_id not in user_assessments:
-        await query.edit_message_text("Session expired. Please start again with /start")
-        return MENU
-    
-    try:
-        answer_value = int(data.split('_')[1])
-    except (IndexError, ValueError):
-        logger.error(f"Invalid answer data: {data}")
-        await query.edit_message_text("Invalid answer. Please try again.")
-        return ASKING_QUESTION
-    
-    user_assessments[user_id]['answers'].append(answer_value)
-    user_assessments[user_id]['current_question'] += 1
-    
-    if user_assessments[user_id]['current_question'] < len(PHQ9_QUESTIONS):
-        await ask_phq9_question(update, context)
-        return ASKING_QUESTION
+    if sessions.stateless:
+        await query.answer()
+        try:
+            assessment = sessions.decode(user_id, data)
+        except InvalidCallback as e:
+            logger.warning(f"Rejected answer data from user {user_id}: {e}")
+            await query.edit_message_text("Session expired. Please start again with /start")
+            return MENU
     else:
-        await show_assessment_result(update, context)
-        return ASSESSMENT_RESULT
+        assessment = await sessions.get(user_id)
+        if assessment is None:
+            # Most often a second tap on the last answer, whose result has
+            # replaced the question: say so without overwriting the result
+            await query.answer("Session expired. Please start again with /start")
+            return MENU
+        await query.answer()
+        if advance(FLOWS[assessment.flow], assessment.answer_list()).item is None:
+            # A repeated tap after the last question
+            return ASSESSMENT_RESULT
+        
+        try:
+            recorded = await sessions.record_answer(assessment, int(data.split('_')[1]))
+        except (IndexError, ValueError):
+            logger.error(f"Invalid answer data: {data}")
+            await query.edit_message_text("Invalid answer. Please try again.")
+            return ASKING_QUESTION
+        if not recorded:
+            # Another worker took a concurrent tap on this question first
+            return ASKING_QUESTION
+    
+    return await ask_question(update, context, assessment)
 
 
-async def show_assessment_result(update: Update, context: ContextTypes.DEFAULT_TYPE):
+@timed(HANDLER_SECONDS)
+async def show_assessment_result(update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 assessment=None, step=None):
     """Calculate and display assessment results"""
     query = update.callback_query
     user_id = update.effective_user.id
     
     logger.info(f"Show assessment result for user: {user_id}")
     
-    if user_id not in user_assessments:
+    if assessment is None:
+        assessment = await sessions.get(user_id)
+    if assessment is None:
         await query.edit_message_text("Session expired.")
         return MENU
     
-    assessment = user_assessments[user_id]
-    answers = assessment['answers']
+    step = step or advance(FLOWS[assessment.flow], assessment.answer_list())
+    questionnaire = step.questionnaire
+    answers = step.answers
     
-    phq9_score = sum(answers)
-    result = detector.classify_score(phq9_score)
+    score = questionnaire.score(answers)
+    if questionnaire.key == 'phq9':
+        result = detector.classify_answers(answers)
+        therapeutic_response = detector.get_therapeutic_response(result)
+        crisis = result['severity'] in CRISIS_SEVERITIES
+    else:
+        result = questionnaire.classify(score)
+        therapeutic_response = result['response']
+        crisis = result['crisis']
     severity = result['severity']
     
-    save_assessment(user_id, phq9_score, severity, answers)
-    therapeutic_response = detector.get_therapeutic_response(result)
-    
-    result_message = f"""
-📊 Assessment Results
-
-{result['color']} Depression Severity: {severity}
-📈 PHQ-9 Score: {phq9_score}/27
-
-💭 Analysis:
-{therapeutic_response}
-
-📌 Next Steps:
-1. Save these results for your records
-2. If severe, contact a professional immediately
-3. Practice self-care daily
-4. Retake assessment in 2 weeks
-"""
-    keyboard = [
-        [InlineKeyboardButton("💪 Self-Care Tips", callback_data='self_care')],
-        [InlineKeyboardButton("📚 Resources", callback_data='resources')],
-        [InlineKeyboardButton("↩️ Main Menu", callback_data='menu')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(result_message, reply_markup=reply_markup)
-    save_conversation(user_id, "Assessment completed", result_message)
-
-
+    await save_assessment_async(user_id, score, severity, answers, durable=True,
+                                questionnaire=questionnaire.key, submission_key=assessment.submission_key())
+    await sessions.delete(user_id)
+    if REMINDER_DAYS:
+        # Replaces the reminder from the user's previous assessment
+        await schedule_reminder_async(user_id, query.message.chat_id,
+                                      screens.REMINDER_ACTIONS[questionnaire.key],
+                                      time.time() + REMINDER_DAYS * 86400)
+    
+    # One stored template per questionnaire and severity, the score is the only parameter
+    response = Response(RESULT_TEMPLATE.format(
+        color=escape(result['color']), measure=escape(questionnaire.measure), severity=escape(severity),
+        title=escape(questionnaire.title), max_score=questionnaire.max_score,
+        analysis=escape(therapeutic_response)
+    ), {'score': score})
+    # Results pointing to crisis services go out ahead of everything else
+    priority = outbound.CRISIS if crisis else outbound.INTERACTIVE
+    await context.bot.edit_message_text(
+        response.text, chat_id=query.message.chat_id, message_id=query.message.message_id,
+        reply_markup=screens.RESULT_KEYBOARD, **outbound.priority_kwargs(context.bot, priority)
+    )
+    await save_conversation_async(user_id, "Assessment completed", response)
+
+
+@timed(HANDLER_SECONDS)
 async def show_resources(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show mental health resources"""
     logger.info(f"Show resources for user: {update.effective_user.id}")
     query = update.callback_query
     await query.answer()
     
-    resources_message = """
-📚 Mental Health Resources
-
-🌍 Global Resources:
-• SAMHSA National Helpline: 1-800-662-4357
-• International Association for Suicide Prevention: https://www.iasp.info/resources/Crisis_Centres/
+    await query.edit_message_text(screens.RESOURCES.text, reply_markup=screens.RESOURCES.reply_markup)
 
-🇺🇸 US-Specific:
-• 988 Suicide & Crisis Lifeline: Call or text 988
-• Crisis Text Line: Text HOME to 741741
-• NAMI Helpline: 1-800-950-6264
-
-💻 Online Resources:
-• Mind.org.uk - Mental health information
-• ADAA.org - Anxiety & Depression Association
-• BetterHelp.com - Online therapy
-• Headspace - Meditation app
-
-⚠️ Emergency: If in immediate danger, call 911 or go to nearest ER
-
-Remember: Seeking help is a sign of strength, not weakness. 💪
-"""
-    keyboard = [
-        [InlineKeyboardButton("↩️ Main Menu", callback_data='menu')],
-        [InlineKeyboardButton("🚪 Exit", callback_data='exit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
-    
-    await query.edit_message_text(resources_message, reply_markup=reply_markup)
 
 
+@timed(HANDLER_SECONDS)
 async def show_self_care(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Show self-care tips"""
     logger.info(f"Show self-care for user: {update.effective_user.id}")
     query = update.callback_query
     await query.answer()
     
-    self_care_message = """
-💪 Self-Care Tips for Mental Health
-
-🛏️ Sleep:
-• Maintain regular sleep schedule (7-9 hours)
-• Avoid screens 1 hour before bed
-• Keep bedroom cool and dark
-
-🏃 Exercise:
-• 30 minutes daily activity
-• Walking, yoga, dancing all help
-• Releases mood-boosting endorphins
-
-🍎 Nutrition:
-• Eat regular, balanced meals
-• Stay hydrated
-• Limit caffeine and alcohol
-
-👥 Social Connection:
-• Reach out to friends/family
-• Join support groups
-• Volunteer in community
-
-🧘 Mindfulness:
-• Meditation: 5-10 minutes daily
-• Deep breathing exercises
-• Journaling thoughts and feelings
-
-🎯 Structure:
-• Set daily goals
-• Maintain routine
-• Break tasks into small steps
-
-Remember: Self-care isn't selfish. You deserve this support! ❤️
-"""
-    keyboard = [
-        [InlineKeyboardButton("↩️ Main Menu", callback_data='menu')],
-        [InlineKeyboardButton("🚪 Exit", callback_data='exit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    await query.edit_message_text(screens.SELF_CARE.text, reply_markup=screens.SELF_CARE.reply_markup)
+
+
+
+def format_trend(trend, now=None):
+    """Trend summary from the stored per-user state (see trends.py)"""
+    now = now or datetime.now(timezone.utc)
+    last = datetime.fromisoformat(str(trend.last_assessed)).replace(tzinfo=timezone.utc)
+    days = max((now - last).days, 0)
+    since = "today" if days == 0 else f"{days} day{'s' if days != 1 else ''} ago"
     
-    await query.edit_message_text(self_care_message, reply_markup=reply_markup)
+    message = "📈 Your Trend:\n\n"
+    message += f"Last score: {trend.last_score}/27 ({since})\n"
+    if trend.delta is None:
+        message += "Change: first assessment\n"
+    elif trend.delta < 0:
+        message += f"Change: ⬇️ {-trend.delta} points lower than before - improving\n"
+    elif trend.delta > 0:
+        message += f"Change: ⬆️ {trend.delta} points higher than before\n"
+    else:
+        message += "Change: same as before\n"
+    message += f"Weighted average: {trend.ewma:.1f}/27 over {trend.count} assessment{'s' if trend.count != 1 else ''}\n\n"
+    return message
 
 
+@timed(HANDLER_SECONDS)
 async def view_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """View previous assessment results"""
     logger.info(f"View results for user: {update.effective_user.id}")
@@ -334,61 +319,144 @@ async def view_results(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await query.answer()
     user_id = update.effective_user.id
     
-    assessments = get_user_assessments(user_id)
+    trend, assessments = await asyncio.gather(
+        get_user_trend_async(user_id), get_user_assessments_async(user_id, limit=5)
+    )
     
     if not assessments:
         message = "📊 No previous assessments found.\n\nStart your first assessment to get results!"
     else:
-        message = "📊 Your Assessment History:\n\n"
-        for i, (score, severity, date) in enumerate(assessments[:5], 1):
-            message += f"{i}. {date}\n   Score: {score}/27 - {severity}\n\n"
-    
-    keyboard = [
-        [InlineKeyboardButton("↩️ Main Menu", callback_data='menu')],
-        [InlineKeyboardButton("🚪 Exit", callback_data='exit')]
-    ]
-    reply_markup = InlineKeyboardMarkup(keyboard)
+        message = format_trend(trend) if trend else ""
+        message += "📊 Your Assessment History:\n\n"
+        for i, (score, severity, date, questionnaire) in enumerate(assessments, 1):
+            questionnaire = QUESTIONNAIRES[questionnaire]
+            message += (f"{i}. {date}\n   {questionnaire.title} Score: "
+                        f"{score}/{questionnaire.max_score} - {severity}\n\n")
     
-    await query.edit_message_text(message, reply_markup=reply_markup)
+    await query.edit_message_text(message, reply_markup=screens.BACK_KEYBOARD)
+
+
+async def exit_bot(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Say goodbye"""
+    await update.callback_query.edit_message_text(screens.EXIT.text)
+
+
+# callback_data -> (handler, conversation state returned after it)
+CALLBACKS = {
+    'menu': (show_menu, MENU),
+    'start_assessment': (start_assessment, ASKING_QUESTION),
+    'start_gad7': (start_anxiety_assessment, ASKING_QUESTION),
+    'resources': (show_resources, None),
+    'self_care': (show_self_care, None),
+    'view_results': (view_results, None),
+    'exit': (exit_bot, END),
+}
+CALLBACKS.update({
+    f'answer_{value}': (handle_answer, ASKING_QUESTION) for value in RESPONSE_OPTIONS.values()
+})
 
 
+@timed(HANDLER_SECONDS, profile=True)
 async def button_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Handle all button callbacks"""
     query = update.callback_query
     
+    route = CALLBACKS.get(query.data)
+    if route is None and sessions.stateless and query.data.startswith(sessions.PREFIX):
+        route = (handle_answer, ASKING_QUESTION)
+    if route is None:
+        return None
+    handler, state = route
     try:
-        if query.data == 'menu':
-            await show_menu(update, context)
-            return MENU
-        elif query.data == 'start_assessment':
-            await start_assessment(update, context)
-            return ASKING_QUESTION
-        elif query.data == 'resources':
-            await show_resources(update, context)
-        elif query.data == 'self_care':
-            await show_self_care(update, context)
-        elif query.data == 'view_results':
-            await view_results(update, context)
-        elif query.data.startswith('answer_'):
-            await handle_answer(update, context)
-            return ASKING_QUESTION
-        elif query.data == 'exit':
-            await query.edit_message_text("👋 Thank you for using MindCare Bot. Take care of yourself!")
-            return END
+        await handler(update, context)
+        return state
     except Exception as e:
         logger.error(f"Error in button callback: {e}")
         await query.answer("An error occurred. Please try again.")
 
 
-
 # ============================================
 # Entry Point with Event Loop Handling
 # ============================================
 
-if __name__ == '__main__':
-    app = Application.builder().token(TOKEN).build()
+async def _post_init(application: Application):
+    """Open the database and start reminders and backups once the application starts"""
+    global reminder_scheduler
+    # Set on each of several webhook workers, see webhook.run
+    worker = application.bot_data.get('webhook_worker')
+    if worker is None:
+        init_database()
+    else:
+        init_database(backfill=False, apply_migrations=False)
+    if SEVERITY_MODE == 'model':
+        # Load the lookup table now rather than in the first result handler
+        detector.severity_table
+    if REMINDER_DAYS:
+        reminder_scheduler = ReminderScheduler(application.bot, submit_read, submit_write)
+        reminder_scheduler.start()
+    backup.start()
+    if worker is None:
+        await metrics.start()
+    else:
+        # Each worker has its own metrics
+        await metrics.start(port=METRICS_PORT + worker if METRICS_PORT else 0)
+
+
+async def _post_shutdown(application: Application):
+    """Flush pending writes and close pooled connections on shutdown"""
+    global reminder_scheduler
+    await metrics.stop()
+    if reminder_scheduler is not None:
+        await reminder_scheduler.stop()
+        reminder_scheduler = None
+    await backup.stop()
+    update_log.close()
+    close_database()
+
+
+def build_application(token=TOKEN, webhook=False, base_url=BOT_API_URL,
+                      concurrency=UPDATE_CONCURRENCY, rate_limit=OUTBOUND_RATE_LIMIT):
+    """Build the bot application with all handlers registered"""
+    builder = (
+        Application.builder()
+        .token(token)
+        .post_init(_post_init)
+        .post_shutdown(_post_shutdown)
+    )
+    if concurrency > 1:
+        # Different users in parallel, each user's updates in order
+        processor = PerUserUpdateProcessor(concurrency)
+        builder = builder.concurrent_updates(processor).update_queue(processor.update_queue)
+        metrics.gauge('mindcare_updates_pending', 'Updates taken off the queue and not yet finished',
+                      lambda: processor.pending)
+    if rate_limit:
+        scheduler = OutboundScheduler()
+        builder = builder.rate_limiter(scheduler)
+        metrics.gauge('mindcare_outbound_waiting', 'Bot API requests waiting for a rate limit token',
+                      lambda: scheduler.waiting)
+    if base_url:
+        builder = builder.base_url(base_url)
+    if webhook:
+        # Updates are pushed by webhook.WebhookServer instead of an Updater
+        builder = builder.updater(None)
+    app = builder.build()
     
     # Add handlers
+    if UPDATE_LOG:
+        # Ahead of the other handlers, see update_log.py
+        app.add_handler(TypeHandler(Update, update_log.record), group=-1)
     app.add_handler(CommandHandler("start", start))
     app.add_handler(CallbackQueryHandler(button_callback))
-    app.run_polling()
\ No newline at end of file
+    return app
+
+
+if __name__ == '__main__':
+    # webhook workers `import main`; without this that would run this file
+    # a second time, with its own session store and gauges
+    sys.modules.setdefault('main', sys.modules[__name__])
+    if BOT_MODE == 'webhook':
+        import webhook
+        webhook.run()
+    else:
+        app = build_application()
+        app.run_polling()
@@ -0,0 +1,298 @@
+"""
+Lightweight metrics for handlers and database calls
+
+Histograms, counters and gauges rendered in the Prometheus text format.
+Nothing is measured unless METRICS_ENABLED is set: timed() then returns the
+function unchanged, so the disabled cost is zero.
+
+The metrics are served at /metrics by the webhook server, on METRICS_PORT
+in polling mode, and/or logged every METRICS_DUMP_INTERVAL seconds.  With
+SLOW_UPDATE_MS set, a sampling profiler records the event loop thread's
+stack while updates are in flight and logs where the time went for every
+update slower than the threshold.
+"""
+import asyncio
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter as _Tally, deque
+
+from http_server import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', '').lower() in ('1', 'true', 'yes')
+# Standalone /metrics server for polling mode, 0 to disable
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+# Log the metrics every this many seconds, 0 to disable
+METRICS_DUMP_INTERVAL = float(os.getenv('METRICS_DUMP_INTERVAL', '0'))
+# Profile updates slower than this, 0 to disable
+SLOW_UPDATE_MS = float(os.getenv('SLOW_UPDATE_MS', '0'))
+PROFILE_INTERVAL_MS = float(os.getenv('PROFILE_INTERVAL_MS', '5'))
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_registry = []
+
+
+class Histogram:
+    """Latency histogram with one series per label value"""
+
+    def __init__(self, name, help, label, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label value -> [bucket counts..., +Inf count, sum]
+        self._series = {}
+        _registry.append(self)
+
+    def observe(self, label_value, seconds):
+        index = bisect_left(self.buckets, seconds)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 1) + [0.0]
+            series[index] += 1
+            series[-1] += seconds
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {value: list(counts) for value, counts in self._series.items()}
+        for value, counts in sorted(series.items()):
+            label = f'{self.label}="{value}"'
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f"{self.name}_sum{{{label}}} {counts[-1]:.6f}")
+            lines.append(f"{self.name}_count{{{label}}} {cumulative}")
+        return lines
+
+
+class Counter:
+
+    def __init__(self, name, help):
+        self.name = name
+        self.help = help
+        self.value = 0
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render(self):
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter",
+                f"{self.name} {self.value}"]
+
+
+class Gauge:
+    """Value read from a callback when the metrics are rendered"""
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+        _registry.append(self)
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception as e:
+            logger.error(f"Cannot read gauge {self.name}: {e}")
+            return []
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge",
+                f"{self.name} {value}"]
+
+
+def gauge(name, help, read):
+    """
+    Register a gauge; read() is only called while rendering
+
+    Registering a name again replaces the earlier gauge, so building a
+    second application (or importing a module twice) exports one family.
+    """
+    if METRICS_ENABLED:
+        _registry[:] = [metric for metric in _registry if not (isinstance(metric, Gauge) and metric.name == name)]
+        Gauge(name, help, read)
+
+
+def render():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in _registry:
+        lines.extend(metric.render())
+    return '\n'.join(lines) + '\n'
+
+
+HANDLER_SECONDS = Histogram('mindcare_handler_seconds', 'Time spent in bot handlers', 'handler')
+DB_SECONDS = Histogram('mindcare_db_seconds', 'Time spent in database.py calls', 'function')
+SLOW_UPDATES = Counter('mindcare_slow_updates_total', 'Updates slower than SLOW_UPDATE_MS')
+
+
+# ============================================
+# Slow update profiler
+# ============================================
+
+def _collapsed_stack(frame, depth=40):
+    """Stack as 'file:function:line' entries, outermost first"""
+    entries = []
+    while frame is not None and len(entries) < depth:
+        code = frame.f_code
+        entries.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+        frame = frame.f_back
+    return ';'.join(reversed(entries))
+
+
+class SlowUpdateProfiler:
+    """
+    Samples the event loop thread's stack while updates are being handled
+
+    The sampler thread only runs while an update is in flight.  Samples show
+    where the loop thread was busy, so they point at work that blocks the
+    loop (CPU or synchronous IO) rather than at awaited network calls; with
+    concurrent updates the samples of overlapping updates are shared.
+    """
+
+    def __init__(self, threshold_ms=SLOW_UPDATE_MS, interval_ms=PROFILE_INTERVAL_MS, top=5):
+        self.threshold = threshold_ms / 1000
+        self.interval = interval_ms / 1000
+        self.top = top
+        self._active = {}
+        self._samples = deque(maxlen=20000)
+        self._wake = threading.Event()
+        self._target = None
+        self._thread = None
+
+    def begin(self):
+        if self._thread is None:
+            self._target = threading.get_ident()
+            self._thread = threading.Thread(target=self._run, name='slow-update-profiler', daemon=True)
+            self._thread.start()
+        token = object()
+        self._active[token] = time.monotonic()
+        self._wake.set()
+        return token
+
+    def end(self, token, label):
+        started = self._active.pop(token)
+        elapsed = time.monotonic() - started
+        if elapsed < self.threshold:
+            return
+        SLOW_UPDATES.inc()
+        stacks = _Tally(stack for at, stack in list(self._samples) if at >= started)
+        report = '\n'.join(f"  {count:4d} {stack}" for stack, count in stacks.most_common(self.top))
+        logger.warning(f"Slow update in {label}: {elapsed * 1000:.0f}ms, "
+                       f"{sum(stacks.values())} samples\n{report}")
+
+    def _run(self):
+        while True:
+            if not self._active:
+                self._wake.clear()
+                if not self._active:
+                    self._wake.wait()
+                continue
+            frame = sys._current_frames().get(self._target)
+            if frame is not None:
+                self._samples.append((time.monotonic(), _collapsed_stack(frame)))
+            del frame
+            time.sleep(self.interval)
+
+
+_profiler = SlowUpdateProfiler() if METRICS_ENABLED and SLOW_UPDATE_MS > 0 else None
+
+
+def timed(histogram, label=None, profile=False):
+    """
+    Record the duration of every call in histogram under label
+
+    profile=True marks a top-level update handler for the slow update
+    profiler.  Returns the function unchanged when metrics are disabled.
+    """
+    def decorate(fn):
+        if not METRICS_ENABLED:
+            return fn
+        name = label or fn.__name__
+        profiler = _profiler if profile else None
+
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def wrapper(*args, **kwargs):
+                token = profiler.begin() if profiler else None
+                started = time.perf_counter()
+                try:
+                    return await fn(*args, **kwargs)
+                finally:
+                    histogram.observe(name, time.perf_counter() - started)
+                    if token:
+                        profiler.end(token, name)
+        else:
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    histogram.observe(name, time.perf_counter() - started)
+        return wrapper
+    return decorate
+
+
+# ============================================
+# Exposition
+# ============================================
+
+class MetricsServer(HTTPServer):
+
+    content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+    async def handle_request(self, method, target, headers, body):
+        if target.split('?', 1)[0] != '/metrics':
+            return 404, 'not found'
+        return 200, await render_async()
+
+
+async def render_async():
+    # Gauges may query the database, keep that off the event loop
+    return await asyncio.get_running_loop().run_in_executor(None, render)
+
+
+_server = None
+_dump_task = None
+
+
+async def _dump(interval):
+    while True:
+        await asyncio.sleep(interval)
+        logger.info(f"Metrics:\n{await render_async()}")
+
+
+async def start(port=METRICS_PORT, dump_interval=METRICS_DUMP_INTERVAL):
+    """Start the standalone /metrics server and periodic dump, as configured"""
+    global _server, _dump_task
+    if not METRICS_ENABLED:
+        return
+    if port and _server is None:
+        _server = MetricsServer('0.0.0.0', port)
+        await _server.start()
+        logger.info(f"Metrics on http://0.0.0.0:{_server.port}/metrics")
+    if dump_interval and _dump_task is None:
+        _dump_task = asyncio.create_task(_dump(dump_interval))
+
+
+async def stop():
+    global _server, _dump_task
+    if _dump_task is not None:
+        _dump_task.cancel()
+        _dump_task = None
+    if _server is not None:
+        await _server.stop()
+        _server = None
@@ -0,0 +1,499 @@
+"""
+Versioned schema migrations for the bot database
+
+The schema version is kept in PRAGMA user_version.  Each migration runs once,
+in order, on the writer connection.  Migrations must be quick: work that has
+to touch every existing row is registered as a backfill instead, which runs
+in small chunks between live writes (see database.run_backfills) and records
+its progress in backfill_progress, so it resumes after a restart.
+
+Usage: python migrations.py [--status]
+"""
+import json
+
+import analytics
+import responses
+import search
+import trends
+from depression_detector import pack_answers, unpack_answers
+
+MIGRATIONS = []
+BACKFILLS = []
+
+
+def migration(version):
+    """Register a schema migration, applied when user_version < version"""
+    def register(fn):
+        MIGRATIONS.append((version, fn))
+        MIGRATIONS.sort(key=lambda m: m[0])
+        return fn
+    return register
+
+
+def backfill(name):
+    """
+    Register a chunked backfill
+
+    fn(conn, after_id, chunk_size) processes up to chunk_size rows with an id
+    above after_id and returns the last id it processed, or None once there
+    is nothing left.  It must not commit; run_backfill_chunk does that
+    together with the progress update.
+    """
+    def register(fn):
+        BACKFILLS.append((name, fn))
+        return fn
+    return register
+
+
+def schema_version(conn):
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+
+def migrate(conn):
+    """
+    Apply all pending migrations, returns the new schema version
+
+    Each migration runs in one BEGIN IMMEDIATE transaction together with
+    its user_version bump, and the version is read again once the write
+    lock is held: several processes starting on the same database apply
+    every migration exactly once, and one that fails halfway leaves no
+    partial schema changes behind.  The sqlite3 module would otherwise
+    commit around DDL on its own, so the connection is switched to manual
+    transactions meanwhile.
+    """
+    isolation_level = conn.isolation_level
+    conn.isolation_level = None
+    try:
+        current = schema_version(conn)
+        for version, fn in MIGRATIONS:
+            if version <= current:
+                continue
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                current = schema_version(conn)
+                if version > current:
+                    fn(conn)
+                    conn.execute(f'PRAGMA user_version = {version}')
+                    current = version
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+    finally:
+        conn.isolation_level = isolation_level
+    return current
+
+
+def run_backfill_chunk(conn, name, fn, chunk_size):
+    """Run one chunk of a backfill, returns False once it is complete"""
+    try:
+        row = conn.execute('''
+            SELECT last_id, done FROM backfill_progress WHERE name = ?
+        ''', (name,)).fetchone()
+        last_id, done = row if row else (0, 0)
+        if done:
+            return False
+
+        new_last_id = fn(conn, last_id, chunk_size)
+        conn.execute('''
+            INSERT OR REPLACE INTO backfill_progress (name, last_id, done)
+            VALUES (?, ?, ?)
+        ''', (name, last_id if new_last_id is None else new_last_id, int(new_last_id is None)))
+        conn.commit()
+        return new_last_id is not None
+    except Exception:
+        conn.rollback()
+        raise
+
+
+def decode_answers(answers_packed, answers_text=None):
+    """Answers of an assessment row, from the packed column or legacy text"""
+    if answers_packed:
+        return unpack_answers(answers_packed)
+    if answers_text:
+        # Legacy rows hold str(list), which is valid JSON for a list of ints
+        try:
+            return json.loads(answers_text)
+        except ValueError:
+            return []
+    return []
+
+
+# ============================================
+# Migrations
+# ============================================
+
+@migration(1)
+def create_base_schema(conn):
+    cursor = conn.cursor()
+
+    # Table 1: Users table
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            last_interaction TIMESTAMP
+        )
+    ''')
+
+    # Table 2: Assessment results
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS assessments (
+            assessment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            phq9_score INTEGER,
+            severity TEXT,
+            answers TEXT,
+            assessment_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Table 3: Conversation logs
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS conversations (
+            conversation_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            user_message TEXT,
+            bot_response TEXT,
+            message_timestamp TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users(user_id)
+        )
+    ''')
+
+    # Table 4: In-progress assessments (see session_store.py)
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS assessment_sessions (
+            user_id INTEGER PRIMARY KEY,
+            current_question INTEGER,
+            answers INTEGER,
+            updated_at REAL
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_assessment_sessions_updated
+        ON assessment_sessions (updated_at)
+    ''')
+
+
+@migration(2)
+def add_history_indexes(conn):
+    # Covers the history query: seek by user, walk the dates backwards and
+    # read score and severity straight from the index
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_assessments_user_date
+        ON assessments (user_id, assessment_date, phq9_score, severity)
+    ''')
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_conversations_user_time
+        ON conversations (user_id, message_timestamp)
+    ''')
+
+
+@migration(3)
+def add_packed_answers(conn):
+    # New rows store answers packed into an integer (see pack_answers) and
+    # leave the legacy text column NULL; old rows are converted by the
+    # pack_legacy_answers backfill
+    conn.execute('ALTER TABLE assessments ADD COLUMN answers_packed INTEGER')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS backfill_progress (
+            name TEXT PRIMARY KEY,
+            last_id INTEGER,
+            done INTEGER
+        )
+    ''')
+
+
+@migration(4)
+def add_analytics_rollups(conn):
+    # Maintained by analytics.update_rollups on every insert from now on;
+    # rows up to the current last id are counted by the analytics_rollups backfill
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS severity_daily (
+            day TEXT,
+            severity TEXT,
+            count INTEGER,
+            PRIMARY KEY (day, severity)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS question_totals (
+            question INTEGER PRIMARY KEY,
+            answered INTEGER,
+            score_sum INTEGER,
+            positive INTEGER
+        )
+    ''')
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS analytics_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO analytics_state (key, value)
+        SELECT 'backfill_until', COALESCE(MAX(assessment_id), 0) FROM assessments
+    ''')
+
+
+@migration(5)
+def add_response_templates(conn):
+    # Templated responses keep bot_response NULL and point to a shared
+    # template plus parameters (see responses.py); legacy text rows are
+    # converted by the template_legacy_responses backfill
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS response_templates (
+            template_id INTEGER PRIMARY KEY,
+            hash BLOB UNIQUE,
+            body BLOB
+        )
+    ''')
+    conn.execute('ALTER TABLE conversations ADD COLUMN response_template INTEGER REFERENCES response_templates(template_id)')
+    conn.execute('ALTER TABLE conversations ADD COLUMN response_params TEXT')
+
+
+@migration(6)
+def add_user_trends(conn):
+    # Maintained by trends.update_trend on every insert from now on; users
+    # with older history are filled in by the user_trends backfill
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS user_trends (
+            user_id INTEGER PRIMARY KEY,
+            count INTEGER,
+            last_score INTEGER,
+            delta INTEGER,
+            ewma REAL,
+            last_assessed TIMESTAMP
+        )
+    ''')
+
+
+@migration(7)
+def add_questionnaires(conn):
+    # Rows from before are all PHQ-9; sessions in progress are on the fixed flow
+    conn.execute("ALTER TABLE assessments ADD COLUMN questionnaire TEXT NOT NULL DEFAULT 'phq9'")
+    conn.execute("ALTER TABLE assessment_sessions ADD COLUMN flow TEXT NOT NULL DEFAULT 'phq9'")
+    # Keep the history query covered now that it also reads the questionnaire
+    conn.execute('''
+        CREATE INDEX IF NOT EXISTS idx_assessments_user_history
+        ON assessments (user_id, assessment_date, phq9_score, severity, questionnaire)
+    ''')
+    conn.execute('DROP INDEX IF EXISTS idx_assessments_user_date')
+
+
+@migration(8)
+def add_reminders(conn):
+    # One pending reminder per user and start action (see reminders.py); the
+    # scheduler only ever reads the next window off the due_at index
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS reminders (
+            user_id INTEGER,
+            action TEXT,
+            chat_id INTEGER,
+            due_at REAL NOT NULL,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, action)
+        )
+    ''')
+    conn.execute('CREATE INDEX IF NOT EXISTS idx_reminders_due ON reminders (due_at)')
+
+
+@migration(9)
+def add_conversation_search(conn):
+    # External content index over the rendered text (see search.py); new rows
+    # are indexed on insert, rows up to the current last id by the
+    # conversation_search backfill
+    conn.execute('''
+        CREATE VIEW IF NOT EXISTS conversation_text AS
+        SELECT conversation_id, user_message,
+               COALESCE(bot_response, render_response(response_templates.body, response_params)) AS bot_response
+        FROM conversations
+        LEFT JOIN response_templates ON template_id = response_template
+    ''')
+    conn.execute('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS conversations_fts USING fts5(
+            user_message, bot_response,
+            content='conversation_text', content_rowid='conversation_id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+    ''')
+    conn.execute("INSERT INTO conversations_fts (conversations_fts, rank) VALUES ('rank', 'bm25(2.0, 1.0)')")
+    conn.execute('''
+        CREATE TABLE IF NOT EXISTS search_state (
+            key TEXT PRIMARY KEY,
+            value INTEGER
+        )
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO search_state (key, value)
+        SELECT 'backfill_until', COALESCE(MAX(conversation_id), 0) FROM conversations
+    ''')
+
+
+
+@migration(10)
+def add_assessment_submission_keys(conn):
+    # Callback sessions save with a key per answer keyboard, so a repeated
+    # tap on the last question does not save the assessment twice
+    conn.execute('ALTER TABLE assessments ADD COLUMN submission_key TEXT')
+    conn.execute('''
+        CREATE UNIQUE INDEX IF NOT EXISTS idx_assessments_submission
+        ON assessments (user_id, submission_key) WHERE submission_key IS NOT NULL
+    ''')
+
+
+@migration(11)
+def key_rollups_by_questionnaire(conn):
+    # Severities and question means of different questionnaires were added
+    # up; the rollups are rebuilt keyed by questionnaire: new rows from now
+    # on, every existing row by the analytics_rollups backfill, run again
+    conn.execute('DROP TABLE IF EXISTS severity_daily')
+    conn.execute('DROP TABLE IF EXISTS question_totals')
+    conn.execute('''
+        CREATE TABLE severity_daily (
+            day TEXT,
+            questionnaire TEXT,
+            severity TEXT,
+            count INTEGER,
+            PRIMARY KEY (day, questionnaire, severity)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        CREATE TABLE question_totals (
+            questionnaire TEXT,
+            question INTEGER,
+            answered INTEGER,
+            score_sum INTEGER,
+            positive INTEGER,
+            PRIMARY KEY (questionnaire, question)
+        ) WITHOUT ROWID
+    ''')
+    conn.execute('''
+        INSERT OR REPLACE INTO analytics_state (key, value)
+        SELECT 'backfill_until', COALESCE(MAX(assessment_id), 0) FROM assessments
+    ''')
+    conn.execute("DELETE FROM backfill_progress WHERE name = 'analytics_rollups'")
+
+# ============================================
+# Backfills
+# ============================================
+
+@backfill('pack_legacy_answers')
+def pack_legacy_answers(conn, after_id, chunk_size):
+    rows = conn.execute('''
+        SELECT assessment_id, answers, answers_packed FROM assessments
+        WHERE assessment_id > ?
+        ORDER BY assessment_id
+        LIMIT ?
+    ''', (after_id, chunk_size)).fetchall()
+    if not rows:
+        return None
+
+    updates = []
+    for assessment_id, answers, answers_packed in rows:
+        if answers_packed is not None or answers is None:
+            continue
+        try:
+            updates.append((pack_answers(json.loads(answers)), None, assessment_id))
+        except (ValueError, TypeError) as e:
+            # 0 is never a valid packed value: it marks rows whose text is kept
+            print(f"Cannot pack answers of assessment {assessment_id}: {e}")
+            updates.append((0, answers, assessment_id))
+
+    conn.executemany('''
+        UPDATE assessments SET answers_packed = ?, answers = ?
+        WHERE assessment_id = ?
+    ''', updates)
+    return rows[-1][0]
+
+
+@backfill('analytics_rollups')
+def backfill_analytics_rollups(conn, after_id, chunk_size):
+    until = conn.execute(
+        "SELECT value FROM analytics_state WHERE key = 'backfill_until'"
+    ).fetchone()[0]
+    rows = conn.execute('''
+        SELECT assessment_id, date(assessment_date), questionnaire, severity, answers_packed, answers
+        FROM assessments
+        WHERE assessment_id > ? AND assessment_id <= ?
+        ORDER BY assessment_id
+        LIMIT ?
+    ''', (after_id, until, chunk_size)).fetchall()
+    if not rows:
+        return None
+    analytics.add_chunk(conn, [row[1:] for row in rows], decode_answers)
+    return rows[-1][0]
+
+
+@backfill('template_legacy_responses')
+def template_legacy_responses(conn, after_id, chunk_size):
+    rows = conn.execute('''
+        SELECT conversation_id, bot_response FROM conversations
+        WHERE conversation_id > ? AND response_template IS NULL
+        ORDER BY conversation_id
+        LIMIT ?
+    ''', (after_id, chunk_size)).fetchall()
+    if not rows:
+        return None
+
+    updates = []
+    for conversation_id, bot_response in rows:
+        response = responses.to_response(bot_response) if bot_response else None
+        if response is not None:
+            template_id = responses.store_template(conn, response.template)
+            updates.append((template_id, responses.encode_params(response.params), conversation_id))
+    conn.executemany('''
+        UPDATE conversations SET response_template = ?, response_params = ?, bot_response = NULL
+        WHERE conversation_id = ?
+    ''', updates)
+    return rows[-1][0]
+
+
+@backfill('user_trends')
+def backfill_user_trends(conn, after_id, chunk_size):
+    # Keyed by user_id rather than a row id: each user is rebuilt as a whole
+    user_ids = [row[0] for row in conn.execute('''
+        SELECT DISTINCT user_id FROM assessments
+        WHERE user_id > ?
+        ORDER BY user_id
+        LIMIT ?
+    ''', (after_id, chunk_size))]
+    if not user_ids:
+        return None
+    for user_id in user_ids:
+        # Users assessed since the migration already have an up to date row
+        if not conn.execute('SELECT 1 FROM user_trends WHERE user_id = ?', (user_id,)).fetchone():
+            trends.rebuild_trend(conn, user_id)
+    return user_ids[-1]
+
+
+
+@backfill('conversation_search')
+def backfill_conversation_search(conn, after_id, chunk_size):
+    # Bounded by the last id at migration time: later rows are already indexed
+    until = conn.execute(
+        "SELECT value FROM search_state WHERE key = 'backfill_until'"
+    ).fetchone()[0]
+    return search.index_chunk(conn, after_id, until, chunk_size)
+
+
+if __name__ == '__main__':
+    import argparse
+    import database
+
+    parser = argparse.ArgumentParser(description="Apply pending migrations and backfills")
+    parser.add_argument('--status', action='store_true', help="only print the schema version")
+    args = parser.parse_args()
+
+    if args.status:
+        version = database.submit_read(schema_version).result()
+        print(f"Schema version {version} of {MIGRATIONS[-1][0]}")
+    else:
+        database.init_database(backfill=False)
+        database.run_backfills()
+        print(f"Schema version {MIGRATIONS[-1][0]}, backfills complete")
+    database.close_database()
@@ -0,0 +1,236 @@
+"""
+Outbound request scheduler for the Bot API
+
+Installed as the bot's rate limiter (see main.build_application), so every
+request made through the bot passes through it:
+
+- token buckets for Telegram's global and per-chat message limits; waiting
+  requests are granted in priority order, crisis results first
+- RetryAfter (HTTP 429) pauses all sending for the advised time, then the
+  request is retried up to OUTBOUND_MAX_RETRIES times
+- edits of the same message are sent one at a time, and an edit that is
+  still waiting when a newer edit of that message arrives is dropped
+
+Pass a priority with rate_limit_args, e.g. via priority_kwargs(bot, CRISIS).
+"""
+import asyncio
+import heapq
+import itertools
+import logging
+import os
+import time
+from datetime import timedelta
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+logger = logging.getLogger(__name__)
+
+OUTBOUND_RATE_LIMIT = os.getenv('OUTBOUND_RATE_LIMIT', '1').lower() in ('1', 'true', 'yes')
+# Telegram allows about 30 messages per second overall and about one per
+# second in a chat, with short bursts
+OUTBOUND_GLOBAL_RATE = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+OUTBOUND_CHAT_RATE = float(os.getenv('OUTBOUND_CHAT_RATE', '1'))
+OUTBOUND_CHAT_BURST = int(os.getenv('OUTBOUND_CHAT_BURST', '3'))
+OUTBOUND_MAX_RETRIES = int(os.getenv('OUTBOUND_MAX_RETRIES', '3'))
+
+# Lower goes first
+CRISIS = 0
+INTERACTIVE = 1
+BULK = 2
+
+# Edits where only the latest version of a message matters
+COALESCED_ENDPOINTS = frozenset({'editMessageText', 'editMessageReplyMarkup'})
+
+
+def _seconds(value):
+    return value.total_seconds() if isinstance(value, timedelta) else float(value)
+
+
+class TokenBucket:
+    """Token bucket whose waiters are served by priority, then arrival"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self._waiters = []
+        self._seq = itertools.count()
+        self._pump_task = None
+
+    @property
+    def waiting(self):
+        return len(self._waiters)
+
+    @property
+    def idle(self):
+        self._refill()
+        return not self._waiters and self.tokens >= self.burst
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return now
+
+    async def acquire(self, priority=INTERACTIVE):
+        now = self._refill()
+        if not self._waiters and now >= self.paused_until and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._start_pump()
+        await future
+
+    def give_back(self):
+        """Return a token that was acquired but not used"""
+        self._refill()
+        self.tokens = min(self.burst, self.tokens + 1)
+        if self._waiters:
+            self._start_pump()
+
+    def pause(self, seconds):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def _start_pump(self):
+        if self._pump_task is None or self._pump_task.done():
+            self._pump_task = asyncio.create_task(self._pump())
+
+    async def _pump(self):
+        while self._waiters:
+            now = self._refill()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            if self.tokens < 1:
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+
+class _EditSlot:
+    __slots__ = ('lock', 'latest', 'refs')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.latest = None
+        self.refs = 0
+
+
+class OutboundScheduler(BaseRateLimiter):
+
+    def __init__(self, global_rate=OUTBOUND_GLOBAL_RATE, chat_rate=OUTBOUND_CHAT_RATE,
+                 chat_burst=OUTBOUND_CHAT_BURST, max_retries=OUTBOUND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, max(1, int(global_rate)))
+        self._chats = {}
+        self._edits = {}
+        self._acquired = 0
+
+        self.sent = 0
+        self.coalesced = 0
+        self.retries = 0
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    @property
+    def waiting(self):
+        return self._global.waiting + sum(bucket.waiting for bucket in self._chats.values())
+
+    def stats(self):
+        return {
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'retries': self.retries,
+            'waiting': self.waiting,
+            'chats': len(self._chats),
+        }
+
+    def _chat_bucket(self, chat_id):
+        self._acquired += 1
+        if self._acquired % 1000 == 0:
+            # Buckets that are full again hold no state worth keeping
+            self._chats = {key: bucket for key, bucket in self._chats.items() if not bucket.idle}
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = INTERACTIVE if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        if chat_id is None:
+            # Not a message (answerCallbackQuery, getMe, ...): only handle 429s
+            return await self._send(callback, args, kwargs, priority)
+
+        message_id = data.get('message_id')
+        if endpoint not in COALESCED_ENDPOINTS or message_id is None:
+            await self._chat_bucket(chat_id).acquire(priority)
+            await self._global.acquire(priority)
+            return await self._send(callback, args, kwargs, priority)
+        return await self._edit(callback, args, kwargs, priority, chat_id, message_id)
+
+    async def _edit(self, callback, args, kwargs, priority, chat_id, message_id):
+        key = (chat_id, message_id)
+        slot = self._edits.get(key)
+        if slot is None:
+            slot = self._edits[key] = _EditSlot()
+        token = object()
+        slot.latest = token
+        slot.refs += 1
+        try:
+            chat_bucket = self._chat_bucket(chat_id)
+            await chat_bucket.acquire(priority)
+            if slot.latest is not token:
+                chat_bucket.give_back()
+                self.coalesced += 1
+                return True
+            await self._global.acquire(priority)
+            async with slot.lock:
+                if slot.latest is not token:
+                    chat_bucket.give_back()
+                    self._global.give_back()
+                    self.coalesced += 1
+                    return True
+                return await self._send(callback, args, kwargs, priority)
+        finally:
+            slot.refs -= 1
+            if not slot.refs:
+                del self._edits[key]
+
+    async def _send(self, callback, args, kwargs, priority):
+        for attempt in itertools.count():
+            try:
+                result = await callback(*args, **kwargs)
+                self.sent += 1
+                return result
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                delay = _seconds(e.retry_after)
+                logger.warning(f"Flood limit hit, pausing outbound requests for {delay:.1f}s")
+                self.retries += 1
+                self._global.pause(delay)
+                await asyncio.sleep(delay)
+
+
+def is_scheduled(bot):
+    """Whether the bot's requests go through an OutboundScheduler"""
+    return isinstance(getattr(bot, 'rate_limiter', None), OutboundScheduler)
+
+
+def priority_kwargs(bot, priority):
+    """rate_limit_args for a bot call, empty when no scheduler is installed"""
+    return {'rate_limit_args': priority} if is_scheduled(bot) else {}
@@ -0,0 +1,255 @@
+"""
+Declarative questionnaires and the flows that ask them
+
+A Questionnaire is what gets scored and saved: its items, which of them
+count towards the score, and its severity bands.  A Flow is how items are
+asked, written as blocks (Ask, When, StopIf) and compiled once at import
+into a flat program of ask / jump / stop instructions.
+
+A session only keeps the answers given so far, in the order asked.  Replaying
+them through the program (a few steps, no I/O) gives the next item to ask
+or the finished result, so the same packed answers work with every session
+store, including the stateless callback one.
+
+The 'adaptive' flow asks the PHQ-2 (PHQ-9 items 1 and 2) first.  After a
+negative PHQ-2 it asks item 9, about self-harm, straight away and stops
+there if that is 0 too; otherwise it continues with the rest of the PHQ-9.
+"""
+import os
+from types import MappingProxyType
+from typing import NamedTuple
+
+from depression_detector import PHQ9_QUESTIONS
+
+# Flow used by "Start Assessment": 'phq9' (always all 9) or, opted into per
+# deployment, 'adaptive' (PHQ-2 first, may stop after 3 questions)
+ASSESSMENT_FLOW = os.getenv('ASSESSMENT_FLOW', 'phq9')
+
+GAD7_QUESTIONS = [
+    "1. Feeling nervous, anxious, or on edge?",
+    "2. Not being able to stop or control worrying?",
+    "3. Worrying too much about different things?",
+    "4. Trouble relaxing?",
+    "5. Being so restless that it's hard to sit still?",
+    "6. Becoming easily annoyed or irritable?",
+    "7. Feeling afraid, as if something awful might happen?",
+]
+
+# Item id -> question text; ids are '<instrument>.<item number>'
+ITEMS = {
+    **{f'phq9.{number}': text for number, text in enumerate(PHQ9_QUESTIONS, 1)},
+    **{f'gad7.{number}': text for number, text in enumerate(GAD7_QUESTIONS, 1)},
+}
+
+PHQ9_ITEMS = tuple(f'phq9.{number}' for number in range(1, len(PHQ9_QUESTIONS) + 1))
+PHQ2_ITEMS = PHQ9_ITEMS[:2]
+PHQ9_ITEM9 = 'phq9.9'
+GAD7_ITEMS = tuple(f'gad7.{number}' for number in range(1, len(GAD7_QUESTIONS) + 1))
+
+
+class Band(NamedTuple):
+    """Severity for scores up to and including upper"""
+    upper: int
+    severity: str
+    color: str
+    response: str
+    crisis: bool = False
+
+
+class Questionnaire(NamedTuple):
+    key: str
+    title: str
+    # Label of the severity line on the result screen
+    measure: str
+    items: tuple
+    # Items that count towards the score, all of them if None
+    scored: tuple = None
+    # PHQ-9 severity comes from DepressionDetector (score or model mode)
+    bands: tuple = None
+
+    @property
+    def max_score(self):
+        return 3 * len(self.scored or self.items)
+
+    def score(self, answers):
+        """Score of answers given in items order"""
+        if self.scored is None:
+            return sum(answers)
+        return sum(value for item, value in zip(self.items, answers) if item in self.scored)
+
+    def classify(self, score):
+        """Band of a score as a read-only mapping like SEVERITY_LEVELS"""
+        for band in self.bands:
+            if score <= band.upper:
+                return MappingProxyType(band._asdict())
+        raise ValueError(f"Score {score} is out of range for {self.title}")
+
+
+QUESTIONNAIRES = {q.key: q for q in (
+    Questionnaire('phq9', 'PHQ-9', 'Depression Severity', PHQ9_ITEMS),
+    # Result of a negative screen in the adaptive flow; item 9 is kept with
+    # it but does not count towards the PHQ-2 score
+    Questionnaire('phq2', 'PHQ-2', 'Depression Screen', PHQ2_ITEMS + (PHQ9_ITEM9,), PHQ2_ITEMS, (
+        Band(2, 'Negative screen', '✅',
+             "Your answers don't suggest depression right now. Keep looking after yourself, "
+             "and check in again if things change. 😊"),
+        Band(6, 'Positive screen', '🟠',
+             "Your answers suggest it would be worth taking the full assessment or talking to a professional."),
+    )),
+    Questionnaire('gad7', 'GAD-7', 'Anxiety Severity', GAD7_ITEMS, None, (
+        Band(4, 'Minimal anxiety', '✅',
+             "Your answers suggest little or no anxiety. Keep up the habits that help you feel calm. 😊"),
+        Band(9, 'Mild anxiety', '🟡',
+             "I notice some mild anxiety. These may help:\n• Slow breathing exercises\n"
+             "• Regular sleep and exercise\n• Less caffeine\n• Talking to someone you trust"),
+        Band(14, 'Moderate anxiety', '🟠',
+             "Your answers suggest moderate anxiety. Talking to a counselor, therapist or your doctor "
+             "can really help. You don't have to manage this alone."),
+        Band(21, 'Severe anxiety', '🔴',
+             "Your answers suggest severe anxiety. Please reach out to a mental health professional "
+             "soon, and use the resources below if you feel overwhelmed."),
+    )),
+)}
+
+
+# ============================================
+# Flow definitions
+# ============================================
+
+class Below(NamedTuple):
+    """True when the answers to items add up to less than limit"""
+    items: tuple
+    limit: int
+
+    def __call__(self, values):
+        return sum(values[item] for item in self.items) < self.limit
+
+
+class Ask(NamedTuple):
+    """Ask these items in order, skipping any already answered"""
+    items: tuple
+
+
+class When(NamedTuple):
+    """Run blocks only if condition holds"""
+    condition: Below
+    blocks: tuple
+
+
+class StopIf(NamedTuple):
+    """Finish with the given questionnaire's result if condition holds"""
+    condition: Below
+    questionnaire: str
+
+
+class Flow(NamedTuple):
+    key: str
+    # Questionnaire reported when the flow runs to the end
+    questionnaire: str
+    blocks: tuple
+
+
+FLOW_DEFINITIONS = (
+    Flow('phq9', 'phq9', (Ask(PHQ9_ITEMS),)),
+    Flow('adaptive', 'phq9', (
+        Ask(PHQ2_ITEMS),
+        When(Below(PHQ2_ITEMS, 3), (
+            Ask((PHQ9_ITEM9,)),
+            StopIf(Below((PHQ9_ITEM9,), 1), 'phq2'),
+        )),
+        Ask(PHQ9_ITEMS),
+    )),
+    Flow('gad7', 'gad7', (Ask(GAD7_ITEMS),)),
+)
+
+
+# ============================================
+# Compiled programs
+# ============================================
+
+ASK, JUMP_UNLESS, STOP_IF = range(3)
+
+
+def compile_blocks(blocks, program=None):
+    """Flatten blocks into (op, argument, target) instructions"""
+    program = [] if program is None else program
+    for block in blocks:
+        if isinstance(block, Ask):
+            program.extend((ASK, item, None) for item in block.items)
+        elif isinstance(block, When):
+            jump = len(program)
+            program.append(None)
+            compile_blocks(block.blocks, program)
+            program[jump] = (JUMP_UNLESS, block.condition, len(program))
+        elif isinstance(block, StopIf):
+            program.append((STOP_IF, block.condition, block.questionnaire))
+        else:
+            raise TypeError(f"Unknown flow block: {block!r}")
+    return program
+
+
+class CompiledFlow(NamedTuple):
+    key: str
+    questionnaire: str
+    program: tuple
+    # Most questions a session can be asked
+    max_steps: int
+    items: frozenset
+    # Whether it can stop before asking every item
+    adaptive: bool
+
+
+def compile_flow(flow):
+    program = tuple(compile_blocks(flow.blocks))
+    items = frozenset(arg for op, arg, _ in program if op == ASK)
+    adaptive = any(op == STOP_IF for op, _, _ in program)
+    return CompiledFlow(flow.key, flow.questionnaire, program, len(items), items, adaptive)
+
+
+FLOWS = {flow.key: compile_flow(flow) for flow in FLOW_DEFINITIONS}
+# Stable order for compact encodings of the flow (see CallbackSessions)
+FLOW_KEYS = tuple(flow.key for flow in FLOW_DEFINITIONS)
+
+if ASSESSMENT_FLOW not in FLOWS:
+    raise ValueError(f"Unknown ASSESSMENT_FLOW: {ASSESSMENT_FLOW}")
+
+
+class Step(NamedTuple):
+    """Where a session stands: the next item, or the finished result"""
+    # Item id to ask next, None when finished
+    item: str
+    # 1-based number of the next question
+    number: int
+    # Set when finished
+    questionnaire: Questionnaire = None
+    # Answers in questionnaire items order, set when finished
+    answers: list = None
+
+
+def advance(flow, answers):
+    """Replay answers (in asked order) through a compiled flow"""
+    values = {}
+    given = 0
+    pc = 0
+    program = flow.program
+    result = flow.questionnaire
+    while pc < len(program):
+        op, arg, target = program[pc]
+        if op == ASK:
+            if arg not in values:
+                if given == len(answers):
+                    return Step(arg, given + 1)
+                values[arg] = answers[given]
+                given += 1
+        elif op == JUMP_UNLESS:
+            if not arg(values):
+                pc = target
+                continue
+        elif arg(values):
+            result = target
+            break
+        pc += 1
+    if given != len(answers):
+        raise ValueError(f"{len(answers)} answers for a {flow.key} flow that asked {given}")
+    questionnaire = QUESTIONNAIRES[result]
+    return Step(None, given + 1, questionnaire, [values[item] for item in questionnaire.items])
@@ -0,0 +1,227 @@
+"""
+Scheduled reassessment reminders
+
+A finished assessment schedules a reminder REMINDER_DAYS later (one per
+user and questionnaire, so retaking it pushes the reminder back).  Due
+times live in the reminders table with an index on due_at; nothing is
+kept in memory between windows.
+
+ReminderScheduler works through one window at a time: it reads the
+reminders due before now + REMINDER_WINDOW, at most REMINDER_WINDOW_MAX
+of them, in due order straight off the index, then sends them as they come
+due in batches of REMINDER_BATCH, paced to REMINDER_RATE messages per
+second and queued at BULK priority behind interactive replies.  A full
+window is followed by the next one as soon as it is sent, so a backlog
+after downtime drains in order with the same memory.  A restart only
+re-reads the next window.
+
+Each reminder is claimed (deleted, if its due time is unchanged) before it
+is sent, so several workers on one database never send it twice and a
+reminder rescheduled after it was read is left alone.  Failed sends are
+put back REMINDER_RETRY seconds later, up to REMINDER_MAX_ATTEMPTS times;
+users who blocked the bot are dropped.
+
+Reminders scheduled while a window is being worked through are picked up
+by the next one, so one due within the current window can be up to
+REMINDER_WINDOW seconds late.
+"""
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import NamedTuple
+
+from telegram.error import Forbidden
+
+import outbound
+import screens
+
+logger = logging.getLogger(__name__)
+
+# Days after an assessment to remind the user to retake it, 0 to disable
+REMINDER_DAYS = float(os.getenv('REMINDER_DAYS', '14'))
+
+# Seconds of due reminders read at once, and at most this many of them
+REMINDER_WINDOW = float(os.getenv('REMINDER_WINDOW', '300'))
+REMINDER_WINDOW_MAX = int(os.getenv('REMINDER_WINDOW_MAX', '1000'))
+
+# Reminders sent together, and messages per second across batches; stays
+# under OUTBOUND_GLOBAL_RATE so replies to users keep some headroom
+REMINDER_BATCH = int(os.getenv('REMINDER_BATCH', '50'))
+REMINDER_RATE = float(os.getenv('REMINDER_RATE', '20'))
+
+REMINDER_RETRY = float(os.getenv('REMINDER_RETRY', '600'))
+REMINDER_MAX_ATTEMPTS = int(os.getenv('REMINDER_MAX_ATTEMPTS', '3'))
+
+
+class Reminder(NamedTuple):
+    due_at: float
+    user_id: int
+    # callback_data of the button that starts the assessment again
+    action: str
+    chat_id: int
+    attempts: int = 0
+
+
+def schedule_reminder(conn, user_id, chat_id, action, due_at):
+    """Set the user's reminder for action to due_at, replacing an earlier one"""
+    conn.execute('''
+        INSERT OR REPLACE INTO reminders (user_id, action, chat_id, due_at, attempts)
+        VALUES (?, ?, ?, ?, 0)
+    ''', (user_id, action, chat_id, due_at))
+
+
+def load_due(conn, horizon, limit):
+    """Up to limit reminders due by horizon, earliest first, read off idx_reminders_due"""
+    rows = conn.execute('''
+        SELECT due_at, user_id, action, chat_id, attempts FROM reminders
+        WHERE due_at <= ?
+        ORDER BY due_at
+        LIMIT ?
+    ''', (horizon, limit))
+    return [Reminder(*row) for row in rows]
+
+
+def claim(conn, reminders):
+    """Delete the reminders that are still as read, returns those to send"""
+    claimed = []
+    for reminder in reminders:
+        cursor = conn.execute('''
+            DELETE FROM reminders WHERE user_id = ? AND action = ? AND due_at = ?
+        ''', (reminder.user_id, reminder.action, reminder.due_at))
+        if cursor.rowcount:
+            claimed.append(reminder)
+    conn.commit()
+    return claimed
+
+
+def reschedule(conn, reminders):
+    """Put failed reminders back, unless a newer one was scheduled meanwhile"""
+    conn.executemany('''
+        INSERT OR IGNORE INTO reminders (user_id, action, chat_id, due_at, attempts)
+        VALUES (?, ?, ?, ?, ?)
+    ''', [(r.user_id, r.action, r.chat_id, r.due_at, r.attempts) for r in reminders])
+    conn.commit()
+
+
+def count_pending(conn):
+    return conn.execute('SELECT COUNT(*) FROM reminders').fetchone()[0]
+
+
+class ReminderScheduler:
+    """
+    Sends due reminders from the database, one window at a time
+
+    submit_read and submit_write are database.submit_read/submit_write (or
+    anything that runs fn(conn, *args) and returns a concurrent Future).
+    """
+
+    def __init__(self, bot, submit_read, submit_write, window=REMINDER_WINDOW,
+                 window_max=REMINDER_WINDOW_MAX, batch_size=REMINDER_BATCH, rate=REMINDER_RATE):
+        self.bot = bot
+        self._submit_read = submit_read
+        self._submit_write = submit_write
+        self.window = window
+        self.window_max = window_max
+        self.batch_size = batch_size
+        self.rate = rate
+        # The current window, in due order
+        self._due = deque()
+        self._task = None
+
+        self.sent = 0
+        self.failed = 0
+        self.windows = 0
+
+    @property
+    def pending(self):
+        """Reminders read for the current window and not sent yet"""
+        return len(self._due)
+
+    def stats(self):
+        return {'sent': self.sent, 'failed': self.failed, 'windows': self.windows, 'pending': self.pending}
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _read(self, fn, *args):
+        return await asyncio.wrap_future(self._submit_read(fn, *args))
+
+    async def _write(self, fn, *args):
+        return await asyncio.wrap_future(self._submit_write(fn, *args))
+
+    async def _run(self):
+        while True:
+            try:
+                horizon = await self.run_window()
+            except Exception as e:
+                logger.error(f"Error sending reminders: {e}")
+                horizon = time.time() + self.window
+            await asyncio.sleep(max(0.0, horizon - time.time()))
+
+    async def run_window(self, now=None):
+        """Send the reminders of one window, returns when the next one starts"""
+        now = time.time() if now is None else now
+        horizon = now + self.window
+        self._due = deque(await self._read(load_due, horizon, self.window_max))
+        self.windows += 1
+        if len(self._due) == self.window_max:
+            # More are due within the window: continue right after these
+            horizon = self._due[-1].due_at
+
+        while self._due:
+            wait = self._due[0].due_at - time.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            started = time.monotonic()
+            now = time.time()
+            batch = []
+            while self._due and len(batch) < self.batch_size and self._due[0].due_at <= now:
+                batch.append(self._due.popleft())
+            await self._send_batch(batch)
+            await asyncio.sleep(max(0.0, len(batch) / self.rate - (time.monotonic() - started)))
+        return horizon
+
+    async def _send_batch(self, batch):
+        claimed = await self._write(claim, batch)
+        results = await asyncio.gather(*(self._send(reminder) for reminder in claimed),
+                                       return_exceptions=True)
+        retry = []
+        for reminder, result in zip(claimed, results):
+            if not isinstance(result, Exception):
+                self.sent += 1
+                continue
+            self.failed += 1
+            if isinstance(result, Forbidden):
+                continue
+            logger.warning(f"Reminder for user {reminder.user_id} failed: {result}")
+            if reminder.attempts + 1 < REMINDER_MAX_ATTEMPTS:
+                retry.append(reminder._replace(due_at=time.time() + REMINDER_RETRY,
+                                               attempts=reminder.attempts + 1))
+        if retry:
+            await self._write(reschedule, retry)
+
+    async def _send(self, reminder):
+        screen = screens.REMINDERS[reminder.action]
+        await self.bot.send_message(
+            reminder.chat_id, screen.text, reply_markup=screen.reply_markup,
+            **outbound.priority_kwargs(self.bot, outbound.BULK)
+        )
+
+
+if __name__ == '__main__':
+    import database
+
+    print(f"{database.submit_read(count_pending).result()} reminders pending")
+    database.close_database()
@@ -0,0 +1,154 @@
+"""
+Deduplicated storage of bot responses
+
+A templated response is stored as a reference to a content-addressed row
+of response_templates (zlib compressed, keyed by the sha256 of the text)
+plus a small JSON payload of parameters, instead of the full text in every
+conversations row.  The text is rendered again on demand.
+
+Usage: python responses.py [report]   bytes saved by templated responses
+"""
+import hashlib
+import json
+import re
+import zlib
+from functools import lru_cache
+from typing import NamedTuple
+
+
+def escape(text):
+    """Make text safe to embed in a template"""
+    return str(text).replace('{', '{{').replace('}', '}}')
+
+
+def render(template, params):
+    return template.format_map(params)
+
+
+class Response(NamedTuple):
+    """Template text with {name} fields and the parameters to fill them"""
+    template: str
+    params: dict
+
+    @property
+    def text(self):
+        return render(self.template, self.params)
+
+
+def template_hash(template):
+    return hashlib.sha256(template.encode()).digest()
+
+
+def store_template(conn, template):
+    """Id of the template's row, inserting it if it is new"""
+    digest = template_hash(template)
+    conn.execute('''
+        INSERT OR IGNORE INTO response_templates (hash, body) VALUES (?, ?)
+    ''', (digest, zlib.compress(template.encode(), 9)))
+    return conn.execute(
+        'SELECT template_id FROM response_templates WHERE hash = ?', (digest,)
+    ).fetchone()[0]
+
+
+@lru_cache(maxsize=256)
+def _decompress(body):
+    # Keyed by the stored bytes rather than template_id, which differs per shard
+    return zlib.decompress(body).decode()
+
+
+def load_template(conn, template_id):
+    body = conn.execute(
+        'SELECT body FROM response_templates WHERE template_id = ?', (template_id,)
+    ).fetchone()[0]
+    return _decompress(body)
+
+
+def decode_response(bot_response, template_body, params):
+    """Full text of a conversations row's response, given its template's stored body"""
+    if template_body is None:
+        return bot_response
+    return render(_decompress(template_body), json.loads(params))
+
+
+def encode_params(params):
+    return json.dumps(params, separators=(',', ':'))
+
+
+# Fields recognised in responses logged before templates existed
+_LEGACY_FIELDS = (
+    ('score', re.compile(r'PHQ-9 Score: (\d+)/27')),
+)
+
+
+def to_response(text):
+    """Response equivalent to a legacy full-text response, None if it has no template"""
+    template = escape(text)
+    params = {}
+    for name, pattern in _LEGACY_FIELDS:
+        match = pattern.search(template)
+        if match is None:
+            continue
+        start, end = match.span(1)
+        template = template[:start] + '{' + name + '}' + template[end:]
+        params[name] = int(match.group(1))
+    if not params:
+        return None
+    response = Response(template, params)
+    # Only convert when the text comes back exactly
+    return response if response.text == text else None
+
+
+def report(conn):
+    """Bytes used by templated responses against storing the full text"""
+    templates = conn.execute(
+        'SELECT COUNT(*), COALESCE(SUM(LENGTH(body)), 0) FROM response_templates'
+    ).fetchone()
+    rows = 0
+    full_bytes = 0
+    param_bytes = 0
+    cursor = conn.execute('''
+        SELECT response_templates.body, response_params FROM conversations
+        JOIN response_templates ON template_id = response_template
+    ''')
+    while True:
+        batch = cursor.fetchmany(5000)
+        if not batch:
+            break
+        for body, params in batch:
+            rows += 1
+            # The parameters plus up to 8 bytes for the template id
+            param_bytes += len(params.encode()) + 8
+            full_bytes += len(decode_response(None, body, params).encode())
+    text_rows, text_bytes = conn.execute('''
+        SELECT COUNT(*), COALESCE(SUM(LENGTH(CAST(bot_response AS BLOB))), 0)
+        FROM conversations WHERE response_template IS NULL
+    ''').fetchone()
+    page_size = conn.execute('PRAGMA page_size').fetchone()[0]
+    free_pages = conn.execute('PRAGMA freelist_count').fetchone()[0]
+    return {
+        'templated_rows': rows,
+        'templates': templates[0],
+        'full_text_bytes': full_bytes,
+        'stored_bytes': param_bytes + templates[1],
+        'saved_bytes': full_bytes - param_bytes - templates[1],
+        'text_rows': text_rows,
+        'text_bytes': text_bytes,
+        'reclaimable_bytes': page_size * free_pages,
+    }
+
+
+if __name__ == '__main__':
+    import database
+
+    database.init_database(backfill=False)
+    database.run_backfills()
+    stats = database.submit_read(report).result()
+    database.close_database()
+
+    print(f"Templated responses: {stats['templated_rows']} rows, {stats['templates']} templates")
+    print(f"  as full text:  {stats['full_text_bytes']:>12,} bytes")
+    print(f"  stored:        {stats['stored_bytes']:>12,} bytes")
+    print(f"  saved:         {stats['saved_bytes']:>12,} bytes")
+    print(f"Plain text responses: {stats['text_rows']} rows, {stats['text_bytes']:,} bytes")
+    if stats['reclaimable_bytes']:
+        print(f"{stats['reclaimable_bytes']:,} bytes of free pages can be returned to the OS with VACUUM")
@@ -0,0 +1,243 @@
+"""
+Precompiled screens: message text and inline keyboards built once
+
+Static screens (menus, instructions, resources, one per question of each
+flow) are built at import and shared by every update instead of being
+rebuilt in each handler.  InlineKeyboardMarkup objects are immutable, so
+sharing them between concurrent updates is safe.  The build_* functions
+are what the registry is made from; benchmarks/screen_registry.py calls
+them per update to compare against the registry.
+"""
+from typing import NamedTuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from questionnaires import FLOWS, ITEMS, QUESTIONNAIRES
+
+
+class Screen(NamedTuple):
+    text: str
+    reply_markup: InlineKeyboardMarkup = None
+
+
+def keyboard(*rows):
+    """Markup with one button per row from (label, callback_data) pairs"""
+    return InlineKeyboardMarkup([
+        [InlineKeyboardButton(label, callback_data=data)] for label, data in rows
+    ])
+
+
+# ============================================
+# Builders
+# ============================================
+
+WELCOME_TEXT = """
+👋 Welcome to MindCare Bot, {first_name}!
+
+I'm here to help you understand your mental health through a scientifically-backed assessment.
+
+This chatbot can:
+✅ Conduct a depression screening (PHQ-9)
+✅ Check in on anxiety (GAD-7)
+✅ Provide personalized insights
+✅ Suggest helpful resources
+✅ Maintain confidential records
+
+⚠️ Important: This bot is NOT a substitute for professional medical advice.
+Always consult a mental health professional for diagnosis and treatment.
+
+What would you like to do?
+"""
+
+MENU_TEXT = """
+📋 MindCare Main Menu
+
+What would you like to do today?
+"""
+
+INSTRUCTIONS_TEXT = """
+{heading} ({title})
+
+You'll answer {count} questions about how you've been feeling over the past 2 weeks.
+
+For each question, choose:
+• 😊 Not at all (0)
+• 😔 Several days (1)
+• 😞 More than half the days (2)
+• 😢 Nearly every day (3)
+
+Your responses are confidential and saved securely.
+
+Let's begin! 👇
+"""
+
+RESOURCES_TEXT = """
+📚 Mental Health Resources
+
+🌍 Global Resources:
+• SAMHSA National Helpline: 1-800-662-4357
+• International Association for Suicide Prevention: https://www.iasp.info/resources/Crisis_Centres/
+
+🇺🇸 US-Specific:
+• 988 Suicide & Crisis Lifeline: Call or text 988
+• Crisis Text Line: Text HOME to 741741
+• NAMI Helpline: 1-800-950-6264
+
+💻 Online Resources:
+• Mind.org.uk - Mental health information
+• ADAA.org - Anxiety & Depression Association
+• BetterHelp.com - Online therapy
+• Headspace - Meditation app
+
+⚠️ Emergency: If in immediate danger, call 911 or go to nearest ER
+
+Remember: Seeking help is a sign of strength, not weakness. 💪
+"""
+
+SELF_CARE_TEXT = """
+💪 Self-Care Tips for Mental Health
+
+🛏️ Sleep:
+• Maintain regular sleep schedule (7-9 hours)
+• Avoid screens 1 hour before bed
+• Keep bedroom cool and dark
+
+🏃 Exercise:
+• 30 minutes daily activity
+• Walking, yoga, dancing all help
+• Releases mood-boosting endorphins
+
+🍎 Nutrition:
+• Eat regular, balanced meals
+• Stay hydrated
+• Limit caffeine and alcohol
+
+👥 Social Connection:
+• Reach out to friends/family
+• Join support groups
+• Volunteer in community
+
+🧘 Mindfulness:
+• Meditation: 5-10 minutes daily
+• Deep breathing exercises
+• Journaling thoughts and feelings
+
+🎯 Structure:
+• Set daily goals
+• Maintain routine
+• Break tasks into small steps
+
+Remember: Self-care isn't selfish. You deserve this support! ❤️
+"""
+
+EXIT_TEXT = "👋 Thank you for using MindCare Bot. Take care of yourself!"
+
+REMINDER_TEXT = """
+⏰ Time for a check-in
+
+It's been a while since your last {title}. Taking it again every couple of weeks shows how things are changing for you.
+"""
+
+
+def build_menu_keyboard():
+    return keyboard(
+        ("📋 Start Assessment", 'start_assessment'),
+        ("😟 Anxiety Check (GAD-7)", 'start_gad7'),
+        ("📊 View Previous Results", 'view_results'),
+        ("❓ Help & Resources", 'resources'),
+        ("🚪 Exit", 'exit'),
+    )
+
+
+def build_back_keyboard():
+    return keyboard(
+        ("↩️ Main Menu", 'menu'),
+        ("🚪 Exit", 'exit'),
+    )
+
+
+def build_result_keyboard():
+    return keyboard(
+        ("💪 Self-Care Tips", 'self_care'),
+        ("📚 Resources", 'resources'),
+        ("↩️ Main Menu", 'menu'),
+    )
+
+
+ANSWER_LABELS = ("😊 Not at all", "😔 Several days", "😞 More than half", "😢 Nearly every day")
+
+
+def build_answer_keyboard(callback_data=None):
+    """Answer buttons for values 0-3, with answer_<value> data unless given"""
+    callback_data = callback_data or [f'answer_{value}' for value in range(len(ANSWER_LABELS))]
+    return keyboard(*zip(ANSWER_LABELS, callback_data))
+
+
+INSTRUCTION_HEADINGS = {
+    'phq9': "🧠 Depression Screening Assessment",
+    'gad7': "😟 Anxiety Screening Assessment",
+}
+
+
+def build_instructions(flow):
+    count = f"up to {flow.max_steps}" if flow.adaptive else str(flow.max_steps)
+    return Screen(INSTRUCTIONS_TEXT.format(
+        heading=INSTRUCTION_HEADINGS[flow.questionnaire],
+        title=QUESTIONNAIRES[flow.questionnaire].title, count=count,
+    ))
+
+
+def build_question(flow, number, item):
+    text = f"Question {number}/{flow.max_steps}\n\n{ITEMS[item]}"
+    return Screen(text, build_answer_keyboard())
+
+
+# Reminder sent after each questionnaire -> button data that starts it again;
+# a PHQ-2 screen is followed up with the usual assessment flow
+REMINDER_ACTIONS = {
+    'phq9': 'start_assessment',
+    'phq2': 'start_assessment',
+    'gad7': 'start_gad7',
+}
+
+
+def build_reminder(questionnaire, action):
+    return Screen(REMINDER_TEXT.format(title=questionnaire.title), keyboard(
+        (f"📋 Retake {questionnaire.title}", action),
+        ("↩️ Main Menu", 'menu'),
+    ))
+
+
+# ============================================
+# Registry (built once at import)
+# ============================================
+
+MENU_KEYBOARD = build_menu_keyboard()
+BACK_KEYBOARD = build_back_keyboard()
+RESULT_KEYBOARD = build_result_keyboard()
+ANSWER_KEYBOARD = build_answer_keyboard()
+
+MENU = Screen(MENU_TEXT, MENU_KEYBOARD)
+INSTRUCTIONS = {key: build_instructions(flow) for key, flow in FLOWS.items()}
+RESOURCES = Screen(RESOURCES_TEXT, BACK_KEYBOARD)
+SELF_CARE = Screen(SELF_CARE_TEXT, BACK_KEYBOARD)
+EXIT = Screen(EXIT_TEXT)
+# Reminder message per button data in REMINDER_ACTIONS
+REMINDERS = {
+    'start_assessment': build_reminder(QUESTIONNAIRES['phq9'], 'start_assessment'),
+    'start_gad7': build_reminder(QUESTIONNAIRES['gad7'], 'start_gad7'),
+}
+
+# (flow, question number, item) -> screen, all sharing the answer keyboard;
+# adaptive flows can ask an item at more than one position
+QUESTIONS = {
+    (key, number, item): Screen(build_question(flow, number, item).text, ANSWER_KEYBOARD)
+    for key, flow in FLOWS.items()
+    for number in range(1, flow.max_steps + 1)
+    for item in flow.items
+}
+
+
+def welcome(first_name):
+    """Welcome screen, the only static screen with a per-user part"""
+    return Screen(WELCOME_TEXT.format(first_name=first_name), MENU_KEYBOARD)
@@ -0,0 +1,142 @@
+"""
+Full-text search over conversation logs
+
+conversations_fts is an FTS5 index of each conversation's user_message and
+bot_response.  It stores no text of its own: its content is the
+conversation_text view, which renders templated responses (see
+responses.py) through the render_response SQL function, so snippets show
+the full response while the table keeps only the template reference.
+database._open_connection registers the function on every connection.
+
+New rows are indexed by database._insert_conversation in the same
+transaction as the insert; rows from before the index existed are added
+by the conversation_search backfill, a chunk per write transaction.
+Results are ranked by bm25, with user messages weighted twice as much as
+bot responses.
+
+Usage: python search.py KEYWORDS... [--user ID] [--page 1] [--per-page 20] [--match]
+
+Keywords must all appear (in any order); --match takes an FTS5 query
+instead, e.g. 'sleep* OR insomnia' or 'NEAR(hurt myself, 5)'.
+"""
+from typing import NamedTuple
+
+from responses import decode_response
+
+SNIPPET_TOKENS = 12
+
+
+class SearchHit(NamedTuple):
+    conversation_id: int
+    user_id: int
+    message_timestamp: str
+    # Best matching column, matches in [brackets]
+    snippet: str
+    # bm25, lower is a better match
+    rank: float
+
+
+def render_response(body, params):
+    """SQL function: full text of a templated response"""
+    if body is None:
+        return None
+    return decode_response(None, body, params)
+
+
+def register_functions(conn):
+    conn.create_function('render_response', 2, render_response, deterministic=True)
+
+
+def index_conversation(conn, conversation_id, user_message, bot_response):
+    """Add a new row to the index; runs inside the insert's transaction"""
+    conn.execute('''
+        INSERT INTO conversations_fts (rowid, user_message, bot_response) VALUES (?, ?, ?)
+    ''', (conversation_id, user_message, bot_response))
+
+
+def index_chunk(conn, after_id, until, chunk_size):
+    """Index up to chunk_size rows with ids in (after_id, until], returns the last id or None"""
+    last = conn.execute('''
+        SELECT MAX(conversation_id) FROM (
+            SELECT conversation_id FROM conversations
+            WHERE conversation_id > ? AND conversation_id <= ?
+            ORDER BY conversation_id
+            LIMIT ?
+        )
+    ''', (after_id, until, chunk_size)).fetchone()[0]
+    if last is None:
+        return None
+    conn.execute('''
+        INSERT INTO conversations_fts (rowid, user_message, bot_response)
+        SELECT conversation_id, user_message, bot_response FROM conversation_text
+        WHERE conversation_id > ? AND conversation_id <= ?
+    ''', (after_id, last))
+    return last
+
+
+def indexing_complete(conn):
+    """Whether rows from before the index existed have all been indexed"""
+    row = conn.execute(
+        "SELECT done FROM backfill_progress WHERE name = 'conversation_search'"
+    ).fetchone()
+    return bool(row and row[0])
+
+
+def keywords_query(text):
+    """FTS5 query matching rows that contain every word of text"""
+    return ' '.join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def search(conn, query, limit=20, offset=0, user_id=None):
+    """Page of SearchHits for an FTS5 query, best match first"""
+    sql = '''
+        SELECT c.conversation_id, c.user_id, c.message_timestamp,
+               snippet(conversations_fts, -1, '[', ']', '…', ?), conversations_fts.rank
+        FROM conversations_fts
+        JOIN conversations c ON c.conversation_id = conversations_fts.rowid
+        WHERE conversations_fts MATCH ?
+    '''
+    args = [SNIPPET_TOKENS, query]
+    if user_id is not None:
+        sql += ' AND c.user_id = ?'
+        args.append(user_id)
+    sql += ' ORDER BY conversations_fts.rank LIMIT ? OFFSET ?'
+    args += [limit, offset]
+    return [SearchHit(*row) for row in conn.execute(sql, args)]
+
+
+if __name__ == '__main__':
+    import argparse
+    import sqlite3
+
+    parser = argparse.ArgumentParser(description="Search conversation logs")
+    parser.add_argument('keywords', nargs='+')
+    parser.add_argument('--user', type=int, help="only this user's conversations")
+    parser.add_argument('--page', type=int, default=1)
+    parser.add_argument('--per-page', type=int, default=20)
+    parser.add_argument('--match', action='store_true', help="keywords are an FTS5 query")
+    args = parser.parse_args()
+
+    import database
+
+    database.init_database(backfill=False)
+    if not database.submit_read(indexing_complete).result():
+        print("Older conversations are still being indexed, results may be incomplete")
+    text = ' '.join(args.keywords)
+    query = text if args.match else keywords_query(text)
+    try:
+        # One extra row tells whether there is a next page
+        hits = database.search_conversations(query, args.per_page + 1,
+                                             (args.page - 1) * args.per_page, args.user)
+    except sqlite3.OperationalError as e:
+        parser.error(f"invalid search: {e}")
+    finally:
+        database.close_database()
+
+    for hit in hits[:args.per_page]:
+        print(f"#{hit.conversation_id}  user {hit.user_id}  {hit.message_timestamp}  ({hit.rank:.2f})")
+        print(f"    {' '.join(hit.snippet.split())}")
+    if not hits:
+        print("No matches" if args.page == 1 else "No more matches")
+    elif len(hits) > args.per_page:
+        print(f"More on page {args.page + 1}")
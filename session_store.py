@@ -0,0 +1,316 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+
+from database import submit_read, submit_write
+from depression_detector import EMPTY_ANSWERS, unpack_answers
+from questionnaires import FLOW_KEYS
+
+# Which store to use: 'memory' (single process), 'sqlite' (survives
+# restarts and can be shared by several workers using the same database) or
+# 'callback' (stateless: progress travels in the answer buttons, see
+# CallbackSessions)
+SESSION_STORE = os.getenv('SESSION_STORE', 'memory')
+
+# Key for the MAC on callback sessions, shared by all workers; defaults to
+# one derived from the bot token
+SESSION_SECRET = os.getenv('SESSION_SECRET', '')
+
+# Abandoned questionnaires expire after this many seconds
+SESSION_TTL = float(os.getenv('SESSION_TTL', '3600'))
+
+# Upper bound on in-memory sessions, least recently updated are evicted first
+SESSION_MAX = int(os.getenv('SESSION_MAX', '10000'))
+
+
+class AssessmentSession:
+    """In-progress questionnaire state for one user"""
+
+    __slots__ = ('user_id', 'current_question', 'answers', 'updated_at', 'flow', 'issued')
+
+    def __init__(self, user_id, current_question=0, answers=EMPTY_ANSWERS, updated_at=0.0, flow='phq9',
+                 issued=None):
+        self.user_id = user_id
+        # Number of questions answered so far
+        self.current_question = current_question
+        self.answers = answers  # packed in the order asked, see depression_detector.pack_answers
+        self.updated_at = updated_at
+        self.flow = flow  # key of questionnaires.FLOWS
+        # Minute the answered buttons were issued, for callback sessions
+        self.issued = issued
+
+    def add_answer(self, value):
+        """Record the answer to the current question and move to the next one"""
+        if not 0 <= value <= 3:
+            raise ValueError(f"Invalid answer value: {value}")
+        self.answers = (self.answers << 2) | value
+        self.current_question += 1
+
+    def answer_list(self):
+        return unpack_answers(self.answers)
+
+    def submission_key(self):
+        """
+        Same for every tap on one keyboard of a callback session, None otherwise
+
+        A repeated or replayed tap on the last question's buttons decodes to
+        the same key, so the assessment it completes is saved only once.
+        """
+        if self.issued is None:
+            return None
+        return f"{self.flow}:{self.answers >> 2}:{self.issued}"
+
+
+class MemorySessionStore:
+    """Process-local store with TTL expiry and LRU eviction"""
+
+    stateless = False
+
+    def __init__(self, max_sessions=SESSION_MAX, ttl=SESSION_TTL):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        # Ordered by last update, oldest first
+        self._sessions = OrderedDict()
+
+    def __len__(self):
+        return len(self._sessions)
+
+    async def get(self, user_id):
+        session = self._sessions.get(user_id)
+        if session is not None and session.updated_at + self.ttl < time.time():
+            del self._sessions[user_id]
+            return None
+        return session
+
+    async def save(self, session):
+        now = time.time()
+        session.updated_at = now
+        self._sessions[session.user_id] = session
+        self._sessions.move_to_end(session.user_id)
+
+        # Expired sessions sit at the front, so this only touches what it removes
+        while self._sessions:
+            oldest = next(iter(self._sessions.values()))
+            if len(self._sessions) <= self.max_sessions and oldest.updated_at + self.ttl >= now:
+                break
+            self._sessions.popitem(last=False)
+
+    async def record_answer(self, session, value):
+        """Add the answer to the current question and save, returns whether it was recorded"""
+        session.add_answer(value)
+        await self.save(session)
+        return True
+
+    async def delete(self, user_id):
+        self._sessions.pop(user_id, None)
+
+
+def _get_session(conn, user_id, oldest):
+    return conn.execute('''
+        SELECT current_question, answers, updated_at, flow
+        FROM assessment_sessions
+        WHERE user_id = ? AND updated_at >= ?
+    ''', (user_id, oldest)).fetchone()
+
+
+def _save_session(conn, user_id, current_question, answers, updated_at, flow):
+    conn.execute('''
+        INSERT OR REPLACE INTO assessment_sessions
+        (user_id, current_question, answers, updated_at, flow)
+        VALUES (?, ?, ?, ?, ?)
+    ''', (user_id, current_question, answers, updated_at, flow))
+    conn.commit()
+
+
+def _advance_session(conn, user_id, read_answers, read_at, current_question, answers, updated_at):
+    # Compare and swap: of two taps on the same question, from any worker,
+    # only the first finds the row as it was read.  updated_at changes on
+    # every save, so it also tells a restarted session (answers back to
+    # empty) from the one a late tap was read against
+    cursor = conn.execute('''
+        UPDATE assessment_sessions
+        SET current_question = ?, answers = ?, updated_at = ?
+        WHERE user_id = ? AND answers = ? AND updated_at = ?
+    ''', (current_question, answers, updated_at, user_id, read_answers, read_at))
+    conn.commit()
+    return cursor.rowcount == 1
+
+
+def _delete_session(conn, user_id):
+    conn.execute('DELETE FROM assessment_sessions WHERE user_id = ?', (user_id,))
+    conn.commit()
+
+
+def _count_sessions(conn, oldest):
+    return conn.execute(
+        'SELECT COUNT(*) FROM assessment_sessions WHERE updated_at >= ?', (oldest,)
+    ).fetchone()[0]
+
+
+def _purge_sessions(conn, oldest):
+    conn.execute('DELETE FROM assessment_sessions WHERE updated_at < ?', (oldest,))
+    conn.commit()
+
+
+class SQLiteSessionStore:
+    """
+    Sessions kept in the assessment_sessions table
+
+    Any worker using the same database can resume a session, and sessions
+    survive a restart.  Expired rows are ignored on read and purged in the
+    background every purge_every saves.
+    """
+
+    stateless = False
+
+    def __init__(self, ttl=SESSION_TTL, purge_every=1000):
+        self.ttl = ttl
+        self.purge_every = purge_every
+        self._saves = 0
+
+    def __len__(self):
+        # Blocking: used for the active sessions gauge, off the event loop
+        return submit_read(_count_sessions, time.time() - self.ttl).result()
+
+    async def get(self, user_id):
+        row = await asyncio.wrap_future(submit_read(_get_session, user_id, time.time() - self.ttl))
+        if row is None:
+            return None
+        return AssessmentSession(user_id, *row)
+
+    async def save(self, session):
+        session.updated_at = time.time()
+        await asyncio.wrap_future(submit_write(
+            _save_session, session.user_id, session.current_question,
+            session.answers, session.updated_at, session.flow
+        ))
+        self._saved(session)
+
+    async def record_answer(self, session, value):
+        """
+        Add the answer to the current question and save, returns whether it was recorded
+
+        The update applies only if the stored session is still the one read
+        (same answers, not saved since), so neither a concurrent tap handled
+        by another worker nor a restart of the assessment is overwritten;
+        the tap that loses returns False.
+        """
+        read_answers, read_at = session.answers, session.updated_at
+        session.add_answer(value)
+        session.updated_at = time.time()
+        recorded = await asyncio.wrap_future(submit_write(
+            _advance_session, session.user_id, read_answers, read_at, session.current_question,
+            session.answers, session.updated_at
+        ))
+        if recorded:
+            self._saved(session)
+        return recorded
+
+    def _saved(self, session):
+        self._saves += 1
+        if self._saves % self.purge_every == 0:
+            submit_write(_purge_sessions, session.updated_at - self.ttl)
+
+    async def delete(self, user_id):
+        await asyncio.wrap_future(submit_write(_delete_session, user_id))
+
+
+class InvalidCallback(ValueError):
+    """callback_data that was forged, altered or has expired"""
+
+
+class CallbackSessions:
+    """
+    Stateless sessions: each answer button carries the whole session
+
+    The callback_data of an answer button holds the flow, the answers so
+    far (packed, the question index is their count), the answer the button
+    stands for and the minute it was issued, followed by a 64-bit HMAC over
+    those and the user id.  Any worker with the same key can continue the session, so
+    nothing is stored and get() always returns None.  The data is 22
+    characters, well within Telegram's 64-byte limit.
+    """
+
+    stateless = True
+    PREFIX = 's:'
+
+    # 3 bytes of flow (3 bits), answers (up to 19) and answer value (2),
+    # 4 bytes of issue minute, 8 of MAC
+    _STATE_BYTES = 3
+    _FLOW_SHIFT = 21
+    _MAC_BYTES = 8
+
+    def __init__(self, secret=SESSION_SECRET, ttl=SESSION_TTL):
+        if not secret:
+            token = os.getenv('TELEGRAM_BOT_TOKEN')
+            if not token:
+                raise ValueError("SESSION_STORE=callback needs SESSION_SECRET or TELEGRAM_BOT_TOKEN")
+            secret = hashlib.sha256(b'mindcare-session:' + token.encode()).hexdigest()
+        self.key = secret.encode()
+        self.ttl = ttl
+
+    def __len__(self):
+        # Sessions are not held anywhere
+        return 0
+
+    async def get(self, user_id):
+        return None
+
+    async def save(self, session):
+        pass
+
+    async def delete(self, user_id):
+        pass
+
+    def _mac(self, user_id, body):
+        message = user_id.to_bytes(8, 'big', signed=True) + body
+        return hmac.new(self.key, message, hashlib.sha256).digest()[:self._MAC_BYTES]
+
+    def encode(self, session, value, now=None):
+        """callback_data for answering value to the session's current question"""
+        minute = int((time.time() if now is None else now) // 60)
+        state = (FLOW_KEYS.index(session.flow) << self._FLOW_SHIFT) | (session.answers << 2) | value
+        body = (state.to_bytes(self._STATE_BYTES, 'big')
+                + (minute & 0xFFFFFFFF).to_bytes(4, 'big'))
+        token = base64.urlsafe_b64encode(body + self._mac(session.user_id, body))
+        return self.PREFIX + token.decode()
+
+    def decode(self, user_id, data, now=None):
+        """Session with the button's answer recorded, raises InvalidCallback"""
+        try:
+            raw = base64.urlsafe_b64decode(data[len(self.PREFIX):])
+        except ValueError:
+            raise InvalidCallback("malformed callback data")
+        body, mac = raw[:-self._MAC_BYTES], raw[-self._MAC_BYTES:]
+        if len(body) != self._STATE_BYTES + 4 or not hmac.compare_digest(mac, self._mac(user_id, body)):
+            raise InvalidCallback("callback data failed authentication")
+
+        minute = int((time.time() if now is None else now) // 60)
+        issued = int.from_bytes(body[self._STATE_BYTES:], 'big')
+        if (minute - issued) & 0xFFFFFFFF > self.ttl // 60:
+            raise InvalidCallback("session expired")
+
+        state = int.from_bytes(body[:self._STATE_BYTES], 'big')
+        flow = state >> self._FLOW_SHIFT
+        answers = (state & ((1 << self._FLOW_SHIFT) - 1)) >> 2
+        if flow >= len(FLOW_KEYS):
+            raise InvalidCallback("unknown flow")
+        session = AssessmentSession(user_id, (answers.bit_length() - 1) // 2, answers, flow=FLOW_KEYS[flow],
+                                    issued=issued)
+        session.add_answer(state & 3)
+        return session
+
+
+def create_session_store(kind=SESSION_STORE):
+    """Build the session store selected by SESSION_STORE"""
+    if kind == 'memory':
+        return MemorySessionStore()
+    if kind == 'sqlite':
+        return SQLiteSessionStore()
+    if kind == 'callback':
+        return CallbackSessions()
+    raise ValueError(f"Unknown session store: {kind}")
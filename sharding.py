@@ -0,0 +1,361 @@
+"""
+Sharded storage and one worker process per shard
+
+With SHARD_COUNT > 1 every user belongs to one of SHARD_COUNT database
+files, chosen by a stable hash of the user_id (shard_for).  The launcher
+runs one bot worker per shard, each with its own DATABASE_PATH, and a
+router in the front process that receives the updates (long polling, or
+the public webhook with BOT_MODE=webhook) and forwards each one to the
+worker owning its user.  A user's updates always reach the same worker in
+order, so per-user state can stay in worker memory.
+
+Reads across all users (exports, analytics) go through fanout(), which
+runs a query on every shard.
+
+Usage:
+  python sharding.py run [--shards 4]      start the router and the workers
+  python sharding.py split [--shards 4]    copy an existing DATABASE_PATH into shards
+  python sharding.py status [--shards 4]   row counts per shard
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sqlite3
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+SHARD_COUNT = int(os.getenv('SHARD_COUNT', '1'))
+# Worker i takes forwarded updates on 127.0.0.1:SHARD_BASE_PORT + i
+SHARD_BASE_PORT = int(os.getenv('SHARD_BASE_PORT', '8500'))
+# Updates buffered per worker before the router stops taking more
+SHARD_FORWARD_QUEUE = int(os.getenv('SHARD_FORWARD_QUEUE', '1000'))
+
+DB_PATH = os.getenv('DATABASE_PATH', './data/users.db')
+
+# Tables copied by split_database, all keyed by user_id
+SHARDED_TABLES = ('users', 'assessments', 'conversations', 'assessment_sessions', 'user_trends',
+                  'reminders')
+
+
+def shard_for(user_id, count=SHARD_COUNT):
+    """Shard index of a user; stable across processes and restarts"""
+    if count <= 1:
+        return 0
+    return zlib.crc32(str(int(user_id)).encode()) % count
+
+
+def shard_path(index, count=SHARD_COUNT, base=DB_PATH):
+    """Database file of a shard, e.g. ./data/users.shard2.db"""
+    if count <= 1:
+        return base
+    root, ext = os.path.splitext(base)
+    return f"{root}.shard{index}{ext or '.db'}"
+
+
+def shard_paths(count=SHARD_COUNT, base=DB_PATH):
+    return [shard_path(i, count, base) for i in range(max(1, count))]
+
+
+def fanout(fn, *args, count=SHARD_COUNT, base=DB_PATH):
+    """
+    Run fn(conn, *args) on every shard in parallel, returns the results in
+    shard order
+
+    Connections are read-only and opened per call, so this works from any
+    process, including while the workers are running.
+    """
+    def run(path):
+        conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=30)
+        try:
+            return fn(conn, *args)
+        finally:
+            conn.close()
+
+    paths = [path for path in shard_paths(count, base) if os.path.exists(path)]
+    with ThreadPoolExecutor(max_workers=len(paths) or 1) as pool:
+        return list(pool.map(run, paths))
+
+
+def update_user_id(data):
+    """user_id of a raw update dict, None if it has no user"""
+    for value in data.values():
+        if not isinstance(value, dict):
+            continue
+        for field in ('from', 'user'):
+            user = value.get(field)
+            if isinstance(user, dict) and 'id' in user:
+                return user['id']
+        chat = value.get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+# ============================================
+# Workers
+# ============================================
+
+def _run_shard(index, count, base, port):
+    # Settings are read at import time, so set them before importing the bot
+    os.environ['DATABASE_PATH'] = shard_path(index, count, base)
+    os.environ['WEBHOOK_LISTEN'] = '127.0.0.1'
+    os.environ['SHARD_INDEX'] = str(index)
+    # The flood limits apply to the bot as a whole, split them between workers
+    global_rate = float(os.getenv('OUTBOUND_GLOBAL_RATE', '30'))
+    os.environ['OUTBOUND_GLOBAL_RATE'] = str(global_rate / count)
+    # Each worker serves /metrics on its own webhook port instead
+    os.environ.pop('METRICS_PORT', None)
+    import main
+    import webhook
+    asyncio.run(webhook.serve(main.build_application(webhook=True), port, register=False))
+
+
+def start_workers(count=SHARD_COUNT, base=DB_PATH, base_port=SHARD_BASE_PORT):
+    # spawn: the workers must import database.py with their own DATABASE_PATH
+    context = multiprocessing.get_context('spawn')
+    processes = [
+        context.Process(target=_run_shard, args=(i, count, base, base_port + i), name=f"shard-{i}")
+        for i in range(count)
+    ]
+    for process in processes:
+        process.start()
+    return processes
+
+
+# ============================================
+# Router
+# ============================================
+
+class Router:
+    """Forwards raw updates to the worker that owns the user, in order per worker"""
+
+    def __init__(self, count=SHARD_COUNT, base_port=SHARD_BASE_PORT, secret=None):
+        import webhook
+        self.count = count
+        self.urls = [f"http://127.0.0.1:{base_port + i}{webhook.WEBHOOK_PATH}" for i in range(count)]
+        self.headers = {'Content-Type': 'application/json'}
+        secret = secret or webhook.WEBHOOK_SECRET
+        if secret:
+            self.headers[webhook.SECRET_HEADER] = secret
+        self.forwarded = [0] * count
+        self._queues = None
+        self._tasks = []
+        self._client = None
+
+    async def start(self):
+        import httpx
+        self._client = httpx.AsyncClient(timeout=30)
+        self._queues = [asyncio.Queue(SHARD_FORWARD_QUEUE) for _ in range(self.count)]
+        self._tasks = [asyncio.create_task(self._forward(i)) for i in range(self.count)]
+
+    async def route(self, data, body=None):
+        """Queue one update for its worker; blocks while that worker is behind"""
+        user_id = update_user_id(data)
+        index = 0 if user_id is None else shard_for(user_id, self.count)
+        await self._queues[index].put(body or json.dumps(data).encode())
+
+    async def _forward(self, index):
+        queue = self._queues[index]
+        while True:
+            body = await queue.get()
+            delay = 0.1
+            while True:
+                try:
+                    response = await self._client.post(self.urls[index], content=body, headers=self.headers)
+                    if response.status_code < 500:
+                        if response.status_code != 200:
+                            logger.error(f"Shard {index} rejected an update: {response.status_code}")
+                        break
+                except Exception as e:
+                    # Worker starting up or restarting: keep the update and retry
+                    logger.debug(f"Shard {index} unavailable: {e}")
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 5)
+            self.forwarded[index] += 1
+            queue.task_done()
+
+    async def stop(self, timeout=10):
+        """Deliver what is queued (up to timeout), then close"""
+        try:
+            await asyncio.wait_for(asyncio.gather(*(q.join() for q in self._queues)), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping undelivered updates on shutdown")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        await self._client.aclose()
+
+
+def _bot_settings():
+    # Same settings as main.py, without importing the bot into the router
+    from dotenv import load_dotenv
+    load_dotenv()
+    return os.getenv('TELEGRAM_BOT_TOKEN'), os.getenv('BOT_API_URL')
+
+
+async def _poll(router, stop):
+    """Long-poll Telegram and route every update"""
+    from telegram import Bot
+    token, base_url = _bot_settings()
+    bot = Bot(token, base_url=base_url) if base_url else Bot(token)
+    offset = None
+    stopped = asyncio.create_task(stop.wait())
+    async with bot:
+        while not stop.is_set():
+            poll = asyncio.create_task(bot.get_updates(offset=offset, timeout=10))
+            await asyncio.wait({poll, stopped}, return_when=asyncio.FIRST_COMPLETED)
+            if stop.is_set():
+                poll.cancel()
+                break
+            try:
+                updates = poll.result()
+            except Exception as e:
+                logger.error(f"getUpdates failed: {e}")
+                await asyncio.sleep(1)
+                continue
+            for update in updates:
+                await router.route(update.to_dict())
+                offset = update.update_id + 1
+
+
+async def _serve_router(router, stop):
+    """Take updates on the public webhook and route them"""
+    import webhook
+
+    class RouterServer(webhook.WebhookServer):
+        async def accept(self, body):
+            try:
+                data = json.loads(body)
+            except ValueError:
+                return 400, 'invalid update'
+            await router.route(data, body)
+            return 200, 'ok'
+
+    server = RouterServer(None)
+    await server.start()
+    if webhook.WEBHOOK_URL:
+        from telegram import Bot
+        token, base_url = _bot_settings()
+        async with (Bot(token, base_url=base_url) if base_url else Bot(token)) as bot:
+            await bot.set_webhook(url=webhook.WEBHOOK_URL.rstrip('/') + webhook.WEBHOOK_PATH,
+                                  secret_token=webhook.WEBHOOK_SECRET)
+    await stop.wait()
+    await server.stop()
+
+
+async def run_router(count=SHARD_COUNT, mode=None):
+    mode = mode or os.getenv('BOT_MODE', 'polling')
+    router = Router(count)
+    await router.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+
+    front = _serve_router(router, stop) if mode == 'webhook' else _poll(router, stop)
+    logger.info(f"Routing {mode} updates to {count} shards")
+    await front
+    await router.stop()
+    logger.info(f"Forwarded per shard: {router.forwarded}")
+
+
+def run(count=SHARD_COUNT):
+    """Start one worker per shard and the router; returns when stopped"""
+    if count <= 1:
+        raise SystemExit("Set SHARD_COUNT (or --shards) above 1 to run sharded")
+    processes = start_workers(count)
+    try:
+        asyncio.run(run_router(count))
+    finally:
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+        for process in processes:
+            process.join()
+
+
+# ============================================
+# Maintenance
+# ============================================
+
+def split_database(source=DB_PATH, count=SHARD_COUNT):
+    """Copy every user's rows from an unsharded database into its shard"""
+    from migrations import migrate
+
+    copied = [0] * count
+    for index in range(count):
+        path = shard_path(index, count, source)
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        conn = sqlite3.connect(path)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            migrate(conn)
+            conn.create_function('shard_for', 1, lambda user_id: shard_for(user_id or 0, count), deterministic=True)
+            conn.execute('ATTACH DATABASE ? AS source', (f"file:{source}?mode=ro",))
+            # Templates are shared by all users; copied with their ids so the
+            # copied conversations still point at the right rows
+            if conn.execute('PRAGMA source.table_info(response_templates)').fetchone():
+                conn.execute('''
+                    INSERT OR IGNORE INTO main.response_templates (template_id, hash, body)
+                    SELECT template_id, hash, body FROM source.response_templates
+                ''')
+            for table in SHARDED_TABLES:
+                columns = [row[1] for row in conn.execute(f'PRAGMA source.table_info({table})')]
+                if not columns:
+                    continue
+                names = ', '.join(columns)
+                cursor = conn.execute(f'''
+                    INSERT OR IGNORE INTO main.{table} ({names})
+                    SELECT {names} FROM source.{table} WHERE shard_for(user_id) = ?
+                ''', (index,))
+                copied[index] += cursor.rowcount
+            # Copied rows are not in the rollups yet: let the backfill count them
+            conn.execute('''
+                UPDATE analytics_state SET value = (SELECT COALESCE(MAX(assessment_id), 0) FROM assessments)
+                WHERE key = 'backfill_until'
+            ''')
+            # Nor in the search index
+            conn.execute('''
+                UPDATE search_state SET value = (SELECT COALESCE(MAX(conversation_id), 0) FROM conversations)
+                WHERE key = 'backfill_until'
+            ''')
+            conn.commit()
+            conn.execute('DETACH DATABASE source')
+        finally:
+            conn.close()
+    return copied
+
+
+def _table_counts(conn):
+    return {
+        table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+        for table in ('users', 'assessments', 'conversations')
+    }
+
+
+if __name__ == '__main__':
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Sharded storage and workers")
+    parser.add_argument('command', choices=('run', 'split', 'status'))
+    parser.add_argument('--shards', type=int, default=SHARD_COUNT)
+    args = parser.parse_args()
+
+    if args.command == 'run':
+        run(args.shards)
+    elif args.command == 'split':
+        copied = split_database(DB_PATH, args.shards)
+        print(f"Copied {sum(copied)} rows into {args.shards} shards: {copied}")
+    else:
+        paths = [path for path in shard_paths(args.shards) if os.path.exists(path)]
+        for path, counts in zip(paths, fanout(_table_counts, count=args.shards)):
+            print(f"{path}: {counts}")
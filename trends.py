@@ -0,0 +1,74 @@
+"""
+Per-user score trend kept up to date on every PHQ-9 assessment
+
+user_trends holds, per user, the number of full PHQ-9 assessments, the
+last score, its change from the previous one, an exponentially weighted
+moving average of the score and the time of the last assessment.  It is
+updated in constant time in the same transaction as each assessment insert
+(see database._insert_assessment), so showing a trend never reads the
+history.
+
+A user without a trend row yet (first assessment, or history from before
+the table existed) gets it built once from their history; the
+user_trends backfill does the same for everyone else.
+"""
+import os
+from typing import NamedTuple
+
+# Weight of the newest score in the moving average
+TREND_EWMA_ALPHA = float(os.getenv('TREND_EWMA_ALPHA', '0.3'))
+
+
+class Trend(NamedTuple):
+    count: int
+    last_score: int
+    # None after the first assessment
+    delta: int
+    ewma: float
+    # UTC timestamp text, as stored in assessments.assessment_date
+    last_assessed: str
+
+
+def update_trend(conn, user_id, assessment_id, score, alpha=TREND_EWMA_ALPHA):
+    """Fold one new assessment into the user's trend; runs inside the insert's transaction"""
+    cursor = conn.execute('''
+        UPDATE user_trends SET
+            count = count + 1,
+            last_score = ?,
+            delta = ? - last_score,
+            ewma = ? * ? + (1 - ?) * ewma,
+            last_assessed = (SELECT assessment_date FROM assessments WHERE assessment_id = ?)
+        WHERE user_id = ?
+    ''', (score, score, alpha, score, alpha, assessment_id, user_id))
+    if cursor.rowcount == 0:
+        rebuild_trend(conn, user_id, alpha)
+
+
+def rebuild_trend(conn, user_id, alpha=TREND_EWMA_ALPHA):
+    """Compute the user's trend from their full history"""
+    count = 0
+    previous = last = ewma = last_assessed = None
+    rows = conn.execute('''
+        SELECT phq9_score, assessment_date FROM assessments
+        WHERE user_id = ? AND questionnaire = 'phq9'
+        ORDER BY assessment_id
+    ''', (user_id,))
+    for score, assessment_date in rows:
+        count += 1
+        previous, last = last, score
+        ewma = score if ewma is None else alpha * score + (1 - alpha) * ewma
+        last_assessed = assessment_date
+    if not count:
+        return
+    conn.execute('''
+        INSERT OR REPLACE INTO user_trends (user_id, count, last_score, delta, ewma, last_assessed)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', (user_id, count, last, None if previous is None else last - previous, ewma, last_assessed))
+
+
+def get_trend(conn, user_id):
+    """The user's Trend, or None if they have no assessments"""
+    row = conn.execute('''
+        SELECT count, last_score, delta, ewma, last_assessed FROM user_trends WHERE user_id = ?
+    ''', (user_id,)).fetchone()
+    return Trend(*row) if row else None
@@ -0,0 +1,196 @@
+"""
+Recording of incoming updates for replay
+
+With UPDATE_LOG set, main.build_application installs record() as the first
+handler, which appends every incoming Update, anonymised, to that file for
+benchmarks/replay.py.  The file is a series of gzip members of JSON lines
+{"t": unix time, "update": {...}}, one member per write-behind batch
+written with a single append, so a crash loses at most the batch in flight
+and gzip readers (zcat, read_log) see one continuous stream.
+
+Anonymisation keeps the traffic's shape and drops what identifies people:
+
+- user and chat ids become stable pseudonyms (an HMAC with UPDATE_LOG_SALT,
+  random per process unless set, so ids only line up across restarts
+  when it is), and names and usernames are removed
+- message text is cut to a leading /command; bot messages inside callback
+  queries lose their text, which can hold the user's name; callback query
+  and chat_instance ids are hashed
+- signed answer buttons (SESSION_STORE=callback) are stored as the plain
+  answer_<value> they stand for, since their MAC is bound to the real
+  user id and the recording process's key
+"""
+import base64
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+# Append anonymised incoming updates to this file, empty to disable
+UPDATE_LOG = os.getenv('UPDATE_LOG', '')
+UPDATE_LOG_SALT = os.getenv('UPDATE_LOG_SALT', '')
+
+# Updates per compressed member, and seconds before a partial one is written
+UPDATE_LOG_BATCH = int(os.getenv('UPDATE_LOG_BATCH', '500'))
+UPDATE_LOG_FLUSH_INTERVAL = float(os.getenv('UPDATE_LOG_FLUSH_INTERVAL', '5'))
+
+# Objects holding a user or chat
+_IDENTITY_KEYS = frozenset({'from', 'chat', 'user', 'sender_chat', 'forward_from', 'forward_from_chat'})
+_NAME_FIELDS = ('username', 'first_name', 'last_name', 'title')
+# Payloads with personal content, dropped outright
+_DROPPED_KEYS = frozenset({'contact', 'location', 'venue', 'photo', 'document', 'voice',
+                           'video', 'audio', 'sticker', 'caption', 'caption_entities'})
+
+# session_store.CallbackSessions.PREFIX; its state's low 2 bits are the answer
+_SIGNED_PREFIX = 's:'
+
+_recorder = None
+
+
+class Anonymiser:
+    """Replaces identifiers in Update dicts with keyed pseudonyms"""
+
+    def __init__(self, salt=UPDATE_LOG_SALT):
+        self.key = salt.encode() if salt else os.urandom(32)
+
+    def _hash(self, text):
+        # 48 bits: unique enough, and fits every Telegram id field
+        digest = hmac.new(self.key, text.encode(), hashlib.sha256).digest()
+        return int.from_bytes(digest[:6], 'big') + 1
+
+    def pseudonym(self, value):
+        pseudo = self._hash(str(abs(int(value))))
+        return -pseudo if int(value) < 0 else pseudo
+
+    def _identity(self, obj):
+        if obj.get('is_bot'):
+            return obj
+        obj = {key: value for key, value in obj.items() if key not in _NAME_FIELDS}
+        obj['id'] = self.pseudonym(obj['id'])
+        if 'is_bot' in obj:
+            # Required for a User
+            obj['first_name'] = 'User'
+        return obj
+
+    def _message_text(self, message, from_bot):
+        text = message.get('text')
+        if text is None:
+            return message
+        message = dict(message)
+        command = text.split()[0] if text.startswith('/') and not from_bot else ''
+        message['text'] = command
+        entities = [entity for entity in message.pop('entities', ())
+                    if entity.get('type') == 'bot_command' and entity.get('offset') == 0]
+        if command and entities:
+            message['entities'] = [dict(entities[0], length=len(command))]
+        return message
+
+    def anonymise(self, obj, key=None):
+        """Anonymised copy of an Update dict (or any part of one)"""
+        if isinstance(obj, list):
+            return [self.anonymise(value, key) for value in obj]
+        if not isinstance(obj, dict):
+            return obj
+        if key in _IDENTITY_KEYS and 'id' in obj:
+            return self._identity(obj)
+        if 'text' in obj and 'message_id' in obj:
+            obj = self._message_text(obj, (obj.get('from') or {}).get('is_bot', False))
+        result = {}
+        for name, value in obj.items():
+            if name in _DROPPED_KEYS:
+                continue
+            if name == 'chat_instance' or (name == 'id' and key == 'callback_query'):
+                value = str(self._hash(f'{name}:{value}'))
+            elif name in ('data', 'callback_data') and isinstance(value, str) and value.startswith(_SIGNED_PREFIX):
+                value = signed_answer(value)
+            else:
+                value = self.anonymise(value, name)
+            result[name] = value
+        return result
+
+
+def signed_answer(data):
+    """answer_<value> for a signed answer button's callback_data"""
+    try:
+        state = base64.urlsafe_b64decode(data[len(_SIGNED_PREFIX):])[:3]
+        return f"answer_{state[-1] & 3}"
+    except (ValueError, IndexError):
+        return 'answer_invalid'
+
+
+class UpdateRecorder:
+    """Appends anonymised updates to a compressed log in batches"""
+
+    def __init__(self, path=UPDATE_LOG, salt=UPDATE_LOG_SALT,
+                 max_batch=UPDATE_LOG_BATCH, flush_interval=UPDATE_LOG_FLUSH_INTERVAL):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.anonymiser = Anonymiser(salt)
+        self.recorded = 0
+        # One thread, so batches are appended in order; flushes started by
+        # record() on the event loop only hand their batch over
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='update-log')
+        self._queue = WriteBehindQueue(self._write, max_batch=max_batch, flush_interval=flush_interval)
+
+    def record(self, update_dict, timestamp=None):
+        line = json.dumps({
+            't': round(time.time() if timestamp is None else timestamp, 3),
+            'update': self.anonymiser.anonymise(update_dict),
+        }, separators=(',', ':'), ensure_ascii=False)
+        self._queue.put(line)
+        self.recorded += 1
+
+    def _write(self, lines):
+        return self._executor.submit(self._append, lines)
+
+    def _append(self, lines):
+        try:
+            if lines:
+                member = gzip.compress(('\n'.join(lines) + '\n').encode(), 6)
+                with open(self.path, 'ab') as f:
+                    f.write(member)
+            return len(lines)
+        except Exception as e:
+            logger.error(f"Error writing update log: {e}")
+            raise
+
+    def close(self):
+        self._queue.close()
+        self._executor.shutdown()
+
+
+def read_log(path):
+    """(timestamp, update dict) for each recorded update, in order"""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        try:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    yield entry['t'], entry['update']
+        except (EOFError, ValueError) as e:
+            # A batch cut short by a crash: keep everything before it
+            logger.warning(f"{path} ends with an incomplete batch: {e}")
+
+
+async def record(update, context):
+    """Handler for group -1: log the update before the bot handles it"""
+    global _recorder
+    if _recorder is None:
+        _recorder = UpdateRecorder()
+    _recorder.record(update.to_dict())
+
+
+def close():
+    """Write out buffered updates"""
+    global _recorder
+    if _recorder is not None:
+        _recorder.close()
+        _recorder = None
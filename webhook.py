@@ -0,0 +1,228 @@
+"""
+Webhook serving mode
+
+Serves Telegram updates from an embedded HTTP server instead of long polling.
+Several worker processes can share the port (SO_REUSEPORT) or sit behind a
+load balancer; they need a shared session store (SESSION_STORE=sqlite) or
+stateless sessions (SESSION_STORE=callback) since consecutive taps from one
+user may reach different workers.  Updates are only ordered per user within
+a worker, so the sqlite store applies each answer as a compare-and-swap
+(SQLiteSessionStore.record_answer): of two taps on one question handled by
+different workers at once, only the first is recorded.
+
+Usage:
+  python webhook.py serve [--port 8443] [--workers 1]
+  python webhook.py post update.json [--url http://127.0.0.1:8443/telegram]
+
+'post' sends recorded Update JSON (one object, a list, or JSON lines) to a
+running server, which is how the webhook can be exercised offline.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import urllib.error
+import urllib.request
+
+import metrics
+from http_server import HTTPServer
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Public URL registered with Telegram on startup, e.g. https://bot.example.com
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+# Checked against the X-Telegram-Bot-Api-Secret-Token header when set
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+WEBHOOK_WORKERS = int(os.getenv('WEBHOOK_WORKERS', '1'))
+
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+
+class WebhookServer(HTTPServer):
+    """HTTP endpoint that feeds POSTed updates to an Application"""
+
+    def __init__(self, application, host=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                 path=WEBHOOK_PATH, secret=WEBHOOK_SECRET, reuse_port=False):
+        super().__init__(host, port, reuse_port)
+        self.application = application
+        self.path = path
+        self.secret = secret
+
+    async def start(self):
+        await super().start()
+        logger.info(f"Webhook listening on {self.host}:{self.port}{self.path}")
+
+    async def handle_request(self, method, target, headers, body):
+        """Route one request, returns (status, body)"""
+        path = target.split('?', 1)[0]
+        if path == '/healthz':
+            return (200, 'ok') if self.accepting else (503, 'stopping')
+        if path == '/metrics' and metrics.METRICS_ENABLED:
+            return 200, await metrics.render_async()
+        if path != self.path:
+            return 404, 'not found'
+        if method != 'POST':
+            return 405, 'method not allowed'
+        if self.secret and headers.get(SECRET_HEADER) != self.secret:
+            return 403, 'forbidden'
+        if body is None:
+            return 413, 'too large'
+        if not self.accepting:
+            return 503, 'stopping'
+        return await self.accept(body)
+
+    async def accept(self, body):
+        """Hand one update body to the application, returns (status, body)"""
+        from telegram import Update
+        try:
+            update = Update.de_json(json.loads(body), self.application.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.error(f"Invalid update payload: {e}")
+            return 400, 'invalid update'
+        await self.application.update_queue.put(update)
+        return 200, 'ok'
+
+
+async def serve(application, port=WEBHOOK_PORT, reuse_port=False, register=True):
+    """Run the application behind the webhook server until SIGINT/SIGTERM"""
+    await application.initialize()
+    if application.post_init:
+        await application.post_init(application)
+    if register and WEBHOOK_URL:
+        await application.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip('/') + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET,
+        )
+    await application.start()
+
+    server = WebhookServer(application, port=port, reuse_port=reuse_port)
+    await server.start()
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass
+    try:
+        await stop.wait()
+    finally:
+        # Stop taking updates first, then let the application finish the
+        # queued ones before the database is closed in post_shutdown
+        logger.info("Webhook shutting down")
+        await server.stop()
+        await application.stop()
+        if application.post_stop:
+            await application.post_stop(application)
+        await application.shutdown()
+        if application.post_shutdown:
+            await application.post_shutdown(application)
+
+
+def _run_worker(index, port, reuse_port):
+    import main
+    application = main.build_application(webhook=True)
+    if reuse_port:
+        # One of several workers: the others' saves would not invalidate
+        # this process's history cache
+        import database
+        database.disable_history_cache()
+        # Skips migrations and backfills (run by the parent process) and
+        # moves the standalone metrics server to METRICS_PORT + index
+        application.bot_data['webhook_worker'] = index
+    # Only the first worker registers the webhook with Telegram
+    asyncio.run(serve(application, port, reuse_port, register=index == 0))
+
+
+def run(port=WEBHOOK_PORT, workers=WEBHOOK_WORKERS):
+    """Start the webhook in this process, or in several processes sharing the port"""
+    if workers <= 1:
+        _run_worker(0, port, False)
+        return
+
+    from session_store import SESSION_STORE
+    if SESSION_STORE == 'memory':
+        sys.exit("WEBHOOK_WORKERS > 1 needs a shared session store, set SESSION_STORE=sqlite or callback")
+
+    # Migrate once here rather than in every worker at the same moment, and
+    # close the database again: forked workers must not share connections
+    import database
+    database.init_database(backfill=False)
+    database.close_database()
+
+    processes = [
+        multiprocessing.Process(target=_run_worker, args=(i, port, True), name=f"webhook-{i}")
+        for i in range(workers)
+    ]
+    for process in processes:
+        process.start()
+    # Backfills run in this process only, while the workers serve
+    database.init_database(apply_migrations=False)
+
+    def forward(signum, frame):
+        for process in processes:
+            if process.is_alive():
+                os.kill(process.pid, signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, forward)
+    signal.signal(signal.SIGINT, forward)
+    for process in processes:
+        process.join()
+    database.close_database()
+
+
+def post_updates(source, url, secret=WEBHOOK_SECRET):
+    """POST recorded updates to a webhook, returns the HTTP status of each"""
+    text = sys.stdin.read() if source == '-' else open(source).read()
+    try:
+        data = json.loads(text)
+        updates = data if isinstance(data, list) else [data]
+    except ValueError:
+        updates = [json.loads(line) for line in text.splitlines() if line.strip()]
+
+    statuses = []
+    for update in updates:
+        request = urllib.request.Request(
+            url, data=json.dumps(update).encode(), method='POST',
+            headers={'Content-Type': 'application/json'},
+        )
+        if secret:
+            request.add_header(SECRET_HEADER, secret)
+        try:
+            with urllib.request.urlopen(request) as response:
+                statuses.append(response.status)
+        except urllib.error.HTTPError as e:
+            statuses.append(e.code)
+    return statuses
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Webhook serving mode")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    serve_parser = commands.add_parser('serve', help="run the bot behind the webhook server")
+    serve_parser.add_argument('--port', type=int, default=WEBHOOK_PORT)
+    serve_parser.add_argument('--workers', type=int, default=WEBHOOK_WORKERS)
+
+    post_parser = commands.add_parser('post', help="POST recorded updates to a running webhook")
+    post_parser.add_argument('file', help="JSON or JSON lines file, - for stdin")
+    post_parser.add_argument('--url', default=f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    args = parser.parse_args()
+    if args.command == 'serve':
+        run(args.port, args.workers)
+    else:
+        statuses = post_updates(args.file, args.url)
+        print(f"Posted {len(statuses)} updates: {statuses.count(200)} accepted")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,126 @@
+import threading
+import time
+
+
+class WriteBehindQueue:
+    """
+    Buffers records in memory and hands them to a flush function in batches
+
+    A batch is flushed when it reaches max_batch records or when its oldest
+    record has waited flush_interval seconds, whichever comes first.
+    submit_batch(batch) must return a concurrent.futures.Future that resolves
+    once the batch is committed.  Batches are submitted in the order the
+    records were queued.
+    """
+
+    def __init__(self, submit_batch, max_batch=100, flush_interval=0.5):
+        self._submit_batch = submit_batch
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+
+        self._cond = threading.Condition()
+        self._buffer = []
+        self._oldest = None
+        self._in_flight = 0
+        self._closed = False
+
+        # Tuning counters
+        self.flushes = 0
+        self.records_flushed = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._total_flush_ms = 0.0
+
+        self._thread = threading.Thread(target=self._run, name='write-behind', daemon=True)
+        self._thread.start()
+
+    def put(self, record):
+        """Queue a record for the next batch"""
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("write-behind queue is closed")
+            if not self._buffer:
+                # Wake the flusher so it starts the time window
+                self._oldest = time.monotonic()
+                self._cond.notify()
+            self._buffer.append(record)
+            if len(self._buffer) >= self.max_batch:
+                self._cond.notify()
+
+    def flush(self, *records):
+        """
+        Flush everything pending, plus the given records, right away
+
+        Returns a Future that resolves once the batch is committed, so callers
+        that need a durable write can wait for it.
+        """
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("write-behind queue is closed")
+            self._buffer.extend(records)
+            return self._flush_locked()
+
+    def _flush_locked(self):
+        # Swap and submit under the lock so batches reach the writer in order
+        batch = self._buffer
+        self._buffer = []
+        self._oldest = None
+        started = time.perf_counter()
+        future = self._submit_batch(batch)
+        # Counted only once submitted: a submit that raises never calls back
+        self._in_flight += len(batch)
+        future.add_done_callback(lambda f: self._flushed(len(batch), started))
+        return future
+
+    def _flushed(self, size, started):
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._cond:
+            self._in_flight -= size
+            if size:
+                self.flushes += 1
+                self.records_flushed += size
+                self.last_flush_ms = elapsed_ms
+                self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+                self._total_flush_ms += elapsed_ms
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if not self._buffer:
+                    self._cond.wait()
+                    continue
+                remaining = self._oldest + self.flush_interval - time.monotonic()
+                if len(self._buffer) < self.max_batch and remaining > 0:
+                    self._cond.wait(remaining)
+                    continue
+                self._flush_locked()
+
+    @property
+    def depth(self):
+        """Records queued or submitted but not yet committed"""
+        with self._cond:
+            return len(self._buffer) + self._in_flight
+
+    def stats(self):
+        """Queue depth and flush latency, for tuning batch size and interval"""
+        with self._cond:
+            return {
+                'depth': len(self._buffer) + self._in_flight,
+                'flushes': self.flushes,
+                'records_flushed': self.records_flushed,
+                'last_flush_ms': self.last_flush_ms,
+                'avg_flush_ms': self._total_flush_ms / self.flushes if self.flushes else 0.0,
+                'max_flush_ms': self.max_flush_ms,
+            }
+
+    def close(self):
+        """Stop the flusher thread and wait until all queued records are committed"""
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+        with self._cond:
+            future = self._flush_locked()
+        future.result()